@@ -1,13 +1,109 @@
+import ipaddress
 import os
-import requests
+import time
 
 from jose import jwt, JWTError
 from fastapi import HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+
+from . import database, profiling
+from .jwks import key_store
+from .metrics import auth_verify_duration
+from .token_cache import token_cache
+
+# Members of this Cognito group manage the authorizations of the other users
+ADMIN_GROUP = os.getenv("ADMIN_GROUP", "admin")
+# Addresses or networks of the load balancers and proxies in front of the API, whose X-Forwarded-For is trusted
+TRUSTED_PROXIES = [ipaddress.ip_network(proxy.strip(), strict = False)
+                   for proxy in os.getenv("TRUSTED_PROXIES", "").split(",") if proxy.strip()]
+
+def get_token(request: Request) -> str:
+    """
+    Get the bearer token of the request.
+
+    :param request: The request object containing the access token.
+    :type request: Request
+    :return: The raw access token.
+    :rtype: str
+    :raises HTTPException: If the authorization header is missing or malformed.
+    """
+    authorization = request.headers.get("Authorization")
+    if not authorization:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail = "ERROR: Authorization header missing")
+    parts = authorization.split(" ")
+    if len(parts) < 2:
+        raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "ERROR: Error authenticating")
+    return parts[1]
+
+def is_trusted_proxy(address: str) -> bool:
+    """
+    :param address: An IP address.
+    :return: True if the address belongs to one of the `TRUSTED_PROXIES`.
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+def client_address(request: Request) -> str:
+    """
+    Get the address of the client of a request. When the request comes from a trusted proxy, it is the last address
+    of X-Forwarded-For which isn't a trusted proxy: each proxy appends the address it got the request from, so the
+    addresses before it may be forged by the client.
+
+    :param request: The request object.
+    :type request: Request
+    :return: The address of the client, or "unknown".
+    :rtype: str
+    """
+    address = request.client.host if request.client else "unknown"
+    if not is_trusted_proxy(address):
+        return address
+    hops = [hop.strip() for header in request.headers.getlist("X-Forwarded-For") for hop in header.split(",")]
+    return next((hop for hop in reversed(hops) if hop and not is_trusted_proxy(hop)), address)
+
+def client_identity(request: Request) -> str:
+    """
+    Identify the client of a request without verifying its access token, e.g. to rate limit it before the
+    verification. Only tokens which were already verified are trusted, so a client can't borrow another's identity.
+
+    :param request: The request object, possibly with an access token.
+    :type request: Request
+    :return: `sub:<sub>` for a verified token, else `ip:<client address>`.
+    :rtype: str
+    """
+    parts = request.headers.get("Authorization", "").split(" ")
+    if len(parts) >= 2:
+        claims = token_cache.peek(parts[1])
+        if claims is not None and claims.get("sub"):
+            return f"sub:{claims['sub']}"
+    return f"ip:{client_address(request)}"
+
+def decode_token(token: str, key: dict) -> dict:
+    """
+    Check the signature and the claims of the access token, and store it in the token cache.
+
+    :param token: The raw access token.
+    :param key: The JWK the token was signed with, or None if it is unknown.
+    :return: The decoded access token.
+    :raises JWTError: If the access token is invalid.
+    """
+    if key is None:
+        raise JWTError("Unknown signing key")
+    decoded_token = jwt.decode(token, key, algorithms=["RS256"],
+                               audience = os.getenv('COGNITO_AUDIENCE'), issuer = os.getenv('COGNITO_ISSUER'))
+    token_cache.put(token, decoded_token)
+    return decoded_token
 
 def verify_access(request: Request):
     """
     Verify access token in the request.
 
+    The signing key is taken from the process-wide JWKS key store, so the issuer is only contacted when
+    its keys expire or when the token was signed with a key we don't know yet. Tokens which were already
+    verified are served from the token cache until they expire.
+
     :param request: The request object containing the access token.
     :type request: Request
     :return: The decoded access token if valid.
@@ -16,19 +112,94 @@ def verify_access(request: Request):
     :raises HTTPException: If the access token is invalid.
     :raises HTTPException: If there is an error authenticating.
     """
-    authorization = request.headers.get("Authorization")
-    if not authorization:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail = "ERROR: Authorization header missing")
+    token = get_token(request)
+    start = time.perf_counter()
+    outcome = "cached"
     try:
-        token = authorization.split(" ")[1]
-        issuer = os.getenv('COGNITO_ISSUER')
-        audience = os.getenv('COGNITO_AUDIENCE')
-        response = requests.get(f"{issuer}/.well-known/jwks.json")
-        jwks = response.json()["keys"]
-        decoded_token = jwt.decode(token, jwks, algorithms=["RS256"],
-                                   audience = audience, issuer = issuer)
+        decoded_token = token_cache.get(token)
+        if decoded_token is None:
+            outcome = "verified"
+            decoded_token = decode_token(token, key_store.get_key(jwt.get_unverified_header(token).get("kid")))
         return decoded_token
     except JWTError:
+        outcome = "invalid"
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail = "ERROR: Invalid Access token")
     except Exception:
-        raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "ERROR: Error authenticating")
\ No newline at end of file
+        outcome = "error"
+        raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "ERROR: Error authenticating")
+    finally:
+        auth_verify_duration.labels(outcome).observe(time.perf_counter() - start)
+
+async def verify_access_async(request: Request):
+    """
+    Asynchronous version of :func:`verify_access`. The signing keys are fetched without blocking the event loop.
+
+    :param request: The request object containing the access token.
+    :type request: Request
+    :return: The decoded access token if valid.
+    :rtype: Dict[str, Any]
+    :raises HTTPException: If the authorization header is missing.
+    :raises HTTPException: If the access token is invalid.
+    :raises HTTPException: If there is an error authenticating.
+    """
+    token = get_token(request)
+    start = time.perf_counter()
+    outcome = "cached"
+    try:
+        decoded_token = token_cache.get(token)
+        if decoded_token is None:
+            outcome = "verified"
+            decoded_token = decode_token(token, await key_store.aget_key(jwt.get_unverified_header(token).get("kid")))
+        return decoded_token
+    except JWTError:
+        outcome = "invalid"
+        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail = "ERROR: Invalid Access token")
+    except Exception:
+        outcome = "error"
+        raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "ERROR: Error authenticating")
+    finally:
+        auth_verify_duration.labels(outcome).observe(time.perf_counter() - start)
+
+async def get_claims(request: Request) -> dict:
+    """
+    Request-scoped dependency which verifies the access token once and shares its claims.
+
+    The decoded claims are kept in the request state, so the endpoint and everything it calls get the
+    same claims without verifying the token again. In async mode the token is verified on the event loop,
+    otherwise in the threadpool.
+
+    :param request: The request object containing the access token.
+    :type request: Request
+    :return: The decoded access token if valid.
+    :rtype: Dict[str, Any]
+    :raises HTTPException: If the access token is missing or invalid.
+    """
+    claims = getattr(request.state, "claims", None)
+    if claims is None:
+        start = time.perf_counter()
+        try:
+            if database.ASYNC_MODE:
+                claims = await verify_access_async(request)
+            else:
+                claims = await run_in_threadpool(verify_access, request)
+        finally:
+            profiling.record("auth", time.perf_counter() - start)
+        request.state.claims = claims
+    return claims
+
+async def require_admin(request: Request) -> dict:
+    """
+    Request-scoped dependency which only lets the members of the admin group through, based on the
+    `cognito:groups` claim of the access token.
+
+    :param request: The request object containing the access token.
+    :type request: Request
+    :return: The decoded access token if valid.
+    :rtype: Dict[str, Any]
+    :raises HTTPException: If the access token is missing or invalid.
+    :raises HTTPException: If the user is not a member of the admin group.
+    """
+    claims = await get_claims(request)
+    if ADMIN_GROUP not in (claims.get("cognito:groups") or []):
+        raise HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail = "ERROR: Admin access required")
+    return claims
@@ -0,0 +1,319 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import compression, schemas
+from .geo import GridIndex, parse_coordinates
+from .search import SearchIndex
+
+# Keep the JSON encoding of the catalogue with its snapshot, so that reads send pre-encoded bytes
+ENCODED_CACHE = os.getenv("POINTS_ENCODED_CACHE", "true").lower() in ("1", "true", "yes")
+
+class CatalogueSnapshot:
+    """
+    Immutable copy of every stored point, indexed by name and by id.
+
+    Attributes:
+        generation (int): The cache generation the snapshot was built for.
+        points (List[schemas.Point]): Every point, in id order.
+        by_name (Dict[str, schemas.Point]): The points indexed by their name.
+        by_id (Dict[int, schemas.Point]): The points indexed by their id.
+        built_at (float): Monotonic time at which the snapshot was built.
+        encoded (bytes): JSON encoding of the whole list.
+        etag (str): Strong entity tag of the whole list, computed from its encoding.
+    """
+
+    def __init__(self, generation: int, points: Iterable, search_base: Optional[SearchIndex] = None):
+        self.generation = generation
+        self.points: List[schemas.Point] = schemas.PointList.validate_python(list(points), from_attributes = True)
+        self.by_name: Dict[str, schemas.Point] = {point.name: point for point in self.points}
+        self.by_id: Dict[int, schemas.Point] = {point.id: point for point in self.points}
+        self.built_at = time.monotonic()
+        self._etag: Optional[str] = None
+        self._encoded: Optional[bytes] = None
+        self._point_etags: Dict[str, str] = {}
+        self._encoded_points: Dict[str, bytes] = {}
+        self._compressed: Dict[str, bytes] = {}
+        self._geo_index: Optional[GridIndex] = None
+        self._search_index: Optional[SearchIndex] = None
+        self._search_base = search_base
+
+    @staticmethod
+    def bytes_tag(encoded: bytes) -> str:
+        """
+        :param encoded: Encoded content.
+        :return: A strong entity tag computed from the content.
+        """
+        return f'"{hashlib.sha256(encoded).hexdigest()[:32]}"'
+
+    @property
+    def encoded(self) -> bytes:
+        """
+        :return: The JSON encoding of the whole list, encoded once per snapshot unless POINTS_ENCODED_CACHE is off.
+        """
+        if self._encoded is not None:
+            return self._encoded
+        encoded = schemas.PointList.dump_json(self.points)
+        if ENCODED_CACHE:
+            self._encoded = encoded
+        return encoded
+
+    @property
+    def etag(self) -> str:
+        if self._etag is None:
+            self._etag = self.bytes_tag(self.encoded)
+        return self._etag
+
+    @property
+    def geo_index(self) -> GridIndex:
+        """
+        :return: Spatial index of the points with valid coordinates, built on first use.
+        """
+        if self._geo_index is None:
+            entries = []
+            for point in self.points:
+                parsed = parse_coordinates(point.coordinates)
+                if parsed is not None:
+                    entries.append((parsed[0], parsed[1], point))
+            self._geo_index = GridIndex(entries)
+        return self._geo_index
+
+    @property
+    def search_index(self) -> SearchIndex:
+        """
+        :return: Prefix search index of the names and locations of the points, built on first use. It is derived
+            from the index of a previous snapshot when there is one, so only the changed points are indexed again.
+        """
+        if self._search_index is None:
+            entries = ((point.id, point.name, point.location, point) for point in self.points)
+            base = self._search_base
+            self._search_index = SearchIndex(entries) if base is None else base.updated(entries)
+            self._search_base = None
+        return self._search_index
+
+    @property
+    def latest_search_index(self) -> Optional[SearchIndex]:
+        """
+        :return: The search index of the snapshot if it was built, else the index it would be derived from.
+        """
+        return self._search_index if self._search_index is not None else self._search_base
+
+    def compressed(self, encoding: str) -> bytes:
+        """
+        :param encoding: The content coding, "br" or "gzip".
+        :return: The JSON encoding of the whole list compressed with that coding, cached like :attr:`encoded`.
+        """
+        compressed = self._compressed.get(encoding)
+        if compressed is None:
+            compressed = compression.compress(self.encoded, encoding)
+            if ENCODED_CACHE:
+                self._compressed[encoding] = compressed
+        return compressed
+
+    def point_encoded(self, name: str) -> bytes:
+        """
+        :param name: The name of a point in the snapshot.
+        :return: The JSON encoding of that point, cached like :attr:`encoded`.
+        """
+        encoded = self._encoded_points.get(name)
+        if encoded is None:
+            encoded = self.by_name[name].model_dump_json().encode()
+            if ENCODED_CACHE:
+                self._encoded_points[name] = encoded
+        return encoded
+
+    def point_etag(self, name: str) -> str:
+        """
+        :param name: The name of a point in the snapshot.
+        :return: The strong entity tag of that point.
+        """
+        etag = self._point_etags.get(name)
+        if etag is None:
+            etag = self._point_etags[name] = self.bytes_tag(self.point_encoded(name))
+        return etag
+
+class PointCatalogue:
+    """
+    Read-through, in-process cache of the points catalogue.
+
+    The snapshot is dropped whenever the invalidation bus announces that a point was created or deleted, in this
+    replica or in another one, and rebuilt lazily on the next read. The TTL bounds how long writes which were
+    not announced can go unnoticed.
+
+    :param ttl: Seconds a snapshot is served for. A TTL of 0 disables the cache.
+    """
+
+    def __init__(self, ttl: float = float(os.getenv("POINTS_CACHE_TTL", "60"))):
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._snapshot: Optional[CatalogueSnapshot] = None
+        # The search index of the dropped snapshot, from which the next one is derived
+        self._search_base: Optional[SearchIndex] = None
+        self._lock = threading.Lock()
+
+    def current(self) -> Optional[CatalogueSnapshot]:
+        """
+        Get the cached snapshot, without touching the database.
+
+        :return: The snapshot, or None if there is none or it is older than the TTL.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - snapshot.built_at >= self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return snapshot
+
+    def install(self, points: Iterable, generation: int) -> CatalogueSnapshot:
+        """
+        Build a snapshot from the given points and cache it, unless the catalogue changed meanwhile.
+
+        :param points: Every stored point, as ORM objects or dictionaries.
+        :param generation: The cache generation read before loading the points.
+        :return: The new snapshot.
+        """
+        previous = self._snapshot
+        search_base = previous.latest_search_index if previous is not None else self._search_base
+        snapshot = CatalogueSnapshot(generation, points, search_base)
+        with self._lock:
+            if generation == self.generation:
+                self._snapshot = snapshot
+        return snapshot
+
+    def invalidate(self):
+        """
+        Drop the cached snapshot and move to the next cache generation.
+
+        :return: None
+        """
+        with self._lock:
+            self.generation += 1
+            if self._snapshot is not None:
+                self._search_base = self._snapshot.latest_search_index
+            self._snapshot = None
+
+    def stats(self) -> dict:
+        """
+        :return: The hit/miss counters and the state of the cached snapshot.
+        """
+        snapshot = self._snapshot
+        lookups = self.hits + self.misses
+        return {
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "cached_points": len(snapshot.points) if snapshot is not None else 0,
+            "age_seconds": time.monotonic() - snapshot.built_at if snapshot is not None else None,
+            "ttl_seconds": self.ttl,
+        }
+
+class AuthorizationMap:
+    """
+    In-memory map from an access token `sub` to its authorization: (name, point_id).
+
+    The map is loaded whole, refreshed incrementally with the authorizations added since the last load, and
+    reloaded whole once it is older than the TTL, which bounds how long changes made by other processes go
+    unnoticed. Changes made through `crud` are applied to it directly, and it is dropped whenever the invalidation
+    bus announces a change, so that revocations reach every replica.
+
+    :param ttl: Seconds the map is trusted for before a full reload.
+    """
+
+    def __init__(self, ttl: float = float(os.getenv("AUTH_CACHE_TTL", "300"))):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.last_id = 0
+        self.loaded_at: Optional[float] = None
+        self._entries: Dict[str, Tuple[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def is_stale(self) -> bool:
+        """
+        :return: True if the map was never loaded or is older than the TTL.
+        """
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= self.ttl
+
+    def get(self, sub: str) -> Optional[Tuple[str, int]]:
+        """
+        :param sub: The subject of the access token.
+        :return: The (name, point_id) of the authorization, or None if it is unknown or the map is stale.
+        """
+        entry = None if self.is_stale() else self._entries.get(sub)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def peek(self, sub: str) -> Optional[Tuple[str, int]]:
+        """
+        Same as :meth:`get`, without counting the lookup.
+        """
+        return None if self.is_stale() else self._entries.get(sub)
+
+    def load(self, authorizations: Iterable):
+        """
+        Replace the whole map.
+
+        :param authorizations: Every stored authorization.
+        :return: None
+        """
+        with self._lock:
+            self._entries = {}
+            self.last_id = 0
+            self._apply(authorizations)
+            self.loaded_at = time.monotonic()
+
+    def update(self, authorizations: Iterable):
+        """
+        Add or replace some authorizations.
+
+        :param authorizations: The new or changed authorizations.
+        :return: None
+        """
+        with self._lock:
+            self._apply(authorizations)
+
+    def _apply(self, authorizations: Iterable):
+        for authorization in authorizations:
+            self._entries[authorization.sub] = (authorization.name, authorization.point_id)
+            self.last_id = max(self.last_id, authorization.id)
+
+    def remove(self, sub: str):
+        """
+        :param sub: The subject whose authorization was deleted.
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(sub, None)
+
+    def clear(self):
+        """
+        Drop the whole map, so that it is reloaded on next use.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries = {}
+            self.last_id = 0
+            self.loaded_at = None
+
+    def stats(self) -> dict:
+        """
+        :return: The hit/miss counters and the size of the map.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "cached_authorizations": len(self._entries),
+            "age_seconds": time.monotonic() - self.loaded_at if self.loaded_at is not None else None,
+            "ttl_seconds": self.ttl,
+        }
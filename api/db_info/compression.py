@@ -0,0 +1,190 @@
+import gzip
+import os
+import zlib
+from typing import Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+
+# Already compressed formats, e.g. images, gain nothing from being compressed again
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# Event streams are small frames sent one at a time, which proxies must not hold back
+UNCOMPRESSED_TYPES = ("text/event-stream",)
+
+def supported_encodings() -> Tuple[str, ...]:
+    """
+    :return: The content codings the API can produce, in order of preference. Brotli needs the `brotli` package.
+    """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Pick the content coding of a response from the Accept-Encoding header of the request.
+
+    :param accept_encoding: The value of the Accept-Encoding header, if any.
+    :return: "br" or "gzip", or None if the response must not be compressed.
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        (coding, _, parameters) = item.strip().partition(";")
+        quality = 1.0
+        parameter = parameters.strip()
+        if parameter.startswith("q="):
+            try:
+                quality = float(parameter[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    candidates = [(accepted.get(coding, accepted.get("*", 0.0)), -position, coding)
+                  for (position, coding) in enumerate(supported_encodings())]
+    (quality, _, coding) = max(candidates)
+    return coding if quality > 0 else None
+
+def encoded_etag(etag: str, encoding: Optional[str]) -> str:
+    """
+    Derive the entity tag of a compressed representation, e.g. `"abc"` to `"abc-gzip"`. The gzip, br and identity
+    representations of a resource differ byte by byte, so they must not share a strong entity tag.
+
+    :param etag: The entity tag of the identity representation, strong or weak.
+    :param encoding: The content coding of the representation, or None for the identity representation.
+    :return: The entity tag of the representation. Tags already derived for that coding are returned as they are.
+    """
+    if encoding is None or not etag.endswith('"') or etag.endswith(f'-{encoding}"'):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+def identity_etag(etag: str) -> str:
+    """
+    :param etag: An entity tag, possibly weak or derived by :func:`encoded_etag`.
+    :return: The opaque tag of the identity representation, e.g. `"abc"` for `W/"abc-gzip"`.
+    """
+    etag = etag.strip().removeprefix("W/")
+    for encoding in ("br", "gzip"):
+        if etag.endswith(f'-{encoding}"'):
+            return f'{etag[:-len(encoding) - 2]}"'
+    return etag
+
+def compress(data: bytes, encoding: str, level: int = COMPRESSION_LEVEL) -> bytes:
+    """
+    :param data: The content to compress.
+    :param encoding: "br" or "gzip".
+    :param level: The gzip compression level, from 1 to 9. Brotli uses a quality of `level + 2`, at most 11.
+    :return: The compressed content.
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality = min(level + 2, 11))
+    return gzip.compress(data, compresslevel = level, mtime = 0)
+
+class StreamCompressor:
+    """
+    Incremental compressor of a streamed body. Every chunk is flushed, so the client can decode the rows it has
+    received without waiting for the end of the stream.
+
+    :param encoding: "br" or "gzip".
+    :param level: The compression level, as for :func:`compress`.
+    """
+
+    def __init__(self, encoding: str, level: int = COMPRESSION_LEVEL):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality = min(level + 2, 11))
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing JSON and text responses with brotli or gzip, as negotiated with Accept-Encoding.
+
+    Complete responses smaller than `minimum_size` are sent as they are, since compressing them costs more than
+    it saves. Streamed responses are compressed chunk by chunk, and the ETag of compressed responses is derived
+    for their coding with :func:`encoded_etag`. Responses which already have a Content-Encoding, e.g. pre-compressed
+    ones, are left untouched.
+
+    :param app: The ASGI application.
+    :param minimum_size: Size, in bytes, below which complete responses are not compressed.
+    :param level: The compression level, as for :func:`compress`.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE, level: int = COMPRESSION_LEVEL):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = None
+        for (name, value) in scope.get("headers", ()):
+            if name == b"accept-encoding":
+                encoding = negotiate(value.decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        compressor: Optional[StreamCompressor] = None
+
+        async def send_wrapper(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = start_message.get("headers", [])
+                if not self.compressible(headers) or (not more_body and len(body) < self.minimum_size):
+                    (start, start_message) = (start_message, None)
+                    await send(start)
+                    return await send(message)
+                headers = [(name, encoded_etag(value.decode("latin-1"), encoding).encode("latin-1") if name == b"etag" else value)
+                           for (name, value) in headers if name != b"content-length"]
+                headers.append((b"content-encoding", encoding.encode()))
+                headers.append((b"vary", b"Accept-Encoding"))
+                compressor = StreamCompressor(encoding, self.level)
+                if not more_body:
+                    compressed = compress(body, encoding, self.level)
+                    headers.append((b"content-length", str(len(compressed)).encode()))
+                    await send({**start_message, "headers": headers})
+                    return await send({"type": "http.response.body", "body": compressed})
+                await send({**start_message, "headers": headers})
+
+            chunk = compressor.compress(body) if body else b""
+            if not more_body:
+                chunk += compressor.finish()
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    def compressible(headers) -> bool:
+        """
+        :param headers: The raw headers of the response.
+        :return: True if the response has a compressible content type and isn't encoded yet.
+        """
+        content_type = ""
+        for (name, value) in headers:
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type":
+                content_type = value.decode("latin-1").lower()
+        return content_type.startswith(COMPRESSIBLE_TYPES) and not content_type.startswith(UNCOMPRESSED_TYPES)
@@ -1,10 +1,33 @@
-import json
 import os
-from fastapi import Request
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import Select, column, delete, func, insert, or_, select, table, text, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.orm import Session
 
-from . import models, schemas, auth
+from . import models, schemas
+from .database import replica_read
+from .cache import AuthorizationMap, CatalogueSnapshot, PointCatalogue
+from .geo import bounding_box, haversine_km, parse_coordinates
+from .invalidation import InvalidationBus, create_invalidation_bus
+from .migrations import SEARCH_TABLE
+from .search import SearchIndex, tokenize
+
+POINT_FIELDS = ("id", "name", "location", "coordinates", "image")
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+SYNC_TOMBSTONE_HORIZON = float(os.getenv("SYNC_TOMBSTONE_HORIZON", str(30 * 24 * 3600)))
 
+point_catalogue = PointCatalogue()
+authorization_map = AuthorizationMap()
+invalidation_bus = create_invalidation_bus()
+invalidation_bus.subscribe(lambda version: point_catalogue.invalidate())
+invalidation_bus.subscribe(lambda version: authorization_map.clear())
+# Authorization changes only drop the authorization maps, so the points catalogue and its version are kept
+authorization_bus = create_invalidation_bus(channel = "authorizations:invalidations", version_key = "authorizations:version")
+authorization_bus.subscribe(lambda version: authorization_map.clear())
+
+@replica_read
 def get_points(db: Session):
     """
     :param db: The database session object to use for querying.
@@ -12,6 +35,102 @@ def get_points(db: Session):
     """
     return db.query(models.Point).all()
 
+def get_points_stream_query(batch_size: int = EXPORT_BATCH_SIZE) -> Select:
+    """
+    Build the query streaming every point, in id order, from a server-side cursor.
+
+    The rows are fetched `batch_size` at a time, so only one batch is held in memory. The query is executed with
+    `Session.execute`, or with `AsyncSession.stream` in async mode.
+
+    :param batch_size: Number of rows fetched at a time.
+    :return: The query, selecting the columns of `POINT_FIELDS`.
+    """
+    return (select(*[getattr(models.Point, field) for field in POINT_FIELDS])
+            .order_by(models.Point.id)
+            .execution_options(yield_per = batch_size))
+
+def has_points(db: Session) -> bool:
+    """
+    :param db: The database session object to use for querying.
+    :return: True if there is at least one point in the database, without loading the points.
+    """
+    return db.execute(select(models.Point.id).limit(1)).first() is not None
+
+@replica_read
+def get_points_page(db: Session,
+                    limit: Optional[int] = None,
+                    offset: int = 0,
+                    after_id: Optional[int] = None,
+                    fields: Optional[Sequence[str]] = None) -> List[dict]:
+    """
+    Retrieve a page of points, in id order, selecting only the requested columns.
+
+    :param db: The database session object to use for querying.
+    :param limit: Maximum number of points to return, or None for every point.
+    :param offset: Number of points to skip.
+    :param after_id: Keyset cursor: only return points with a greater id.
+    :param fields: Names of the columns to select, from `POINT_FIELDS`. Defaults to every column.
+    :return: The points as dictionaries with the requested fields. The `id` is always included, since it is the cursor.
+    """
+    names = [field for field in (fields or POINT_FIELDS) if field != "id"]
+    query = select(models.Point.id, *[getattr(models.Point, name) for name in names]).order_by(models.Point.id)
+    if after_id is not None:
+        query = query.where(models.Point.id > after_id)
+    if offset:
+        query = query.offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    return [row._asdict() for row in db.execute(query)]
+
+@replica_read
+def get_points_in_box(db: Session, box: Tuple[float, float, float, float]):
+    """
+    Retrieve the points inside a latitude/longitude box, using the index on the numeric coordinates.
+
+    :param db: The database session object to use for querying.
+    :param box: (min_latitude, max_latitude, min_longitude, max_longitude).
+    :return: The points inside the box.
+    """
+    (min_latitude, max_latitude, min_longitude, max_longitude) = box
+    return db.query(models.Point).filter(models.Point.latitude.between(min_latitude, max_latitude),
+                                         models.Point.longitude.between(min_longitude, max_longitude)).all()
+
+@replica_read
+def get_nearest_points(db: Session, latitude: float, longitude: float, k: int,
+                       radius_km: Optional[float] = None) -> List[Tuple[float, models.Point]]:
+    """
+    Find the k points closest to a location, straight from the database.
+
+    With a radius the candidates are prefiltered in SQL by their bounding box; the exact haversine distance
+    is then computed for each candidate.
+
+    :param db: The database session object to use for querying.
+    :param latitude: Latitude of the location.
+    :param longitude: Longitude of the location.
+    :param k: Maximum number of points to return.
+    :param radius_km: If given, only points within this distance are returned.
+    :return: (distance_km, point) pairs, closest first.
+    """
+    if radius_km is not None:
+        candidates = get_points_in_box(db, bounding_box(latitude, longitude, radius_km))
+    else:
+        candidates = db.query(models.Point).filter(models.Point.latitude.is_not(None)).all()
+    distances = [(haversine_km(latitude, longitude, point.latitude, point.longitude), point) for point in candidates]
+    if radius_km is not None:
+        distances = [(distance, point) for (distance, point) in distances if distance <= radius_km]
+    return sorted(distances, key = lambda entry: entry[0])[:k]
+
+def load_point_catalogue(db: Session) -> CatalogueSnapshot:
+    """
+    Load every point from the database and cache it as the current catalogue snapshot.
+
+    :param db: The database session object to use for querying.
+    :return: The snapshot of the points catalogue.
+    """
+    generation = point_catalogue.generation
+    return point_catalogue.install(get_points(db), generation)
+
+@replica_read
 def get_point_id(db: Session, id: int):
     """
     :param db: A database session object of type Session.
@@ -21,6 +140,7 @@ def get_point_id(db: Session, id: int):
     """
     return db.query(models.Point).filter(models.Point.id == id).first()
 
+@replica_read
 def get_point_by_name(db: Session, name: str):
     """
     Retrieve a point from the database based on its name.
@@ -31,37 +151,194 @@ def get_point_by_name(db: Session, name: str):
     """
     return db.query(models.Point).filter(models.Point.name == name).first()
 
-def get_auth(db: Session, request: Request):
+@replica_read
+def get_points_by_keys(db: Session, names: Sequence[str] = (), ids: Sequence[int] = ()) -> List:
+    """
+    Retrieve the points with any of the given names or ids, with a single query.
+
+    :param db: The database session object to use for querying.
+    :param names: The names of the points.
+    :param ids: The ids of the points.
+    :return: The points found, as rows with the columns of `POINT_FIELDS`, in no particular order.
+    """
+    conditions = []
+    if names:
+        conditions.append(models.Point.name.in_(set(names)))
+    if ids:
+        conditions.append(models.Point.id.in_(set(ids)))
+    if not conditions:
+        return []
+    return db.execute(select(*[getattr(models.Point, field) for field in POINT_FIELDS]).where(or_(*conditions))).all()
+
+@replica_read
+def search_points(db: Session, query: str, limit: int) -> List:
+    """
+    Search the points whose name or location has words starting with the words of the query, ignoring accents
+    and case, straight from the database.
+
+    The full-text index created by `migrations.migrate_search` is used on SQLite (FTS5) and MySQL (FULLTEXT),
+    and the matches are ranked by relevance. On other databases, or when the index is missing, every point is
+    loaded and searched in memory.
+
+    :param db: The database session object to use for querying.
+    :param query: The text typed by the user.
+    :param limit: Maximum number of points to return.
+    :return: The matching points, best first.
+    """
+    words = tokenize(query)
+    if not words:
+        return []
+    columns = [getattr(models.Point, field) for field in POINT_FIELDS]
+    dialect = db.get_bind().dialect.name
+    try:
+        if dialect == "sqlite":
+            match = " ".join(f'"{word}"*' for word in words)
+            search = table(SEARCH_TABLE, column("rowid"), column("rank"))
+            return db.execute(select(*columns).join(search, search.c.rowid == models.Point.id)
+                              .where(text(f"{SEARCH_TABLE} MATCH :match")).order_by(search.c.rank)
+                              .limit(limit), {"match": match}).all()
+        if dialect in ("mysql", "mariadb"):
+            match = " ".join(f"+{word}*" for word in words)
+            relevance = text("MATCH (points.name, points.location) AGAINST (:match IN BOOLEAN MODE)")
+            return db.execute(select(*columns).where(relevance).order_by(relevance.desc()).limit(limit), {"match": match}).all()
+    except DBAPIError:
+        db.rollback()
+    return SearchIndex((point.id, point.name, point.location, point) for point in get_points(db)).search(query, limit)
+
+def get_auth(db: Session, claims: dict):
     """
+    Look up the authorization of the user in the in-memory authorization map. On a miss the map is reloaded
+    if it is stale, or else refreshed with the authorizations added since it was loaded.
+
     :param db: The database session.
-    :param request: The request object containing the user access token.
+    :param claims: The decoded claims of the user access token.
     :return: The point ID associated with the user's authorization, or None if the user has no access.
 
     """
-    decoded_token = auth.verify_access(request)
-    sub = decoded_token["sub"]
-    access = db.query(models.AuthorizationToPoint).filter(models.AuthorizationToPoint.sub == sub).first()
+    sub = claims["sub"]
+    access = authorization_map.peek(sub)
+    if access == None:
+        if authorization_map.is_stale():
+            load_authorizations(db)
+        else:
+            refresh_authorizations(db)
+        access = authorization_map.peek(sub)
     if access != None:
-        return (access.name, access.point_id)
+        return access
     return (None, None)
 
-def create_point(db: Session, new_point: schemas.PointCreate):
+def load_authorizations(db: Session) -> int:
+    """
+    Load every authorization from the database into the authorization map, replacing its content.
+
+    :param db: The database session.
+    :return: The number of authorizations loaded.
+    """
+    authorizations = db.execute(select(models.AuthorizationToPoint.id, models.AuthorizationToPoint.sub,
+                                       models.AuthorizationToPoint.name, models.AuthorizationToPoint.point_id)).all()
+    authorization_map.load(authorizations)
+    return len(authorizations)
+
+def refresh_authorizations(db: Session) -> int:
+    """
+    Add the authorizations created since the authorization map was last loaded or refreshed.
+
+    :param db: The database session.
+    :return: The number of authorizations added.
+    """
+    authorizations = db.execute(select(models.AuthorizationToPoint.id, models.AuthorizationToPoint.sub,
+                                       models.AuthorizationToPoint.name, models.AuthorizationToPoint.point_id)
+                                .where(models.AuthorizationToPoint.id > authorization_map.last_id)).all()
+    authorization_map.update(authorizations)
+    return len(authorizations)
+
+@replica_read
+def get_authorizations(db: Session):
+    """
+    :param db: The database session.
+    :return: A list of all authorizations, with their drop-off point loaded.
+    """
+    return db.query(models.AuthorizationToPoint).order_by(models.AuthorizationToPoint.id).all()
+
+@replica_read
+def get_authorization(db: Session, sub: str):
+    """
+    Retrieve the authorization of a user, with its drop-off point loaded in the same query.
+
+    :param db: The database session.
+    :param sub: The subject of the user access token.
+    :return: The authorization, or None if the user has no access.
+    """
+    return db.query(models.AuthorizationToPoint).filter(models.AuthorizationToPoint.sub == sub).first()
+
+def create_authorization(db: Session, new_authorization: schemas.AuthorizationCreate):
+    """
+    Authorize a user to access a drop-off point, and add the authorization to the authorization map.
+
+    :param db: The database session.
+    :param new_authorization: The data for the new authorization.
+    :return: The newly created authorization, or None if the point doesn't exist or the user already has one.
+    """
+    # A user with an authorization is rejected by the unique constraint on `sub`, even when the other one is concurrent
+    if get_point_id(db, new_authorization.point_id) == None:
+        return None
+    db_authorization = models.AuthorizationToPoint(sub = new_authorization.sub,
+                                                   name = new_authorization.name,
+                                                   point_id = new_authorization.point_id)
+    db.add(db_authorization)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+    db.refresh(db_authorization)
+    authorization_map.update([db_authorization])
+    return db_authorization
+
+def delete_authorization(db: Session, sub: str):
+    """
+    Revoke the authorization of a user, and remove it from the authorization map. The change is published on
+    the authorization bus, so the other replicas drop their maps instead of waiting for the TTL.
+
+    :param db: The database session.
+    :param sub: The subject of the user access token.
+    :return: "OK" if successful or None if the user had no authorization.
+    """
+    deleted = db.execute(delete(models.AuthorizationToPoint).where(models.AuthorizationToPoint.sub == sub)).rowcount
+    db.commit()
+    authorization_map.remove(sub)
+    if not deleted:
+        return None
+    publish_change(db, authorization_bus)
+    return "OK"
+
+def create_point(db: Session, new_point: schemas.PointCreate) -> Optional[schemas.Point]:
     """
     Create Point
 
-    Inserts a new point into the database.
+    Inserts a new point into the database with a single INSERT statement. The unique constraints on the name and
+    the coordinates decide conflicts, so concurrent creates can't both succeed. The id is read with RETURNING when
+    the dialect supports it, or else from the cursor, so no SELECT follows the insert.
 
     :param db: The database session.
     :param new_point: The data for the new point.
-    :return: The newly created point.
+    :return: The newly created point, or None if its name or coordinates are already registered.
     """
-    db_point = models.Point(name = new_point.name,
-                            location = new_point.location, 
-                            coordinates = new_point.coordinates, 
-                            image = new_point.image)
-    db.add(db_point)
-    db.commit()
-    db.refresh(db_point)
+    (latitude, longitude) = parse_coordinates(new_point.coordinates) or (None, None)
+    try:
+        statement = insert(models.Point).values(**new_point.model_dump(), latitude = latitude, longitude = longitude,
+                                                version = next_version(db), updated_at = utcnow())
+        if db.get_bind().dialect.insert_returning:
+            row = db.execute(statement.returning(*[getattr(models.Point, field) for field in POINT_FIELDS])).one()
+            db_point = schemas.Point.model_validate(row._asdict())
+        else:
+            result = db.execute(statement)
+            db_point = schemas.Point(id = result.inserted_primary_key[0], **new_point.model_dump())
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+    publish_change(db)
     return db_point
 
 def delete_point(db: Session, name: str):
@@ -78,6 +355,181 @@ def delete_point(db: Session, name: str):
     db_point = get_point_by_name(db, name)
     if db_point == None:
         return None
+    db.add(models.PointTombstone(point_id = db_point.id, name = db_point.name, version = next_version(db), deleted_at = utcnow()))
     db.delete(db_point)
     db.commit()
+    publish_change(db)
     return "OK"
+
+
+def bulk_create_points(db: Session, new_points: List[schemas.PointCreate]) -> Optional[List[dict]]:
+    """
+    Insert many points in a single transaction.
+
+    Conflicts with stored points are found with one `IN` query, conflicts inside the batch are found in memory,
+    and the remaining points are inserted with a single executemany statement.
+
+    :param db: The database session.
+    :param new_points: The data for the new points.
+    :return: One result per new point, in order: its name, its status ("created" or "conflict") and, when created,
+        its id. None if a concurrent write made the transaction fail, in which case nothing was inserted.
+    """
+    names = [new_point.name for new_point in new_points]
+    coordinates = [new_point.coordinates for new_point in new_points]
+    stored = db.execute(select(models.Point.name, models.Point.coordinates)
+                        .where(or_(models.Point.name.in_(names), models.Point.coordinates.in_(coordinates)))).all()
+    taken_names = {name for (name, _) in stored}
+    taken_coordinates = {point_coordinates for (_, point_coordinates) in stored}
+    
+    results = []
+    rows = []
+    for new_point in new_points:
+        if new_point.name in taken_names or new_point.coordinates in taken_coordinates:
+            results.append({"name": new_point.name, "status": "conflict"})
+            continue
+        taken_names.add(new_point.name)
+        taken_coordinates.add(new_point.coordinates)
+        (latitude, longitude) = parse_coordinates(new_point.coordinates) or (None, None)
+        rows.append({**new_point.model_dump(), "latitude": latitude, "longitude": longitude})
+        results.append({"name": new_point.name, "status": "created"})
+    if not rows:
+        return results
+    
+    try:
+        (version, updated_at) = (next_version(db), utcnow())
+        db.execute(insert(models.Point), [{**row, "version": version, "updated_at": updated_at} for row in rows])
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+    publish_change(db)
+    
+    ids = dict(db.execute(select(models.Point.name, models.Point.id)
+                          .where(models.Point.name.in_([row["name"] for row in rows]))).all())
+    for result in results:
+        if result["status"] == "created":
+            result["id"] = ids.get(result["name"])
+    return results
+
+def bulk_delete_points(db: Session, names: List[str]) -> List[dict]:
+    """
+    Delete many points, by name, in a single transaction.
+
+    :param db: The database session.
+    :param names: The names of the points to delete.
+    :return: One result per name, in order: the name and its status ("deleted" or "not_found").
+    """
+    stored = dict(db.execute(select(models.Point.name, models.Point.id).where(models.Point.name.in_(names))).all())
+    if stored:
+        (version, deleted_at) = (next_version(db), utcnow())
+        db.execute(insert(models.PointTombstone), [{"point_id": point_id, "name": name, "version": version, "deleted_at": deleted_at}
+                                                   for (name, point_id) in stored.items()])
+        db.execute(delete(models.Point).where(models.Point.name.in_(stored)))
+        db.commit()
+        publish_change(db)
+    return [{"name": name, "status": "deleted" if name in stored else "not_found"} for name in names]
+
+def utcnow() -> datetime:
+    """
+    :return: The current UTC time, without time zone, as stored in the DateTime columns.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo = None)
+
+def next_version(db: Session) -> int:
+    """
+    Take the next sync version, in the transaction of a write. The counter row stays locked until the transaction
+    ends, so concurrent writers get their versions in commit order. A rolled back write gives its version back.
+
+    The counter row is created by `migrations.migrate_sync`. In a database without it, the first writers race to
+    create it; the losers roll back to a savepoint and increment the row of the winner instead of failing.
+
+    :param db: The database session of the write.
+    :return: The version of the write, also kept in `info["pending_version"]` until the transaction ends.
+    """
+    state = models.SyncState
+    increment = update(state).where(state.id == 1).values(version = state.version + 1)
+    if not db.execute(increment).rowcount:
+        try:
+            with db.begin_nested():
+                db.execute(insert(state).values(id = 1, version = 1, compacted_version = 0))
+        except IntegrityError:
+            db.execute(increment)
+    version = db.info["pending_version"] = db.execute(select(state.version).where(state.id == 1)).scalar_one()
+    return version
+
+def publish_change(db: Session, bus: Optional[InvalidationBus] = None):
+    """
+    Announce a committed change on an invalidation bus.
+
+    The sessions of an AsyncSession run on the event loop, where publishing to Redis would block it, so there the
+    publication is appended to `info["deferred"]`, and `run_crud` makes it in the threadpool once the function returned.
+
+    :param db: The database session which committed the change.
+    :param bus: The bus of the changed data. Defaults to the bus of the points catalogue.
+    :return: None
+    """
+    bus = bus or invalidation_bus
+    deferred = db.info.get("deferred")
+    if deferred is None:
+        bus.publish()
+    else:
+        deferred.append(bus.publish)
+
+def get_sync_state(db: Session) -> Tuple[int, int]:
+    """
+    :param db: The database session.
+    :return: The version of the latest write and the version below which tombstones were compacted.
+    """
+    row = db.execute(select(models.SyncState.version, models.SyncState.compacted_version)
+                     .where(models.SyncState.id == 1)).first()
+    return (row.version, row.compacted_version) if row is not None else (0, 0)
+
+def get_changes(db: Session, since: int, delta: bool = False) -> Optional[dict]:
+    """
+    Retrieve the points created or changed, and the points deleted, after a sync version.
+
+    Both queries use the index on the version columns, so their cost follows the number of changes rather than
+    the number of points. The current version is read first: a write committed meanwhile is sent again on the
+    next sync rather than missed. Clients should apply the deletions, then the points.
+
+    :param db: The database session.
+    :param since: The version the client is at, or 0 for a full sync, which returns every point and no deletion.
+    :param delta: Return only the changes after `since` even when it is 0, e.g. to publish the first changes of a
+        new database.
+    :return: The current version, the changed points and the deleted points (id and name). None if the client
+        must sync fully again, because tombstones it needs were compacted or it is ahead of the database.
+    """
+    (version, compacted_version) = get_sync_state(db)
+    if since > version or 0 < since < compacted_version:
+        return None
+    columns = [getattr(models.Point, field) for field in POINT_FIELDS]
+    if since == 0 and not delta:
+        points = db.execute(select(*columns).order_by(models.Point.id)).all()
+        deleted = []
+    else:
+        points = db.execute(select(*columns).where(models.Point.version > since)
+                            .order_by(models.Point.version, models.Point.id)).all()
+        deleted = db.execute(select(models.PointTombstone.point_id.label("id"), models.PointTombstone.name)
+                             .where(models.PointTombstone.version > since)
+                             .order_by(models.PointTombstone.version, models.PointTombstone.id)).all()
+    return {"version": version, "points": [row._asdict() for row in points], "deleted": [row._asdict() for row in deleted]}
+
+def compact_tombstones(db: Session, horizon: float = SYNC_TOMBSTONE_HORIZON) -> int:
+    """
+    Remove the tombstones older than the horizon. Clients which last synced before the newest removed tombstone
+    are then told to sync fully again.
+
+    :param db: The database session.
+    :param horizon: Seconds tombstones are kept for.
+    :return: The number of tombstones removed.
+    """
+    cutoff = utcnow() - timedelta(seconds = horizon)
+    floor = db.execute(select(func.max(models.PointTombstone.version))
+                       .where(models.PointTombstone.deleted_at < cutoff)).scalar()
+    if floor is None:
+        return 0
+    db.execute(update(models.SyncState).where(models.SyncState.id == 1, models.SyncState.compacted_version < floor)
+               .values(compacted_version = floor))
+    removed = db.execute(delete(models.PointTombstone).where(models.PointTombstone.version <= floor)).rowcount
+    db.commit()
+    return removed
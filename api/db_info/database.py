@@ -1,13 +1,183 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from typing import Callable
+from sqlalchemy import Select, create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.pool import StaticPool
+
+from .metrics import instrument_engine
+from . import profiling
+from .pool import InstrumentedAsyncQueuePool, InstrumentedQueuePool, instrument, pool_status
+from .replicas import DATABASE_REPLICA_URLS, Replica, ReplicaRouter
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///:memory:")
 
+# When enabled the endpoints run on an AsyncEngine instead of the Starlette threadpool
+ASYNC_MODE = os.getenv("DATABASE_ASYNC", "false").lower() in ("1", "true", "yes")
+
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "mysql": "aiomysql",
+}
+
+def to_async_url(url: str) -> str:
+    """
+    Translate a database URL into the equivalent URL using an asyncio driver.
+
+    :param url: The database URL, e.g. `mysql+mysqlconnector://...`.
+    :return: The same URL using the asyncio driver of its backend, e.g. `mysql+aiomysql://...`.
+    """
+    parsed_url = make_url(url)
+    backend = parsed_url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        return url
+    return parsed_url.set(drivername = f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(hide_password = False)
+
+def engine_options(url: str, asynchronous: bool = False) -> dict:
+    """
+    Build the pool options of an engine from the environment.
+
+    In-memory SQLite databases live inside a single connection, so they use a StaticPool shared by every
+    thread. Other databases use a queue pool configured by the `DB_POOL_*` variables.
+
+    :param url: The database URL.
+    :param asynchronous: Whether the options are for an AsyncEngine.
+    :return: Keyword arguments for `create_engine`/`create_async_engine`.
+    """
+    parsed_url = make_url(url)
+    if parsed_url.get_backend_name() == "sqlite":
+        options = {"connect_args": {"check_same_thread": False}}
+        if parsed_url.database in (None, "", ":memory:"):
+            options["poolclass"] = StaticPool
+        return options
+    return {
+        "poolclass": InstrumentedAsyncQueuePool if asynchronous else InstrumentedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+        "pool_use_lifo": os.getenv("DB_POOL_USE_LIFO", "false").lower() in ("1", "true", "yes"),
+    }
+
+def replica_read(function: Callable) -> Callable:
+    """
+    Mark a `crud` function as a read which tolerates the lag of a read replica, so that `run_crud` may send it to
+    one. Functions filling the caches or the sync responses stay on the primary, whose data they must reflect.
+
+    :param function: The `crud` function.
+    :return: The same function.
+    """
+    function.replica_read = True
+    return function
+
+class RoutingSession(Session):
+    """
+    Session sending the SELECT statements of a `replica_read` function to the replica `run_crud` chose for it,
+    stored in `info["replica"]`, and every other statement to the primary.
+
+    Writes made by a session whose `info["client"]` is set make that client sticky, so that its next reads go
+    to the primary and see the write. The sync version a write took, stored in `info["pending_version"]`, becomes
+    `info["sync_version"]` once the write is committed.
+    """
+
+    def commit(self):
+        super().commit()
+        version = self.info.pop("pending_version", None)
+        if version is not None:
+            self.info["sync_version"] = max(version, self.info.get("sync_version", 0))
+
+    def rollback(self):
+        self.info.pop("pending_version", None)
+        super().rollback()
+
+    def get_bind(self, mapper = None, *, clause = None, **kwargs):
+        replica = self.info.get("replica")
+        if replica is not None and isinstance(clause, Select) and not self._flushing:
+            return replica.async_engine.sync_engine if replica.async_engine is not None else replica.engine
+        if self.info.get("client") is not None and (self._flushing or getattr(clause, "is_dml", False)):
+            replica_router.stick(self.info["client"])
+        return super().get_bind(mapper, clause = clause, **kwargs)
+
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
+    **engine_options(SQLALCHEMY_DATABASE_URL),
 )
-SessionLocal = sessionmaker(autocommit = False, autoflush = False, bind = engine)
+pool_stats = instrument(engine.pool)
+instrument_engine(engine)
+profiling.instrument_engine(engine)
+SessionLocal = sessionmaker(class_ = RoutingSession, autocommit = False, autoflush = False, bind = engine)
 
-Base = declarative_base()
+async_engine = None
+async_pool_stats = None
+AsyncSessionLocal = None
+if ASYNC_MODE:
+    async_engine = create_async_engine(to_async_url(SQLALCHEMY_DATABASE_URL),
+                                       **engine_options(SQLALCHEMY_DATABASE_URL, asynchronous = True))
+    async_pool_stats = instrument(async_engine.sync_engine.pool)
+    instrument_engine(async_engine.sync_engine)
+    profiling.instrument_engine(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(autocommit = False, autoflush = False, expire_on_commit = False, bind = async_engine,
+                                           sync_session_class = RoutingSession)
+
+def create_replica(url: str) -> Replica:
+    """
+    Create the engines of a read replica, with the same pool options as the primary.
+
+    :param url: The URL of the replica.
+    :return: The replica.
+    """
+    replica_engine = create_engine(url, **engine_options(url))
+    instrument_engine(replica_engine)
+    profiling.instrument_engine(replica_engine)
+    replica_async_engine = None
+    if ASYNC_MODE:
+        replica_async_engine = create_async_engine(to_async_url(url), **engine_options(url, asynchronous = True))
+        instrument_engine(replica_async_engine.sync_engine)
+        profiling.instrument_engine(replica_async_engine.sync_engine)
+    return Replica(url, replica_engine, replica_async_engine)
+
+replica_router = ReplicaRouter([create_replica(url) for url in DATABASE_REPLICA_URLS], engine)
+
+def pool_capacity(pool) -> int:
+    """
+    :param pool: The pool of an engine.
+    :return: The number of connections the pool keeps open: its `pool_size`, or 1 for pools without one.
+    """
+    return pool.size() if hasattr(pool, "size") else 1
+
+def warm_up_pool() -> int:
+    """
+    Open as many connections as the pool keeps, all at once, and return them to the pool, so that the
+    first requests don't pay for connecting.
 
+    :return: The number of connections opened.
+    """
+    connections = [engine.connect() for _ in range(pool_capacity(engine.pool))]
+    for connection in connections:
+        connection.close()
+    return len(connections)
+
+async def async_warm_up_pool() -> int:
+    """
+    Same as :func:`warm_up_pool`, for the async engine.
+
+    :return: The number of connections opened.
+    """
+    connections = [await async_engine.connect() for _ in range(pool_capacity(async_engine.sync_engine.pool))]
+    for connection in connections:
+        await connection.close()
+    return len(connections)
+
+def get_pool_status() -> dict:
+    """
+    Describe the pool of the engine serving the requests.
+
+    :return: The pool gauges and counters.
+    """
+    if ASYNC_MODE:
+        return pool_status(async_engine.sync_engine.pool, async_pool_stats)
+    return pool_status(engine.pool, pool_stats)
+
+Base = declarative_base()
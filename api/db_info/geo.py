@@ -0,0 +1,162 @@
+import heapq
+import math
+from collections import defaultdict
+from typing import Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+EARTH_RADIUS_KM = 6371.0088
+
+T = TypeVar("T")
+
+def parse_coordinates(coordinates: Optional[str]) -> Optional[Tuple[float, float]]:
+    """
+    Parse free-form coordinates such as "40.63, -8.65" or "40.63 -8.65".
+
+    :param coordinates: The coordinates string, latitude first.
+    :return: The (latitude, longitude) pair, or None if the string isn't a valid pair of coordinates.
+    """
+    if not coordinates:
+        return None
+    parts = coordinates.replace(",", " ").split()
+    if len(parts) != 2:
+        return None
+    try:
+        (latitude, longitude) = (float(parts[0]), float(parts[1]))
+    except ValueError:
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return (latitude, longitude)
+
+def haversine_km(latitude: float, longitude: float, other_latitude: float, other_longitude: float) -> float:
+    """
+    :return: The great-circle distance between two points, in kilometres.
+    """
+    (phi, other_phi) = (math.radians(latitude), math.radians(other_latitude))
+    delta_phi = other_phi - phi
+    delta_lambda = math.radians(other_longitude - longitude)
+    a = math.sin(delta_phi / 2) ** 2 + math.cos(phi) * math.cos(other_phi) * math.sin(delta_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def bounding_box(latitude: float, longitude: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """
+    Compute a box containing every point within the radius, to prefilter candidates with plain comparisons.
+
+    :return: (min_latitude, max_latitude, min_longitude, max_longitude). The longitude range is the whole
+        [-180, 180] when the circle reaches a pole or crosses the antimeridian.
+    """
+    delta_latitude = math.degrees(radius_km / EARTH_RADIUS_KM)
+    (min_latitude, max_latitude) = (latitude - delta_latitude, latitude + delta_latitude)
+    if min_latitude <= -90 or max_latitude >= 90:
+        return (max(min_latitude, -90.0), min(max_latitude, 90.0), -180.0, 180.0)
+    delta_longitude = math.degrees(math.asin(min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(latitude)))))
+    (min_longitude, max_longitude) = (longitude - delta_longitude, longitude + delta_longitude)
+    if min_longitude < -180 or max_longitude > 180:
+        return (min_latitude, max_latitude, -180.0, 180.0)
+    return (min_latitude, max_latitude, min_longitude, max_longitude)
+
+class GridIndex(Generic[T]):
+    """
+    In-memory spatial index answering exact haversine k-nearest-neighbour queries.
+
+    Items are bucketed in a regular latitude/longitude grid. A query scans rings of cells around the query point
+    and stops as soon as no unscanned cell can hold a closer item, so it only looks at the neighbourhood of the
+    query. The grid does not wrap around the antimeridian.
+
+    :param entries: (latitude, longitude, item) triples.
+    :param cell_size: Size of the cells in degrees. Defaults to a size holding a few items per cell.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[float, float, T]], cell_size: Optional[float] = None):
+        self.entries = list(entries)
+        self.cell_size = cell_size or self._default_cell_size()
+        self.cells: Dict[Tuple[int, int], List[Tuple[float, float, T]]] = defaultdict(list)
+        for entry in self.entries:
+            self.cells[self._cell(entry[0], entry[1])].append(entry)
+        if self.cells:
+            rows = [row for (row, _) in self.cells]
+            columns = [column for (_, column) in self.cells]
+            self.extent = (min(rows), max(rows), min(columns), max(columns))
+
+    def _default_cell_size(self, per_cell: int = 4) -> float:
+        if len(self.entries) < 2:
+            return 1.0
+        latitudes = [entry[0] for entry in self.entries]
+        longitudes = [entry[1] for entry in self.entries]
+        area = max(max(latitudes) - min(latitudes), 1e-4) * max(max(longitudes) - min(longitudes), 1e-4)
+        return max(math.sqrt(area * per_cell / len(self.entries)), 1e-4)
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return (math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _bound_km(self, latitude: float, longitude: float, row: int, column: int, ring: int) -> float:
+        # Lower bound of the distance to any item outside the rings already scanned
+        size = self.cell_size
+        gap_latitude = min(latitude - (row - ring) * size, (row + ring + 1) * size - latitude)
+        gap_longitude = min(longitude - (column - ring) * size, (column + ring + 1) * size - longitude)
+        bound_latitude = math.radians(gap_latitude) * EARTH_RADIUS_KM
+        if gap_longitude >= 90:
+            return bound_latitude
+        bound_longitude = math.asin(min(1.0, math.sin(math.radians(gap_longitude)) * math.cos(math.radians(latitude)))) * EARTH_RADIUS_KM
+        return min(bound_latitude, bound_longitude)
+
+    def nearest(self, latitude: float, longitude: float, k: int = 1,
+                radius_km: Optional[float] = None) -> List[Tuple[float, T]]:
+        """
+        Find the k items closest to a point.
+
+        :param latitude: Latitude of the query point.
+        :param longitude: Longitude of the query point.
+        :param k: Maximum number of items to return.
+        :param radius_km: If given, only items within this distance are returned.
+        :return: (distance_km, item) pairs, closest first.
+        """
+        if not self.cells or k <= 0:
+            return []
+        (row, column) = self._cell(latitude, longitude)
+        (min_row, max_row, min_column, max_column) = self.extent
+        last_ring = max(row - min_row, max_row - row, column - min_column, max_column - column)
+        best: List[Tuple[float, int, T]] = []
+        ring = 0
+        while ring <= last_ring:
+            if 8 * ring > len(self.cells):
+                return self._scan(latitude, longitude, k, radius_km)
+            for cell in self._ring(row, column, ring):
+                for (item_latitude, item_longitude, item) in self.cells.get(cell, ()):
+                    distance = haversine_km(latitude, longitude, item_latitude, item_longitude)
+                    if radius_km is not None and distance > radius_km:
+                        continue
+                    candidate = (-distance, id(item), item)
+                    if len(best) < k:
+                        heapq.heappush(best, candidate)
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, candidate)
+            bound = self._bound_km(latitude, longitude, row, column, ring)
+            if radius_km is not None and bound > radius_km:
+                break
+            if len(best) == k and -best[0][0] <= bound:
+                break
+            ring += 1
+        return [(-distance, item) for (distance, _, item) in sorted(best, reverse = True)]
+
+    def _scan(self, latitude: float, longitude: float, k: int, radius_km: Optional[float]) -> List[Tuple[float, T]]:
+        # Used when the query is so far from the items that scanning every item is cheaper than the rings
+        distances = ((haversine_km(latitude, longitude, item_latitude, item_longitude), index)
+                     for (index, (item_latitude, item_longitude, _)) in enumerate(self.entries))
+        if radius_km is not None:
+            distances = (entry for entry in distances if entry[0] <= radius_km)
+        return [(distance, self.entries[index][2]) for (distance, index) in heapq.nsmallest(k, distances)]
+
+    @staticmethod
+    def _ring(row: int, column: int, ring: int):
+        if ring == 0:
+            yield (row, column)
+            return
+        for delta in range(-ring, ring + 1):
+            yield (row - ring, column + delta)
+            yield (row + ring, column + delta)
+        for delta in range(-ring + 1, ring):
+            yield (row + delta, column - ring)
+            yield (row + delta, column + ring)
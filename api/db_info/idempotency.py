@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+class IdempotencyConflict(Exception):
+    """
+    Raised when an idempotency key is reused while its first request is still running, or with another payload.
+
+    Attributes:
+        in_flight (bool): True if the first request is still running, False if the payloads differ.
+    """
+
+    def __init__(self, in_flight: bool):
+        super().__init__("request in flight" if in_flight else "payload mismatch")
+        self.in_flight = in_flight
+
+class IdempotencyStore:
+    """
+    Bounded LRU store of the responses of writes sent with an Idempotency-Key header.
+
+    A retried write with the same key and payload is answered with the stored response instead of running again,
+    so a client which lost the response of a create can safely send it again. Entries expire after `ttl` seconds.
+    The store lives in the process, so retries are only recognised by the replica which served the first request.
+
+    :param maxsize: Maximum number of keys remembered. A `maxsize` of 0 disables the store.
+    :param ttl: Seconds a key is remembered for.
+    """
+
+    def __init__(self,
+                 maxsize: int = int(os.getenv("IDEMPOTENCY_STORE_SIZE", "1024")),
+                 ttl: float = float(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.replays = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(payload: Any) -> str:
+        """
+        :param payload: The JSON-serializable payload of the write.
+        :return: A digest identifying the payload.
+        """
+        return hashlib.sha256(json.dumps(payload, sort_keys = True, default = str).encode()).hexdigest()
+
+    def begin(self, key: str, fingerprint: str) -> Optional[Tuple[int, Any]]:
+        """
+        Claim a key before running a write.
+
+        :param key: The idempotency key, scoped to the client and the endpoint.
+        :param fingerprint: The fingerprint of the payload.
+        :raises IdempotencyConflict: If the key is in use by a running request or was used with another payload.
+        :return: The stored (status_code, body) to replay, or None if the write must run. In that case it must be
+            followed by :meth:`complete` or :meth:`release`.
+        """
+        if self.maxsize <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._entries[key] = (now + self.ttl, fingerprint, None)
+                self._evict()
+                return None
+            (_, stored_fingerprint, response) = entry
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyConflict(in_flight = False)
+            if response is None:
+                raise IdempotencyConflict(in_flight = True)
+            self._entries.move_to_end(key)
+            self.replays += 1
+            return response
+
+    def complete(self, key: str, fingerprint: str, status_code: int, body: Any):
+        """
+        Store the response of a write claimed with :meth:`begin`.
+
+        :param key: The idempotency key.
+        :param fingerprint: The fingerprint of the payload.
+        :param status_code: The status code of the response.
+        :param body: The JSON-serializable body of the response.
+        :return: None
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, fingerprint, (status_code, body))
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def release(self, key: str):
+        """
+        Forget a key claimed with :meth:`begin` whose write failed unexpectedly, so that it can be retried.
+
+        :param key: The idempotency key.
+        :return: None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is None:
+                del self._entries[key]
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last = False)
+
+    def clear(self):
+        """
+        Forget every key.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self.replays = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+idempotency_store = IdempotencyStore()
@@ -1,6 +1,45 @@
+from sqlalchemy import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlalchemy.orm import Session
+from sqlalchemy.util import greenlet_spawn
 
-from db_info import models
+from db_info import crud, database, migrations, models
+
+def create_schema(engine: Engine) -> int:
+    """
+    Create the missing tables and migrate the existing ones.
+
+    :param engine: The engine of the database.
+    :return: The number of points whose coordinates were migrated.
+    """
+    database.Base.metadata.create_all(bind = engine)
+    # The sync columns come first, so that migrate_coordinates also creates their index
+    migrations.migrate_sync(engine)
+    migrated = migrations.migrate_coordinates(engine)
+    migrations.migrate_search(engine)
+    return migrated
+
+async def create_async_schema(async_engine: AsyncEngine) -> int:
+    """
+    Create the missing tables and migrate the existing ones through an async engine, for databases the sync
+    engine doesn't reach, e.g. `sqlite:///:memory:`, which is a different database for each engine.
+
+    :param async_engine: The async engine of the database.
+    :return: The number of points whose coordinates were migrated.
+    """
+    return await greenlet_spawn(create_schema, async_engine.sync_engine)
+
+def seed(db: Session) -> bool:
+    """
+    Initialize the database with the initial items, unless it already has points.
+
+    :param db: The database session object.
+    :return: True if the initial items were added.
+    """
+    if crud.has_points(db):
+        return False
+    init(db)
+    return True
 
 def init(db: Session):
     """
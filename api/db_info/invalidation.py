@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from typing import Callable, List, Optional
+
+class InvalidationBus(ABC):
+    """
+    Propagates changes of the points catalogue, or of another shared dataset such as the authorizations, to every
+    replica of the service. Each dataset has a bus of its own, so its changes don't invalidate the others.
+
+    Writers call :meth:`publish` after committing. Every subscriber, in this process and in the other replicas,
+    is then called with the new catalogue version. Versions only move forward, so replicas and clients can tell
+    whether they are current by comparing them.
+    """
+
+    def __init__(self):
+        self._subscribers: List[Callable[[int], None]] = []
+
+    def subscribe(self, callback: Callable[[int], None]):
+        """
+        Register a callback called with the new catalogue version after every change.
+
+        :param callback: The callback.
+        :return: None
+        """
+        self._subscribers.append(callback)
+
+    def notify(self, version: int):
+        """
+        Call every subscriber with the given catalogue version.
+
+        :param version: The new catalogue version.
+        :return: None
+        """
+        for callback in self._subscribers:
+            callback(version)
+
+    @abstractmethod
+    def publish(self) -> int:
+        """
+        Announce a change of the catalogue.
+
+        :return: The new catalogue version.
+        """
+
+    @abstractmethod
+    def current_version(self) -> int:
+        """
+        :return: The latest catalogue version.
+        """
+
+    def start(self):
+        """
+        Start listening for changes made by other replicas.
+
+        :return: None
+        """
+
+    def stop(self):
+        """
+        Stop listening for changes made by other replicas.
+
+        :return: None
+        """
+
+class InMemoryInvalidationBus(InvalidationBus):
+    """
+    Invalidation bus for a single process. The catalogue version is a local counter.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def publish(self) -> int:
+        with self._lock:
+            self._version += 1
+            version = self._version
+        self.notify(version)
+        return version
+
+    def current_version(self) -> int:
+        return self._version
+
+class RedisInvalidationBus(InvalidationBus):
+    """
+    Invalidation bus shared by every replica through Redis.
+
+    The catalogue version is a Redis counter incremented on every change, and changes are announced on a
+    pub/sub channel. The listener also polls the counter every `poll_interval` seconds, so a replica which
+    missed a message (e.g. while reconnecting) still catches up within that delay.
+
+    :param url: The Redis URL. Ignored if `client` is given.
+    :param client: An existing Redis client, e.g. a `fakeredis.FakeRedis` in tests.
+    :param channel: The pub/sub channel the changes are announced on.
+    :param version_key: The key of the catalogue version counter.
+    :param poll_interval: Maximum seconds before a missed change is noticed.
+    """
+
+    def __init__(self,
+                 url: Optional[str] = None,
+                 client = None,
+                 channel: str = "points:invalidations",
+                 version_key: str = "points:version",
+                 poll_interval: float = float(os.getenv("INVALIDATION_POLL_INTERVAL", "5"))):
+        super().__init__()
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.channel = channel
+        self.version_key = version_key
+        self.poll_interval = poll_interval
+        self.origin = uuid.uuid4().hex
+        self.seen_version = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def publish(self) -> int:
+        version = int(self.client.incr(self.version_key))
+        self.client.publish(self.channel, json.dumps({"version": version, "origin": self.origin}))
+        self._advance(version)
+        return version
+
+    def current_version(self) -> int:
+        return int(self.client.get(self.version_key) or 0)
+
+    def _advance(self, version: int):
+        with self._lock:
+            if version <= self.seen_version:
+                return
+            self.seen_version = version
+        self.notify(version)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        pubsub = self.client.pubsub(ignore_subscribe_messages = True)
+        pubsub.subscribe(self.channel)
+        self._thread = threading.Thread(target = self._listen, args = (pubsub,),
+                                        name = "points-invalidation", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout = self.poll_interval + 1)
+            self._thread = None
+
+    def _listen(self, pubsub):
+        try:
+            while not self._stop.is_set():
+                try:
+                    message = pubsub.get_message(timeout = self.poll_interval)
+                    if message is not None and message["type"] == "message":
+                        payload = json.loads(message["data"])
+                        if payload["origin"] != self.origin:
+                            self._advance(int(payload["version"]))
+                    else:
+                        self._advance(self.current_version())
+                except Exception:
+                    self._stop.wait(self.poll_interval)
+        finally:
+            pubsub.close()
+
+def create_invalidation_bus(channel: str = "points:invalidations", version_key: str = "points:version") -> InvalidationBus:
+    """
+    Create the invalidation bus selected by the `INVALIDATION_BACKEND` variable (`memory` or `redis`).
+
+    :param channel: The pub/sub channel of the Redis bus.
+    :param version_key: The key of the version counter of the Redis bus.
+    :return: The invalidation bus.
+    """
+    if os.getenv("INVALIDATION_BACKEND", "memory").lower() == "redis":
+        return RedisInvalidationBus(url = os.getenv("REDIS_URL", "redis://localhost:6379/0"), channel = channel,
+                                    version_key = version_key)
+    return InMemoryInvalidationBus()
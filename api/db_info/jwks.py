@@ -0,0 +1,248 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+import requests
+
+from .metrics import jwks_fetch_duration
+
+def fetch_jwks(url: str, timeout: float) -> list:
+    """
+    Download the JSON Web Key Set published at the given URL.
+
+    :param url: The URL of the JWKS document.
+    :param timeout: Timeout, in seconds, for the HTTP request.
+    :return: The list of keys in the document.
+    :raises Exception: If the request fails or the document is malformed.
+    """
+    response = requests.get(url, timeout = timeout)
+    response.raise_for_status()
+    return response.json()["keys"]
+
+async def afetch_jwks(url: str, timeout: float) -> list:
+    """
+    Download the JSON Web Key Set published at the given URL without blocking the event loop.
+
+    :param url: The URL of the JWKS document.
+    :param timeout: Timeout, in seconds, for the HTTP request.
+    :return: The list of keys in the document.
+    :raises Exception: If the request fails or the document is malformed.
+    """
+    async with httpx.AsyncClient(timeout = timeout) as client:
+        response = await client.get(url)
+    response.raise_for_status()
+    return response.json()["keys"]
+
+class JWKSKeyStore:
+    """
+    Process-wide cache of the issuer signing keys, indexed by their `kid`.
+
+    Keys are kept for `ttl` seconds and re-fetched once they expire. A token signed with an unknown `kid`
+    forces a refresh, but at most once every `min_refresh_interval` seconds, so a flood of forged tokens
+    cannot turn into a flood of requests to the issuer. If the issuer can't be reached the last known keys
+    keep being served, and it is retried at the same pace.
+
+    :param jwks_url: The JWKS URL. Defaults to `{COGNITO_ISSUER}/.well-known/jwks.json`.
+    :param ttl: Seconds after which the cached keys are considered stale.
+    :param min_refresh_interval: Minimum seconds between two forced refreshes.
+    :param timeout: Timeout, in seconds, for each fetch.
+    :param fetcher: Callable `(url, timeout) -> keys` used to download the key set.
+    :param async_fetcher: Coroutine function `(url, timeout) -> keys` used by :meth:`aget_key`.
+    """
+
+    def __init__(self,
+                 jwks_url: Optional[str] = None,
+                 ttl: float = float(os.getenv("JWKS_CACHE_TTL", "3600")),
+                 min_refresh_interval: float = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30")),
+                 timeout: float = float(os.getenv("JWKS_FETCH_TIMEOUT", "5")),
+                 fetcher: Callable[[str, float], list] = fetch_jwks,
+                 async_fetcher: Callable[[str, float], Awaitable[list]] = afetch_jwks):
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetcher = fetcher
+        self.async_fetcher = async_fetcher
+        self.keys: Dict[str, dict] = {}
+        self.fetched_at: Optional[float] = None
+        self.last_attempt_at: Optional[float] = None
+        self.last_forced_at: Optional[float] = None
+        self.fetch_count = 0
+        self._lock = threading.Lock()
+        self._fetching = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._async_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def url(self) -> str:
+        """
+        :return: The URL the key set is fetched from.
+        """
+        if self.jwks_url:
+            return self.jwks_url
+        return f"{os.getenv('COGNITO_ISSUER')}/.well-known/jwks.json"
+
+    def is_stale(self) -> bool:
+        """
+        :return: True if the keys were never fetched or are older than the TTL.
+        """
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.ttl
+
+    def refresh(self) -> Dict[str, dict]:
+        """
+        Fetch the key set from the issuer and replace the cached keys.
+
+        The fetch happens outside the lock, so requests keep being served from the current keys meanwhile; only
+        the swap of the keys is made under it.
+
+        :return: The cached keys, indexed by `kid`.
+        :raises Exception: If the key set could not be fetched.
+        """
+        self.last_attempt_at = time.monotonic()
+        self.fetch_count += 1
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            keys = self.fetcher(self.url, self.timeout)
+            outcome = "ok"
+        finally:
+            jwks_fetch_duration.labels(outcome).observe(time.perf_counter() - start)
+        return self._store(keys)
+
+    def _store(self, keys: list) -> Dict[str, dict]:
+        keys = {key["kid"]: key for key in keys}
+        with self._lock:
+            self.keys = keys
+            self.fetched_at = time.monotonic()
+            return keys
+
+    def _needs_refresh(self, kid: Optional[str]) -> bool:
+        return ((self.is_stale() and (not self.keys or self._elapsed(self.last_attempt_at)))
+                or (kid not in self.keys and self._elapsed(self.last_forced_at)))
+
+    def get_key(self, kid: Optional[str]) -> Optional[dict]:
+        """
+        Get the signing key with the given `kid`, refreshing the key set when needed.
+
+        A single thread fetches the key set at a time. Threads needing a key which is already cached don't wait
+        for it and are served the current keys, so a slow issuer only delays the tokens signed with unknown keys.
+
+        :param kid: The key identifier found in the token header.
+        :return: The matching JWK, or None if the issuer does not publish such key.
+        :raises Exception: If there are no cached keys and the key set could not be fetched.
+        """
+        if not self._needs_refresh(kid) or not self._fetching.acquire(blocking = kid not in self.keys):
+            return self.keys.get(kid)
+        try:
+            if self.is_stale() and (not self.keys or self._elapsed(self.last_attempt_at)):
+                try:
+                    self.refresh()
+                except Exception:
+                    if not self.keys:
+                        raise
+            if kid not in self.keys and self._elapsed(self.last_forced_at):
+                self.last_forced_at = time.monotonic()
+                try:
+                    self.refresh()
+                except Exception:
+                    pass
+            return self.keys.get(kid)
+        finally:
+            self._fetching.release()
+
+    async def aget_key(self, kid: Optional[str]) -> Optional[dict]:
+        """
+        Asynchronous version of :meth:`get_key`, which fetches the key set with an `httpx.AsyncClient`.
+
+        :param kid: The key identifier found in the token header.
+        :return: The matching JWK, or None if the issuer does not publish such key.
+        :raises Exception: If there are no cached keys and the key set could not be fetched.
+        """
+        if not self.is_stale() and kid in self.keys:
+            return self.keys[kid]
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            if self.is_stale() and (not self.keys or self._elapsed(self.last_attempt_at)):
+                try:
+                    await self._arefresh()
+                except Exception:
+                    if not self.keys:
+                        raise
+            if kid not in self.keys and self._elapsed(self.last_forced_at):
+                self.last_forced_at = time.monotonic()
+                try:
+                    await self._arefresh()
+                except Exception:
+                    pass
+            return self.keys.get(kid)
+
+    async def _arefresh(self):
+        self.last_attempt_at = time.monotonic()
+        self.fetch_count += 1
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            keys = await self.async_fetcher(self.url, self.timeout)
+            outcome = "ok"
+        finally:
+            jwks_fetch_duration.labels(outcome).observe(time.perf_counter() - start)
+        self._store(keys)
+
+    def _elapsed(self, since: Optional[float]) -> bool:
+        return since is None or time.monotonic() - since >= self.min_refresh_interval
+
+    def start_background_refresh(self, interval: Optional[float] = None):
+        """
+        Start a daemon thread which refreshes the key set before it goes stale. Keys fetched less than
+        `interval` seconds ago, e.g. while warming up, are not fetched again.
+
+        :param interval: Seconds between refreshes. Defaults to half of the TTL.
+        :return: None
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        interval = interval if interval is not None else self.ttl / 2
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._refresh_loop, args = (interval,),
+                                        name = "jwks-refresh", daemon = True)
+        self._thread.start()
+
+    def stop_background_refresh(self):
+        """
+        Stop the background refresh thread, if running.
+
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout = self.timeout)
+            self._thread = None
+
+    def _refresh_loop(self, interval: float):
+        while True:
+            if self.fetched_at is None or time.monotonic() - self.fetched_at >= interval:
+                try:
+                    self.refresh()
+                except Exception:
+                    pass
+            if self._stop.wait(interval):
+                return
+
+    def clear(self):
+        """
+        Drop every cached key.
+
+        :return: None
+        """
+        with self._lock:
+            self.keys = {}
+            self.fetched_at = None
+            self.last_attempt_at = None
+            self.last_forced_at = None
+
+key_store = JWKSKeyStore()
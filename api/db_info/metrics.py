@@ -0,0 +1,286 @@
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Engine, event
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_value(value: float) -> str:
+    """
+    :param value: A sample value.
+    :return: The value as written in the Prometheus text format.
+    """
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """
+    :param labels: The labels of a sample.
+    :return: The labels as written in the Prometheus text format, e.g. `{route="/points"}`.
+    """
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for (name, value) in zip(labels, escaped)) + "}"
+
+class Metric(ABC):
+    """
+    Base class of the metrics, holding one child per combination of label values.
+
+    :param name: The metric name.
+    :param documentation: The help text of the metric.
+    :param labelnames: The names of the labels of the metric.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str):
+        """
+        :param values: The value of each label, in the order of `labelnames`.
+        :return: The child of the metric for those label values, created on first use.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """
+        :return: A new child, holding the samples of one combination of label values.
+        """
+
+    @abstractmethod
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        """
+        :return: The (sample name, labels, value) of every sample of the metric.
+        """
+
+    def clear(self):
+        """
+        Drop every child, e.g. between tests.
+
+        :return: None
+        """
+        with self._lock:
+            self._children = {}
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+class Counter(Metric):
+    """
+    Monotonically increasing count, e.g. of requests.
+    """
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def samples(self):
+        for (values, child) in list(self._children.items()):
+            yield (f"{self.name}_total", dict(zip(self.labelnames, values)), child.value)
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return (list(self.counts), self.sum)
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, e.g. latencies, counted in cumulative buckets.
+
+    Observing a value is a binary search and an increment, so it can be used on every request.
+
+    :param buckets: Upper bounds of the buckets, in increasing order. A `+Inf` bucket is always added.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def samples(self):
+        for (values, child) in list(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            (counts, total) = child.snapshot()
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield (f"{self.name}_bucket", {**labels, "le": format_value(bound)}, cumulative)
+            yield (f"{self.name}_count", labels, cumulative)
+            yield (f"{self.name}_sum", labels, total)
+
+class CallbackMetric(Metric):
+    """
+    Metric whose samples are read at scrape time, e.g. from the pool or cache counters, so it costs nothing
+    on the hot path.
+
+    :param metric_type: The Prometheus type of the metric, e.g. `gauge` or `counter`.
+    :param callback: Returns the (labels, value) pairs of the samples.
+    """
+
+    def __init__(self, name: str, documentation: str, metric_type: str,
+                 callback: Callable[[], Iterable[Tuple[Dict[str, str], float]]]):
+        super().__init__(name, documentation)
+        self.type = metric_type
+        self.callback = callback
+
+    def _new_child(self):
+        raise TypeError(f"{self.name} reads its samples from its callback and has no children")
+
+    def samples(self):
+        sample_name = f"{self.name}_total" if self.type == "counter" else self.name
+        for (labels, value) in self.callback():
+            if value is not None:
+                yield (sample_name, labels, value)
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered together in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        :param metric: The metric to expose. A metric with the same name replaces the previous one.
+        :return: The metric.
+        """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, metric_type: str,
+                 callback: Callable[[], Iterable[Tuple[Dict[str, str], float]]]) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, metric_type, callback))
+
+    def get(self, name: str) -> Optional[Metric]:
+        """
+        :param name: The metric name.
+        :return: The metric, or None if there is no such metric.
+        """
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        :return: Every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            name = f"{metric.name}_total" if metric.type == "counter" else metric.name
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for (sample_name, labels, value) in metric.samples():
+                lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram("http_request_duration_seconds",
+                                           "Time spent serving HTTP requests, by route template.",
+                                           ("method", "route", "status"))
+db_query_duration = registry.histogram("db_query_duration_seconds",
+                                       "Time spent executing SQL statements, by statement type.",
+                                       ("statement",))
+auth_verify_duration = registry.histogram("auth_verify_duration_seconds",
+                                          "Time spent verifying access tokens, by outcome.",
+                                          ("outcome",))
+jwks_fetch_duration = registry.histogram("jwks_fetch_duration_seconds",
+                                         "Time spent downloading the issuer signing keys, by outcome.",
+                                         ("outcome",), buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+def instrument_engine(engine: Engine):
+    """
+    Time every SQL statement executed by an engine into `db_query_duration`.
+
+    :param engine: A sync engine, or the `sync_engine` of an AsyncEngine.
+    :return: None
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        starts = connection.info.get("query_start")
+        if starts:
+            verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+            db_query_duration.labels(verb).observe(time.perf_counter() - starts.pop())
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request into `http_request_duration`.
+
+    Requests are labelled with the route template (e.g. `/points/v1/points/name/{point_name}`) rather than the
+    path, so the number of series stays bounded. Requests matching no route are labelled `unmatched`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = getattr(route, "path_format", None) or getattr(route, "path", None) or "unmatched"
+            http_request_duration.labels(scope["method"], route_path, str(status_code)).observe(time.perf_counter() - start)
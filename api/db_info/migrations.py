@@ -0,0 +1,109 @@
+from sqlalchemy import Engine, insert, inspect, select, text, update
+
+from . import models
+from .geo import parse_coordinates
+
+def migrate_coordinates(engine: Engine) -> int:
+    """
+    Add the numeric latitude/longitude columns to an existing points table and fill them from the coordinates strings.
+
+    It is safe to run it several times: columns and indexes are only added if missing, and only points without a
+    latitude are parsed.
+
+    :param engine: The engine of the database to migrate.
+    :return: The number of points whose coordinates were parsed.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table(models.Point.__tablename__):
+        return 0
+    columns = {column["name"] for column in inspector.get_columns(models.Point.__tablename__)}
+    indexes = {index["name"] for index in inspector.get_indexes(models.Point.__tablename__)}
+    migrated = 0
+    with engine.begin() as connection:
+        for column in ("latitude", "longitude"):
+            if column not in columns:
+                connection.execute(text(f"ALTER TABLE points ADD COLUMN {column} DOUBLE PRECISION"))
+                columns.add(column)
+        for index in models.Point.__table__.indexes:
+            if index.name not in indexes and all(column.name in columns for column in index.columns):
+                index.create(connection)
+        rows = connection.execute(select(models.Point.id, models.Point.coordinates)
+                                  .where(models.Point.latitude.is_(None))).all()
+        for (point_id, coordinates) in rows:
+            parsed = parse_coordinates(coordinates)
+            if parsed is None:
+                continue
+            connection.execute(update(models.Point).where(models.Point.id == point_id)
+                               .values(latitude = parsed[0], longitude = parsed[1]))
+            migrated += 1
+    return migrated
+
+def migrate_sync(engine: Engine) -> bool:
+    """
+    Add the sync version columns to an existing points table, and create the row of the sync version counter.
+
+    Existing points get version 0, so they are only sent to clients doing a full sync. The index of the version
+    column is created by :func:`migrate_coordinates`, which must run after. It is safe to run it several times:
+    columns are only added if missing.
+
+    :param engine: The engine of the database to migrate.
+    :return: True if columns were added.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table(models.Point.__tablename__):
+        return False
+    columns = {column["name"] for column in inspector.get_columns(models.Point.__tablename__)}
+    table = models.Point.__table__
+    added = False
+    with engine.begin() as connection:
+        for column in ("version", "updated_at"):
+            if column not in columns:
+                column_type = table.c[column].type.compile(dialect = engine.dialect)
+                default = " NOT NULL DEFAULT 0" if column == "version" else ""
+                connection.execute(text(f"ALTER TABLE points ADD COLUMN {column} {column_type}{default}"))
+                added = True
+        if inspector.has_table(models.SyncState.__tablename__) and connection.execute(select(models.SyncState.id)).first() is None:
+            connection.execute(insert(models.SyncState).values(id = 1, version = 0, compacted_version = 0))
+    return added
+
+SEARCH_TABLE = "points_search"
+SEARCH_INDEX = "ft_points_name_location"
+
+def migrate_search(engine: Engine) -> bool:
+    """
+    Create the full-text index of the names and locations of the points, used by `crud.search_points` when the
+    catalogue cache is disabled.
+
+    On SQLite it is an FTS5 table folding diacritics, kept in sync with the points table by triggers and filled
+    from the existing points. On MySQL it is a FULLTEXT index, whose accent-insensitivity comes from the
+    collation of the columns. Other databases have no full-text index. It is safe to run it several times: the
+    index is only created if missing.
+
+    :param engine: The engine of the database to migrate.
+    :return: True if the index was created.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table(models.Point.__tablename__):
+        return False
+    if engine.dialect.name == "sqlite":
+        if inspector.has_table(SEARCH_TABLE):
+            return False
+        with engine.begin() as connection:
+            connection.execute(text(f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(name, location, content = 'points', "
+                                    "content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2')"))
+            connection.execute(text(f"CREATE TRIGGER {SEARCH_TABLE}_insert AFTER INSERT ON points BEGIN "
+                                    f"INSERT INTO {SEARCH_TABLE} (rowid, name, location) VALUES (new.id, new.name, new.location); END"))
+            connection.execute(text(f"CREATE TRIGGER {SEARCH_TABLE}_delete AFTER DELETE ON points BEGIN "
+                                    f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, name, location) VALUES ('delete', old.id, old.name, old.location); END"))
+            connection.execute(text(f"CREATE TRIGGER {SEARCH_TABLE}_update AFTER UPDATE OF name, location ON points BEGIN "
+                                    f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, name, location) VALUES ('delete', old.id, old.name, old.location); "
+                                    f"INSERT INTO {SEARCH_TABLE} (rowid, name, location) VALUES (new.id, new.name, new.location); END"))
+            connection.execute(text(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('rebuild')"))
+        return True
+    if engine.dialect.name in ("mysql", "mariadb"):
+        if SEARCH_INDEX in {index["name"] for index in inspector.get_indexes(models.Point.__tablename__)}:
+            return False
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE points ADD FULLTEXT INDEX {SEARCH_INDEX} (name, location)"))
+        return True
+    return False
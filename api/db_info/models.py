@@ -1,7 +1,8 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import BigInteger, Column, DateTime, Double, ForeignKey, Index, Integer, String
+from sqlalchemy.orm import relationship, validates
 
 from . import database
+from .geo import parse_coordinates
 
 class Point(database.Base):
     """
@@ -17,14 +18,35 @@ class Point(database.Base):
     :type coordinates: str
     :param image: The image URL of the point.
     :type image: str
+    :param latitude: The latitude parsed from the coordinates, or None if they can't be parsed.
+    :type latitude: float
+    :param longitude: The longitude parsed from the coordinates, or None if they can't be parsed.
+    :type longitude: float
+    :param version: The sync version of the write which created or last changed the point.
+    :type version: int
+    :param updated_at: When the point was created or last changed.
+    :type updated_at: datetime
     """
     __tablename__ = "points"
+    __table_args__ = (Index("ix_points_latitude_longitude", "latitude", "longitude"),)
 
     id = Column(Integer, primary_key = True, index = True, autoincrement=True)
     name = Column(String(30), unique = True, index = True)
     location = Column(String(50))
     coordinates = Column(String(200), unique = True)
     image = Column(String(500))
+    latitude = Column(Double)
+    longitude = Column(Double)
+    version = Column(BigInteger, nullable = False, default = 0, index = True)
+    updated_at = Column(DateTime)
+
+    @validates("coordinates")
+    def sync_latitude_longitude(self, key: str, coordinates: str) -> str:
+        """
+        Keep the numeric latitude and longitude in sync with the coordinates string.
+        """
+        (self.latitude, self.longitude) = parse_coordinates(coordinates) or (None, None)
+        return coordinates
     
 class AuthorizationToPoint(database.Base):
     """
@@ -43,8 +65,52 @@ class AuthorizationToPoint(database.Base):
     __tablename__ = "authpoint"
     
     id = Column(Integer, primary_key = True, index = True, autoincrement=True)
-    sub = Column(String(50), unique = True)
+    sub = Column(String(50), unique = True, index = True)
     name = Column(String(50))
     point_id = Column(Integer, ForeignKey('points.id'))
     
-    dropoff_point = relationship("Point")
\ No newline at end of file
+    dropoff_point = relationship("Point", lazy = "joined")
+
+class PointTombstone(database.Base):
+    """
+    Records the deletion of a point, so that clients syncing their copy of the catalogue learn about it.
+
+    :param id: The unique identifier of the tombstone.
+    :type id: int
+    :param point_id: The id the deleted point had.
+    :type point_id: int
+    :param name: The name the deleted point had.
+    :type name: str
+    :param version: The sync version of the deletion.
+    :type version: int
+    :param deleted_at: When the point was deleted. Tombstones older than the compaction horizon are removed.
+    :type deleted_at: datetime
+    """
+    __tablename__ = "point_tombstones"
+
+    id = Column(Integer, primary_key = True, autoincrement = True)
+    point_id = Column(Integer, nullable = False)
+    name = Column(String(30))
+    version = Column(BigInteger, nullable = False, index = True)
+    deleted_at = Column(DateTime, nullable = False, index = True)
+
+class SyncState(database.Base):
+    """
+    Single-row table holding the sync version counter.
+
+    Every write takes the next version by incrementing the counter in its transaction. The row stays locked until
+    the transaction ends, so versions become visible in increasing order and a client which has seen a version
+    has seen every earlier one.
+
+    :param id: Always 1.
+    :type id: int
+    :param version: The version of the latest write.
+    :type version: int
+    :param compacted_version: The version of the latest compacted tombstone. Clients older than it must resync.
+    :type compacted_version: int
+    """
+    __tablename__ = "sync_state"
+
+    id = Column(Integer, primary_key = True)
+    version = Column(BigInteger, nullable = False, default = 0)
+    compacted_version = Column(BigInteger, nullable = False, default = 0)
@@ -0,0 +1,138 @@
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+class PoolStats:
+    """
+    Counters describing how a connection pool is being used.
+
+    Attributes:
+        connects (int): Number of new DBAPI connections opened.
+        checkouts (int): Number of connections handed out by the pool.
+        checkins (int): Number of connections returned to the pool.
+        invalidations (int): Number of connections invalidated, e.g. by a failed pre-ping.
+        overflow_hits (int): Number of checkouts served beyond `pool_size`.
+        timeouts (int): Number of checkouts which gave up after `pool_timeout`.
+        wait_seconds_total (float): Total time spent waiting for a connection.
+        wait_seconds_max (float): Longest time spent waiting for a connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Set every counter back to zero.
+
+        :return: None
+        """
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.overflow_hits = 0
+            self.timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds: float, overflow: bool):
+        """
+        Record the time a checkout waited for a connection.
+
+        :param seconds: The time waited.
+        :param overflow: Whether the connection was served beyond `pool_size`.
+        :return: None
+        """
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if overflow:
+                self.overflow_hits += 1
+
+    def increment(self, counter: str):
+        """
+        :param counter: The name of the counter to increment.
+        :return: None
+        """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self) -> dict:
+        """
+        :return: The counters, plus the average wait per checkout.
+        """
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "overflow_hits": self.overflow_hits,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+                "wait_seconds_avg": self.wait_seconds_total / self.checkouts if self.checkouts else 0.0,
+            }
+
+class _InstrumentedPoolMixin:
+    """
+    Times every checkout of a queue pool into its `stats`, which survive `Pool.recreate()`.
+    """
+    stats: PoolStats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            if self.stats is not None:
+                self.stats.increment("timeouts")
+            raise
+        if self.stats is not None:
+            self.stats.record_wait(time.perf_counter() - start, self.overflow() > 0)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+class InstrumentedQueuePool(_InstrumentedPoolMixin, QueuePool):
+    pass
+
+class InstrumentedAsyncQueuePool(_InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+def instrument(pool: Pool) -> PoolStats:
+    """
+    Attach a PoolStats to the pool and keep it updated through pool events.
+
+    :param pool: The pool of an engine.
+    :return: The stats of the pool.
+    """
+    stats = PoolStats()
+    pool.stats = stats
+    event.listen(pool, "connect", lambda *args: stats.increment("connects"))
+    event.listen(pool, "checkout", lambda *args: stats.increment("checkouts"))
+    event.listen(pool, "checkin", lambda *args: stats.increment("checkins"))
+    event.listen(pool, "invalidate", lambda *args: stats.increment("invalidations"))
+    return stats
+
+def pool_status(pool: Pool, stats: PoolStats) -> dict:
+    """
+    Describe the current state of a pool.
+
+    :param pool: The pool of an engine.
+    :param stats: The stats attached to the pool.
+    :return: The pool class, its gauges (when the pool class has them) and its counters.
+    """
+    status = {"pool": type(pool).__name__}
+    for gauge in ("size", "checkedin", "checkedout", "overflow"):
+        if hasattr(pool, gauge):
+            status[gauge] = getattr(pool, gauge)()
+    status.update(stats.as_dict())
+    return status
@@ -0,0 +1,216 @@
+import asyncio
+import cProfile
+import functools
+import logging
+import os
+import random
+import re
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+from sqlalchemy import Engine, event
+
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200"))
+
+slow_query_logger = logging.getLogger("db_info.slow_queries")
+
+# Durations of the phases of the request being profiled, or None when it isn't profiled
+current_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("current_timings", default = None)
+
+def record(phase: str, seconds: float):
+    """
+    Add time spent in a phase to the timings of the current request, if it is being profiled.
+
+    :param phase: The phase, e.g. "auth" or "db".
+    :param seconds: The time spent.
+    :return: None
+    """
+    timings = current_timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """
+    :param timings: The duration of each phase, in seconds.
+    :return: The value of a Server-Timing header, with the durations in milliseconds.
+    """
+    return ", ".join(f"{phase};dur={seconds * 1000:.3f}" for (phase, seconds) in timings.items())
+
+def instrument_engine(engine: Engine, threshold_ms: float = SLOW_QUERY_THRESHOLD_MS):
+    """
+    Add the time spent in SQL statements to the "db" phase of profiled requests, and log the statements slower
+    than the threshold to the `db_info.slow_queries` logger.
+
+    :param engine: A sync engine, or the `sync_engine` of an AsyncEngine.
+    :param threshold_ms: Statements slower than this many milliseconds are logged. A negative value disables the log.
+    :return: None
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context.profile_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.profile_start
+        record("db", elapsed)
+        if 0 <= threshold_ms <= elapsed * 1000:
+            slow_query_logger.warning("Slow query (%.1f ms%s): %s", elapsed * 1000,
+                                      ", executemany" if executemany else "", " ".join(statement.split()))
+
+class ProfiledRoute(APIRoute):
+    """
+    Route recording how long FastAPI takes to serialize the value returned by the endpoint into the "serialize"
+    phase of profiled requests.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The dependant is only read at request time, so the endpoint can be wrapped after the handler was built
+        self.dependant.call = self._timed(self.dependant.call)
+
+    @staticmethod
+    def _timed(call: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(call):
+            @functools.wraps(call)
+            async def timed_call(*args, **kwargs):
+                try:
+                    return await call(*args, **kwargs)
+                finally:
+                    mark_endpoint_end()
+        else:
+            @functools.wraps(call)
+            def timed_call(*args, **kwargs):
+                try:
+                    return call(*args, **kwargs)
+                finally:
+                    mark_endpoint_end()
+        return timed_call
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request: Request):
+            response = await handler(request)
+            timings = current_timings.get()
+            if timings is not None and "endpoint_end" in timings:
+                record("serialize", time.perf_counter() - timings.pop("endpoint_end"))
+            return response
+        return profiled_handler
+
+def mark_endpoint_end():
+    """
+    Remember when the endpoint of a profiled request returned, to time the serialization that follows.
+
+    :return: None
+    """
+    timings = current_timings.get()
+    if timings is not None:
+        timings["endpoint_end"] = time.perf_counter()
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling a request when asked by an authorized caller, or for a sample of the requests.
+
+    A request is profiled when it carries an `X-Profile` header and a valid access token, or with a probability
+    of `sample_rate`. With `X-Profile: cprofile`, or for sampled requests, a cProfile report of the event loop
+    thread is written to `report_dir`, when it is set. Only callers with a valid access token get the
+    Server-Timing header, with the auth, db and serialize phases and the total, and the X-Profile-Report header
+    with the file name of the report; the timings of sampled anonymous requests are not disclosed.
+
+    :param app: The ASGI application.
+    :param authorize: Coroutine function raising an HTTPException if the request has no valid access token.
+    :param sample_rate: Share of the requests which are profiled.
+    :param report_dir: Directory where the cProfile reports are written. Reports are disabled when None.
+    """
+
+    def __init__(self, app,
+                 authorize: Callable[[Request], Awaitable] = None,
+                 sample_rate: float = float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+                 report_dir: Optional[str] = os.getenv("PROFILE_DIR")):
+        self.app = app
+        self.authorize = authorize
+        self.sample_rate = sample_rate
+        self.report_dir = report_dir
+        self._profiling = False
+
+    async def mode(self, scope) -> Tuple[Optional[str], bool]:
+        """
+        :return: "timing" or "cprofile" if the request must be profiled, else None, and whether the caller is
+            authorized to receive the profiling headers.
+        """
+        requested = None
+        token = False
+        for (name, value) in scope.get("headers", ()):
+            if name == b"x-profile":
+                requested = value.decode("latin-1").strip().lower()
+            elif name == b"authorization":
+                token = True
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not requested and not sampled:
+            return (None, False)
+        authorized = token and await self.authorized(scope)
+        if requested and authorized:
+            return ("cprofile" if requested == "cprofile" else "timing", True)
+        return ("cprofile" if sampled else None, authorized)
+
+    async def authorized(self, scope) -> bool:
+        """
+        :return: True if the request has a valid access token.
+        """
+        if self.authorize is None:
+            return False
+        try:
+            await self.authorize(Request(scope))
+            return True
+        except HTTPException:
+            return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        timings: Dict[str, float] = {}
+        # Set before authorizing, so that the token verification is timed as the auth phase
+        token = current_timings.set(timings)
+        (mode, authorized) = await self.mode(scope)
+        if mode is None:
+            current_timings.reset(token)
+            return await self.app(scope, receive, send)
+
+        # Only one cProfile profiler can run at a time, so concurrent profiled requests only get timings
+        profiler = cProfile.Profile() if mode == "cprofile" and self.report_dir and not self._profiling else None
+        report = self.report_path(scope) if profiler is not None else None
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and authorized:
+                phases = {phase: timings[phase] for phase in ("auth", "db", "serialize") if phase in timings}
+                phases["total"] = time.perf_counter() - start
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(phases).encode()))
+                if report is not None:
+                    headers.append((b"x-profile-report", os.path.basename(report).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            if profiler is not None:
+                self._profiling = True
+                profiler.enable()
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                os.makedirs(self.report_dir, exist_ok = True)
+                profiler.dump_stats(report)
+            current_timings.reset(token)
+
+    def report_path(self, scope) -> str:
+        """
+        :return: The path of the cProfile report of the request.
+        """
+        path = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_")
+        return os.path.join(self.report_dir, f"{time.strftime('%Y%m%dT%H%M%S')}-{time.perf_counter_ns()}-{scope['method']}-{path}.prof")
@@ -0,0 +1,174 @@
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+# Disabled unless configured, since clients behind a proxy share its address until TRUSTED_PROXIES is set
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "0"))
+
+class RateLimiter(ABC):
+    """
+    Token-bucket rate limiter. Every client has a bucket of `burst` tokens, refilled at `rate` tokens per second,
+    and each request takes one token, so a client can send `burst` requests at once and `rate` per second after.
+
+    :param burst: Capacity of the buckets.
+    :param rate: Tokens added to a bucket per second. A rate of 0 disables the limiter.
+    """
+    # Whether `acquire` does network I/O, and so must run outside of the event loop
+    blocking = False
+
+    def __init__(self, burst: float = RATE_LIMIT_BURST, rate: float = RATE_LIMIT_RATE):
+        self.burst = burst
+        self.rate = rate
+        self.allowed = 0
+        self.limited = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, key: str) -> Tuple[bool, float]:
+        """
+        Take a token from the bucket of a client.
+
+        :param key: The bucket, e.g. `write:sub:1234`.
+        :return: Whether the request is allowed, and the seconds until the next token when it is not.
+        """
+        if not self.enabled:
+            return (True, 0.0)
+        (allowed, retry_after) = self._acquire(key, time.time())
+        if allowed:
+            self.allowed += 1
+        else:
+            self.limited += 1
+        return (allowed, retry_after)
+
+    @abstractmethod
+    def _acquire(self, key: str, now: float) -> Tuple[bool, float]:
+        """
+        Take a token from a bucket, in the storage of the limiter.
+
+        :param key: The bucket.
+        :param now: The current time.
+        :return: Whether the request is allowed, and the seconds until the next token when it is not.
+        """
+
+    def refill(self, tokens: Optional[float], updated: Optional[float], now: float) -> Tuple[bool, float, float]:
+        """
+        :param tokens: The tokens left in the bucket, or None for a new bucket.
+        :param updated: When the bucket was last updated.
+        :param now: The current time.
+        :return: Whether a token could be taken, the tokens left and the seconds until the next token.
+        """
+        if tokens is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+        if tokens >= 1:
+            return (True, tokens - 1, 0.0)
+        return (False, tokens, (1 - tokens) / self.rate)
+
+    def clear(self):
+        """
+        Forget every bucket, e.g. between tests.
+
+        :return: None
+        """
+        self.allowed = 0
+        self.limited = 0
+
+    def stats(self) -> dict:
+        return {"allowed": self.allowed, "limited": self.limited, "burst": self.burst, "rate": self.rate}
+
+class InMemoryRateLimiter(RateLimiter):
+    """
+    Rate limiter keeping the buckets in the process. Each replica limits its own share of the traffic.
+
+    :param max_keys: Maximum number of buckets kept. The least recently used ones are forgotten first, which
+        only gives their clients a full bucket again.
+    """
+
+    def __init__(self, burst: float = RATE_LIMIT_BURST, rate: float = RATE_LIMIT_RATE,
+                 max_keys: int = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))):
+        super().__init__(burst, rate)
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _acquire(self, key: str, now: float) -> Tuple[bool, float]:
+        with self._lock:
+            (tokens, updated) = self._buckets.pop(key, (None, None))
+            (allowed, tokens, retry_after) = self.refill(tokens, updated, now)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last = False)
+        return (allowed, retry_after)
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._buckets.clear()
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Rate limiter keeping the buckets in Redis, so the limits hold across every replica.
+
+    A bucket is a hash updated in a WATCH/MULTI transaction, retried when another replica changed it meanwhile.
+    Buckets expire once they would be full again, so idle clients cost nothing.
+
+    :param url: The Redis URL. Ignored if `client` is given.
+    :param client: An existing Redis client, e.g. a `fakeredis.FakeRedis` in tests.
+    :param prefix: Prefix of the bucket keys.
+    """
+    blocking = True
+
+    def __init__(self, burst: float = RATE_LIMIT_BURST, rate: float = RATE_LIMIT_RATE,
+                 url: Optional[str] = None, client = None, prefix: str = "points:ratelimit:"):
+        super().__init__(burst, rate)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _acquire(self, key: str, now: float) -> Tuple[bool, float]:
+        from redis.exceptions import RedisError
+        try:
+            return self._transaction(self.prefix + key, now)
+        except RedisError:
+            # Fail open: an unavailable Redis must not take the API down with it
+            return (True, 0.0)
+
+    def _transaction(self, name: str, now: float) -> Tuple[bool, float]:
+        from redis.exceptions import WatchError
+        ttl_ms = max(1, math.ceil(self.burst / self.rate * 1000))
+        with self.client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(name)
+                    (tokens, updated) = pipeline.hmget(name, "tokens", "updated")
+                    (allowed, tokens, retry_after) = self.refill(None if tokens is None else float(tokens),
+                                                                 None if updated is None else float(updated), now)
+                    pipeline.multi()
+                    pipeline.hset(name, mapping = {"tokens": tokens, "updated": now})
+                    pipeline.pexpire(name, ttl_ms)
+                    pipeline.execute()
+                    return (allowed, retry_after)
+                except WatchError:
+                    continue
+
+def create_rate_limiter() -> RateLimiter:
+    """
+    Create the rate limiter selected by the `RATE_LIMIT_BACKEND` variable (`memory` or `redis`).
+
+    :return: The rate limiter.
+    """
+    if os.getenv("RATE_LIMIT_BACKEND", "memory").lower() == "redis":
+        return RedisRateLimiter(url = os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    return InMemoryRateLimiter()
+
+rate_limiter = create_rate_limiter()
@@ -0,0 +1,189 @@
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from sqlalchemy import Engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+
+# Comma-separated URLs of read replicas of DATABASE_URL
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_MAX_LAG = int(os.getenv("REPLICA_MAX_LAG", "10"))
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# The sync version of a client's last write, returned by the writes and sent back on the next reads
+SYNC_VERSION_HEADER = "X-Sync-Version"
+SYNC_VERSION_COOKIE = "sync_version"
+
+SYNC_VERSION_QUERY = text("SELECT version FROM sync_state WHERE id = 1")
+
+class Replica:
+    """
+    A read replica of the database and the result of its last health check.
+
+    Attributes:
+        url (str): The URL of the replica, without its password.
+        engine (Engine): The engine of the replica.
+        async_engine (Optional[AsyncEngine]): The async engine of the replica, in async mode.
+        healthy (bool): Whether reads are sent to the replica. Replicas are healthy until a check fails.
+        version (Optional[int]): The sync version of the replica at the last check.
+        lag (Optional[int]): How many sync versions the replica was behind the primary at the last check.
+        error (Optional[str]): The error of the last check, if it failed.
+        reads (int): The number of `crud` reads sent to the replica.
+    """
+
+    def __init__(self, url: str, engine: Engine, async_engine = None):
+        self.url = make_url(url).render_as_string(hide_password = True)
+        self.engine = engine
+        self.async_engine = async_engine
+        self.healthy = True
+        self.version: Optional[int] = None
+        self.lag: Optional[int] = None
+        self.error: Optional[str] = None
+        self.reads = 0
+
+    def stats(self) -> dict:
+        return {"url": self.url, "healthy": self.healthy, "version": self.version, "lag": self.lag, "error": self.error, "reads": self.reads}
+
+class ReplicaRouter:
+    """
+    Chooses the read replica of each read, round-robin among the healthy ones, and remembers the clients which
+    just wrote, whose reads go to the primary so they see their own writes. Clients which send back the sync version
+    of their last write see it on any API instance, as their reads only go to the replicas which reached it.
+
+    A replica is unhealthy when it can't be queried, or when its sync version is more than `max_lag` versions
+    behind the primary's. Reads fall back to the primary when no replica is healthy.
+
+    :param replicas: The read replicas. The router is disabled when there are none.
+    :param primary: The engine of the primary, whose sync version the replicas are compared with.
+    :param max_lag: Maximum number of sync versions a healthy replica can be behind the primary.
+    :param sticky_seconds: Seconds the reads of a client go to the primary after it wrote.
+    :param max_clients: Maximum number of sticky clients remembered; the oldest ones are forgotten first.
+    """
+
+    def __init__(self, replicas: List[Replica], primary: Engine, max_lag: int = REPLICA_MAX_LAG,
+                 sticky_seconds: float = REPLICA_STICKY_SECONDS, max_clients: int = 100000):
+        self.replicas = replicas
+        self.primary = primary
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        self.max_clients = max_clients
+        self.fallbacks = 0
+        self._turn = itertools.count()
+        self._sticky: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    def choose(self, min_version: int = 0) -> Optional[Replica]:
+        """
+        :param min_version: The sync version the replica must have reached at its last check, e.g. the version of
+            the client's last write.
+        :return: The next healthy replica, or None to read from the primary.
+        """
+        healthy = [replica for replica in self.replicas if replica.healthy and (replica.version or 0) >= min_version]
+        if not healthy:
+            self.fallbacks += self.enabled
+            return None
+        replica = healthy[next(self._turn) % len(healthy)]
+        replica.reads += 1
+        return replica
+
+    def check(self):
+        """
+        Query every replica and compare its sync version with the primary's.
+
+        :return: None
+        """
+        try:
+            with self.primary.connect() as connection:
+                primary_version = connection.execute(SYNC_VERSION_QUERY).scalar() or 0
+        except SQLAlchemyError:
+            # The lag can't be measured; the replicas keep their state until the primary is back
+            return
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    version = connection.execute(SYNC_VERSION_QUERY).scalar() or 0
+            except SQLAlchemyError as error:
+                (replica.healthy, replica.version, replica.lag, replica.error) = (False, None, None, repr(error))
+                continue
+            replica.version = version
+            replica.lag = max(0, primary_version - version)
+            replica.healthy = replica.lag <= self.max_lag
+            replica.error = None
+
+    def stick(self, client: str):
+        """
+        Send the reads of a client to the primary for `sticky_seconds`, e.g. after it wrote.
+
+        :param client: The client, as identified by `auth.client_identity`.
+        :return: None
+        """
+        with self._lock:
+            self._sticky[client] = time.monotonic() + self.sticky_seconds
+            self._sticky.move_to_end(client)
+            while len(self._sticky) > self.max_clients:
+                self._sticky.popitem(last = False)
+
+    def is_sticky(self, client: str) -> bool:
+        """
+        :param client: The client, as identified by `auth.client_identity`.
+        :return: True if the reads of the client must go to the primary.
+        """
+        expiry = self._sticky.get(client)
+        return expiry is not None and expiry > time.monotonic()
+
+    def start_health_checks(self, interval: float = REPLICA_CHECK_INTERVAL):
+        """
+        Start a daemon thread checking the replicas every `interval` seconds. Does nothing without replicas.
+
+        :param interval: Seconds between checks.
+        :return: None
+        """
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._check_loop, args = (interval,), name = "replica-checks", daemon = True)
+        self._thread.start()
+
+    def stop_health_checks(self):
+        """
+        Stop the health check thread, if running.
+
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout = REPLICA_CHECK_INTERVAL)
+            self._thread = None
+
+    def _check_loop(self, interval: float):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(interval)
+
+    def clear(self):
+        """
+        Forget the sticky clients, e.g. between tests.
+
+        :return: None
+        """
+        with self._lock:
+            self._sticky.clear()
+
+    def stats(self) -> dict:
+        """
+        :return: The state of every replica, the reads which fell back to the primary and the sticky clients.
+        """
+        now = time.monotonic()
+        return {"replicas": [replica.stats() for replica in self.replicas], "fallbacks": self.fallbacks,
+                "sticky_clients": sum(expiry > now for expiry in list(self._sticky.values()))}
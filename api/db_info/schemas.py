@@ -1,5 +1,5 @@
-from typing import Optional
-from pydantic import BaseModel
+from typing import Dict, List, Optional
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 
 class PointBase(BaseModel):
     """
@@ -51,9 +51,9 @@ class Point(PointBase):
     """
     id: int
 
-    class ConfigDict:
-        from_attributes = True
-        schema_extra = {
+    model_config = ConfigDict(
+        from_attributes = True,
+        json_schema_extra = {
             "example": {
                 "id" : 1,
                 "name": "Room 123",
@@ -62,6 +62,80 @@ class Point(PointBase):
                 "image": "link_to_image"
             }
         }
+    )
+
+# Validates and serializes whole lists of points in one call, straight to JSON bytes
+PointList = TypeAdapter(List[Point])
+
+class PointDistance(Point):
+    """
+    A point together with its distance to a queried location.
+
+    Attributes:
+        distance_km (float): The great-circle distance to the queried location, in kilometres.
+    """
+    distance_km: float
+
+class PointDeletion(BaseModel):
+    """
+    A point deleted since the version a client synced at.
+
+    Attributes:
+        id (int): The id the point had.
+        name (Optional[str]): The name the point had.
+    """
+    id: int
+    name: Optional[str]
+
+class PointChanges(BaseModel):
+    """
+    The changes of the points catalogue since the version a client synced at.
+
+    Attributes:
+        version (int): The current version, to send as `since` on the next sync.
+        points (List[Point]): The points created or changed since the client version.
+        deleted (List[PointDeletion]): The points deleted since the client version, to remove before applying `points`.
+    """
+    version: int
+    points: List[Point]
+    deleted: List[PointDeletion]
+
+class PointBatch(BaseModel):
+    """
+    The points to get in a single request, by name and by id.
+
+    Attributes:
+        names (List[str]): The names of the points.
+        ids (List[int]): The ids of the points.
+    """
+    names: List[str] = []
+    ids: List[int] = []
+
+class PointBatchResult(BaseModel):
+    """
+    The points of a batch request, keyed by the requested names and ids.
+
+    Attributes:
+        names (Dict[str, Optional[Point]]): The point of each requested name, null if there is none.
+        ids (Dict[int, Optional[Point]]): The point of each requested id, null if there is none.
+        missing (PointBatch): The requested names and ids without a point.
+    """
+    names: Dict[str, Optional[Point]]
+    ids: Dict[int, Optional[Point]]
+    missing: PointBatch
+
+class AuthorizationCreate(BaseModel):
+    """
+    The data needed to authorize a user to access a drop-off point.
+
+    Attributes:
+        - sub (str): The subject identifier of the user access token.
+        - name (str): The subject name
+        - point_id (int): The identifier of the point that the authorization grants access to.
+    """
+    sub: str
+    name: str
+    point_id: int
 
 class AuthorizationToPoint(BaseModel):
     """
@@ -73,9 +147,9 @@ class AuthorizationToPoint(BaseModel):
         - name (str): The subject name
         - point_id (int): The identifier of the point that the authorization grants access to.
 
-    ConfigDict:
+    model_config:
         - from_attributes (bool): If set to True, the class will be configured to load data from attributes.
-        - schema_extra (dict): Extra schema information for serialization and documentation purposes.
+        - json_schema_extra (dict): Extra schema information for serialization and documentation purposes.
 
     Example:
         The example below shows how an AuthorizationToPoint object can be represented:
@@ -92,12 +166,13 @@ class AuthorizationToPoint(BaseModel):
     name: str
     point_id: int
 
-    class ConfigDict:
-        from_attributes = True
-        schema_extra = {
+    model_config = ConfigDict(
+        from_attributes = True,
+        json_schema_extra = {
             "example": {
                 "id" : 1,
                 "sub": "sub_identifier",
                 "point_id": 1,
             }
-        }
\ No newline at end of file
+        }
+    )
\ No newline at end of file
@@ -0,0 +1,156 @@
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Dict, Generic, Hashable, Iterable, List, Set, Tuple, TypeVar
+
+T = TypeVar("T")
+
+WORD = re.compile(r"\w+")
+
+def normalize(text: str) -> str:
+    """
+    Fold a text for accent- and case-insensitive matching, e.g. "Pavilhão" to "pavilhao".
+
+    :param text: The text.
+    :return: The text without diacritics, case-folded.
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+# Cached, so rebuilding the index of a catalogue where few points changed only folds the changed texts
+@lru_cache(maxsize = 262144)
+def tokenize(text: str) -> Tuple[str, ...]:
+    """
+    :param text: The text.
+    :return: The normalized words of the text.
+    """
+    return tuple(WORD.findall(normalize(text)))
+
+class SearchIndex(Generic[T]):
+    """
+    In-memory index answering accent-insensitive prefix searches over the name and location of the points.
+
+    Every word of the names and locations is kept in a sorted array, so the words starting with a prefix are one
+    binary search and a contiguous range away, like the subtree of a trie but without a node per character.
+    Each query word must be the prefix of a word of the point. Matches are ranked: names starting with the query
+    first, then points matching on their name only, then the others, alphabetically within each group.
+
+    An index is never modified once built, so it can be searched from several threads; :meth:`updated` derives
+    the index of the next catalogue from it.
+
+    :param entries: (key, name, location, item) tuples, the key identifying the item, e.g. the id of the point.
+    """
+    # Past this share of changed entries, `updated` builds the next index from scratch
+    REBUILD_RATIO = 0.25
+
+    def __init__(self, entries: Iterable[Tuple[Hashable, str, str, T]] = ()):
+        self.items: Dict[Hashable, T] = {}
+        self.texts: Dict[Hashable, Tuple[str, str]] = {}
+        self.names: Dict[Hashable, str] = {}
+        self.postings: Dict[str, List[Hashable]] = {}
+        self.name_postings: Dict[str, List[Hashable]] = {}
+        for (key, name, location, item) in entries:
+            self.items[key] = item
+            self._add(key, name or "", location or "", copy = False)
+        self._sort()
+
+    def _add(self, key: Hashable, name: str, location: str, copy: bool = True):
+        self.texts[key] = (name, location)
+        name_words = tokenize(name)
+        self.names[key] = " ".join(name_words)
+        for (postings, words) in ((self.name_postings, name_words), (self.postings, name_words + tokenize(location))):
+            for word in dict.fromkeys(words):
+                keys = postings.get(word)
+                if keys is None:
+                    postings[word] = [key]
+                elif copy:
+                    # Posting lists may be shared with the index this one was derived from
+                    postings[word] = keys + [key]
+                else:
+                    keys.append(key)
+
+    def _remove(self, key: Hashable):
+        (name, location) = self.texts.pop(key)
+        del self.names[key]
+        name_words = tokenize(name)
+        for (postings, words) in ((self.name_postings, name_words), (self.postings, name_words + tokenize(location))):
+            for word in dict.fromkeys(words):
+                keys = [other for other in postings[word] if other != key]
+                if keys:
+                    postings[word] = keys
+                else:
+                    del postings[word]
+
+    def _sort(self):
+        self.words = sorted(self.postings)
+        self.name_words = sorted(self.name_postings)
+
+    def updated(self, entries: Iterable[Tuple[Hashable, str, str, T]]) -> "SearchIndex[T]":
+        """
+        Derive the index of new entries from this one, only indexing again the entries whose name or location
+        changed. This index is left untouched.
+
+        :param entries: Every entry of the new index, as for the constructor.
+        :return: The new index.
+        """
+        entries = list(entries)
+        texts = {key: (name or "", location or "") for (key, name, location, _) in entries}
+        removed = [key for (key, text) in self.texts.items() if texts.get(key) != text]
+        added = [key for (key, text) in texts.items() if self.texts.get(key) != text]
+        if len(removed) + len(added) > self.REBUILD_RATIO * max(1, len(texts)):
+            return SearchIndex(entries)
+        index: SearchIndex[T] = SearchIndex()
+        index.items = {key: item for (key, _, _, item) in entries}
+        (index.texts, index.names) = (dict(self.texts), dict(self.names))
+        (index.postings, index.name_postings) = (dict(self.postings), dict(self.name_postings))
+        for key in removed:
+            index._remove(key)
+        for key in added:
+            index._add(key, *texts[key])
+        if removed or added:
+            index._sort()
+        else:
+            (index.words, index.name_words) = (self.words, self.name_words)
+        return index
+
+    @staticmethod
+    def _prefixed(words: List[str], postings: Dict[str, List[Hashable]], prefix: str) -> Set[Hashable]:
+        matches: Set[Hashable] = set()
+        position = bisect_left(words, prefix)
+        while position < len(words) and words[position].startswith(prefix):
+            matches.update(postings[words[position]])
+            position += 1
+        return matches
+
+    def _matching(self, words: List[str], postings: Dict[str, List[Hashable]], query: Tuple[str, ...]) -> Set[Hashable]:
+        matches = None
+        # The longest words first, since they match the fewest points
+        for prefix in sorted(query, key = len, reverse = True):
+            found = self._prefixed(words, postings, prefix)
+            matches = found if matches is None else matches & found
+            if not matches:
+                break
+        return matches or set()
+
+    def search(self, query: str, limit: int) -> List[T]:
+        """
+        :param query: The text typed by the user.
+        :param limit: Maximum number of items to return.
+        :return: The matching items, best first.
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        matches = self._matching(self.words, self.postings, words)
+        by_name = self._matching(self.name_words, self.name_postings, words) & matches
+        folded = " ".join(words)
+        def rank(key: Hashable) -> Tuple[int, str]:
+            name = self.names[key]
+            group = 0 if name.startswith(folded) else 1 if key in by_name else 2
+            return (group, name)
+        return [self.items[key] for key in heapq.nsmallest(limit, matches, key = rank)]
+
+    def __len__(self) -> int:
+        return len(self.items)
@@ -0,0 +1,47 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent reads: while a read is running, callers asking for the same key wait for it
+    and share its result instead of running their own query.
+
+    Coalescing happens on the event loop, around `run_crud`, rather than in the `crud` functions. In async mode
+    those run on the event loop thread through `run_sync`, where a caller blocking on another's result would
+    never let it finish.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        :param key: Identifies the read, e.g. `("point", name)`.
+        :param call: Runs the read when no identical read is in flight.
+        :return: The result of the read, shared by every caller that asked for the key while it was running.
+        :raises Exception: Whatever the read raised, to every caller that shared it.
+        """
+        loop = asyncio.get_running_loop()
+        pending = self._calls.get(key)
+        if pending is not None and pending.get_loop() is loop:
+            self.followers += 1
+            # Shielded, so a follower whose request is cancelled doesn't cancel the read of the others
+            return await asyncio.shield(pending)
+        self.leaders += 1
+        pending = self._calls[key] = asyncio.ensure_future(call())
+        pending.add_done_callback(lambda _: self._forget(key, pending))
+        return await asyncio.shield(pending)
+
+    def _forget(self, key: Hashable, pending: asyncio.Future):
+        if self._calls.get(key) is pending:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        """
+        :return: How many reads ran, and how many callers shared a read instead of running one.
+        """
+        return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._calls)}
+
+read_flights = SingleFlight()
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU cache of already verified access tokens.
+
+    Entries are indexed by the SHA-256 of the raw token, so the tokens themselves are never kept in memory,
+    and they expire at the token `exp` claim. A `maxsize` of 0 disables the cache.
+
+    :param maxsize: Maximum number of tokens kept in the cache.
+    """
+
+    def __init__(self, maxsize: int = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token: str) -> str:
+        """
+        :param token: The raw access token.
+        :return: The cache key of the token.
+        """
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        """
+        Get the decoded claims of a previously verified token.
+
+        :param token: The raw access token.
+        :return: The decoded claims, or None if the token is not cached or has expired.
+        """
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            (expires_at, claims) = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return claims
+
+    def peek(self, token: str) -> Optional[dict]:
+        """
+        Get the decoded claims of a previously verified token without counting a hit or a miss, nor refreshing
+        its position in the LRU order.
+
+        :param token: The raw access token.
+        :return: The decoded claims, or None if the token is not cached or has expired.
+        """
+        entry = self._entries.get(self.key(token))
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def put(self, token: str, claims: dict):
+        """
+        Store the decoded claims of a verified token until it expires.
+
+        :param token: The raw access token.
+        :param claims: The decoded claims. Tokens without an `exp` claim are not cached.
+        :return: None
+        """
+        expires_at = claims.get("exp")
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, claims)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        """
+        Drop every cached token.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+token_cache = VerifiedTokenCache()
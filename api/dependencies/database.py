@@ -0,0 +1,195 @@
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, List, Tuple, Union
+
+from fastapi import Request, Response
+from sqlalchemy import Executable, RowMapping
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from db_info import auth, database
+from db_info.replicas import SYNC_VERSION_COOKIE, SYNC_VERSION_HEADER
+
+def requested_version(request: Request) -> int:
+    """
+    Get the sync version of the client's last write, sent back in the X-Sync-Version header or cookie.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        int: The version, or 0 if the client sent none.
+    """
+    value = request.headers.get(SYNC_VERSION_HEADER) or request.cookies.get(SYNC_VERSION_COOKIE)
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+def bind_client(db: Session, request: Request, response: Response):
+    """
+    Tie a session to the client of the request when there are read replicas: its writes make the client sticky
+    and are answered with their sync version, and the reads of a sticky client, or of a client whose last write
+    the replicas haven't reached yet, go to the primary.
+
+    Args:
+        db (Session): The database session of the request.
+        request (Request): The request object.
+        response (Response): The response the sync version of the writes is set on.
+    """
+    if database.replica_router.enabled:
+        client = auth.client_identity(request)
+        db.info["client"] = client
+        db.info["primary"] = database.replica_router.is_sticky(client)
+        db.info["min_version"] = requested_version(request)
+        db.info["response"] = response
+
+def read_routing(db: Union[Session, AsyncSession]) -> Tuple[bool, int]:
+    """
+    Get where the reads of a session may go, e.g. to share them only with reads routed the same way.
+
+    Args:
+        db (Union[Session, AsyncSession]): The database session of the request.
+
+    Returns:
+        Tuple[bool, int]: Whether the reads must go to the primary, and else the sync version the replica must have reached.
+    """
+    session = db.sync_session if isinstance(db, AsyncSession) else db
+    if session.info.get("primary"):
+        return (True, 0)
+    return (False, session.info.get("min_version", 0))
+
+def send_sync_version(session: Session):
+    """
+    Set the sync version of the writes committed by a session on the response of its request, as the
+    X-Sync-Version header and cookie, so the client's next reads, on any API instance, can ask for it.
+
+    Args:
+        session (Session): The database session of the request.
+    """
+    version = session.info.pop("sync_version", None)
+    response = session.info.get("response")
+    if version is not None and response is not None:
+        response.headers[SYNC_VERSION_HEADER] = str(version)
+        response.set_cookie(SYNC_VERSION_COOKIE, str(version), httponly = True, samesite = "lax")
+
+def get_sync_db(request: Request, response: Response):
+    """
+    Get the database session from the SessionLocal object which the API can connect to.
+
+    Args:
+        request (Request): The request object, identifying the client for the read replica routing.
+        response (Response): The response the sync version of the writes is set on.
+
+    Return:
+        A database session.
+    """
+    db = database.SessionLocal()
+    bind_client(db, request, response)
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_db(request: Request, response: Response):
+    """
+    Get an asynchronous database session from the AsyncSessionLocal object which the API can connect to.
+
+    Args:
+        request (Request): The request object, identifying the client for the read replica routing.
+        response (Response): The response the sync version of the writes is set on.
+
+    Return:
+        An asynchronous database session.
+    """
+    async with database.AsyncSessionLocal() as db:
+        bind_client(db.sync_session, request, response)
+        yield db
+
+get_db = get_async_db if database.ASYNC_MODE else get_sync_db
+
+@asynccontextmanager
+async def session_scope(routing: Tuple[bool, int] = (False, 0)):
+    """
+    Open a database session of the configured mode outside of a request, e.g. on startup.
+
+    Args:
+        routing (Tuple[bool, int]): Where its reads may go, as returned by `read_routing`. Defaults to any healthy replica.
+
+    Return:
+        A database session, closed when the context exits.
+    """
+    (primary, min_version) = routing
+    if database.ASYNC_MODE:
+        async with database.AsyncSessionLocal() as db:
+            db.sync_session.info.update(primary = primary, min_version = min_version)
+            yield db
+    else:
+        db = database.SessionLocal()
+        db.info.update(primary = primary, min_version = min_version)
+        try:
+            yield db
+        finally:
+            db.close()
+
+async def run_crud(function: Callable, db: Union[Session, AsyncSession], *args, **kwargs) -> Any:
+    """
+    Run a `crud` function without blocking the event loop.
+
+    With an AsyncSession the function runs on its asyncio connection through `run_sync`, so the same `crud`
+    implementation serves both modes; the blocking calls it defers to `info["deferred"]`, like publishing its
+    changes, then run in the threadpool. With a regular Session it runs in the threadpool, like a sync endpoint would.
+    Functions marked with `database.replica_read` read from a read replica, unless the client of the session is
+    sticky or no healthy replica reached the version of its last write. The version of the writes it committed is
+    set on the response.
+
+    Args:
+        function (Callable): The `crud` function, taking the session as its first argument.
+        db (Union[Session, AsyncSession]): The database session of the request.
+
+    Returns:
+        Any: The value returned by the function.
+    """
+    session = db.sync_session if isinstance(db, AsyncSession) else db
+    replica = None
+    if getattr(function, "replica_read", False) and not session.info.get("primary"):
+        replica = database.replica_router.choose(session.info.get("min_version", 0))
+    session.info["replica"] = replica
+    try:
+        if isinstance(db, AsyncSession):
+            deferred = session.info["deferred"] = []
+            try:
+                return await db.run_sync(function, *args, **kwargs)
+            finally:
+                del session.info["deferred"]
+                for call in deferred:
+                    await run_in_threadpool(call)
+        return await run_in_threadpool(function, db, *args, **kwargs)
+    finally:
+        session.info["replica"] = None
+        send_sync_version(session)
+
+async def stream_rows(query: Executable) -> AsyncIterator[List[RowMapping]]:
+    """
+    Stream the rows of a query in batches, in a session of its own which stays open until the last batch.
+
+    The query should set the `yield_per` execution option, so the rows are read from a server-side cursor and
+    each batch has that many rows. With an AsyncSession the batches are read on the event loop, otherwise each
+    one is read in the threadpool.
+
+    Args:
+        query (Executable): The query to stream.
+
+    Returns:
+        AsyncIterator[List[RowMapping]]: The batches of rows.
+    """
+    async with session_scope() as db:
+        if isinstance(db, AsyncSession):
+            result = await db.stream(query)
+            async for partition in result.mappings().partitions():
+                yield partition
+        else:
+            result = await run_in_threadpool(db.execute, query)
+            partitions = result.mappings().partitions()
+            while (partition := await run_in_threadpool(next, partitions, None)) is not None:
+                yield partition
@@ -1,18 +1,49 @@
+import asyncio
+import json
+import logging
+import math
+import time
 from os import getenv
-from typing import List, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
 
+import orjson
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from uvicorn import run
 
 ENV_FILE_PATH = getenv("ENV_FILE_PATH")
 load_dotenv(ENV_FILE_PATH)
 
-from db_info import auth, crud, database, init_db, schemas
+from db_info import auth, compression, crud, database, init_db, schemas
+from db_info.cache import CatalogueSnapshot
+from db_info.compression import CompressionMiddleware
+from db_info.idempotency import IdempotencyConflict, idempotency_store
+from db_info.metrics import MetricsMiddleware, registry
+from db_info.profiling import ProfiledRoute, ProfilingMiddleware
+from db_info.rate_limit import rate_limiter
+from db_info.replicas import SYNC_VERSION_HEADER
+from db_info.singleflight import read_flights
+from dependencies.database import get_db, read_routing, run_crud, session_scope, stream_rows
+from services.events import HEARTBEAT, Event, Subscriber, broadcaster
+from services import images
 
-database.Base.metadata.create_all(bind = database.engine)
+POINTS_CACHE_MAX_AGE = int(getenv("POINTS_CACHE_MAX_AGE", "30"))
+# Image variants are identified by their content, so clients can keep them much longer than the point data
+IMAGE_CACHE_MAX_AGE = int(getenv("IMAGE_CACHE_MAX_AGE", "604800"))
+BULK_MAX_ITEMS = int(getenv("BULK_MAX_ITEMS", "1000"))
+BULK_MAX_BYTES = int(getenv("BULK_MAX_BYTES", str(1024 * 1024)))
+# "auto" creates, migrates and seeds the database on startup; "manual" leaves it to `setup_db.py`
+STARTUP_MODE = getenv("STARTUP_MODE", "auto").lower()
+WARM_UP_RETRY_INTERVAL = float(getenv("WARM_UP_RETRY_INTERVAL", "5"))
+SYNC_COMPACTION_INTERVAL = float(getenv("SYNC_COMPACTION_INTERVAL", "3600"))
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title = "Drop-off Points API",
               summary = "Drop-off Points API for UAchado App",
@@ -20,7 +51,9 @@ app = FastAPI(title = "Drop-off Points API",
               version = "1.0.0",
               openapi_url = "/points/v1/openapi.json",
               docs_url="/points/v1/docs",
-              redoc_url="/points/v1/redocs")
+              redoc_url="/points/v1/redocs",
+              default_response_class = ORJSONResponse)
+app.router.route_class = ProfiledRoute
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,41 +61,487 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=[SYNC_VERSION_HEADER],
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(ProfilingMiddleware, authorize = auth.get_claims)
+app.add_middleware(MetricsMiddleware)
 
 ## HELPER FUNCTIONS
 
-def get_db():
+async def get_catalogue() -> CatalogueSnapshot:
     """
-    Get the database session from the SessionLocal object which the API can connect to.
+    Get the snapshot of the points catalogue, loading it from the database only when it is not cached.
 
-    Return:
-        A database session.
+    Concurrent misses share one load instead of each reading the whole table. The load runs on a session of its
+    own rather than on the session of the request which started it, so it can finish for the others even if
+    that request is cancelled.
+
+    Returns:
+        CatalogueSnapshot: The snapshot of every stored point.
+    """
+    snapshot = crud.point_catalogue.current()
+    if snapshot is None:
+        snapshot = await read_flights.do(("catalogue", crud.point_catalogue.generation),
+                                         lambda: load_with_session(crud.load_point_catalogue))
+    return snapshot
+
+def rate_limit(group: str) -> Callable[[Request], Awaitable[None]]:
+    """
+    Build a dependency taking a token from the rate limiter bucket of the client for a group of endpoints.
+
+    Clients are identified by the `sub` of their access token once it was verified, else by their address. The
+    dependency must come before `auth.get_claims`, so that rejected requests don't cost a token verification.
+
+    Args:
+        group (str): The group of endpoints sharing a bucket, e.g. "write".
+
+    Returns:
+        Callable[[Request], Awaitable[None]]: The dependency.
+
+    Raises:
+        HTTPException (HTTP_429_TOO_MANY_REQUESTS): Error raised by the dependency if the bucket is empty, with a Retry-After header.
+    """
+    async def check_rate_limit(request: Request):
+        if not rate_limiter.enabled:
+            return
+        key = f"{group}:{auth.client_identity(request)}"
+        if rate_limiter.blocking:
+            (allowed, retry_after) = await run_in_threadpool(rate_limiter.acquire, key)
+        else:
+            (allowed, retry_after) = rate_limiter.acquire(key)
+        if not allowed:
+            raise HTTPException(status_code = status.HTTP_429_TOO_MANY_REQUESTS, detail = "TOO MANY REQUESTS",
+                                headers = {"Retry-After": str(max(1, math.ceil(retry_after)))})
+    return check_rate_limit
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check whether an If-None-Match header matches an entity tag, using the weak comparison of RFC 9110. The tags
+    of the compressed representations match the tag of the identity one, so a client revalidating either gets a 304.
+
+    Args:
+        if_none_match (Optional[str]): The value of the If-None-Match header, if any.
+        etag (str): The current entity tag of the resource.
+
+    Returns:
+        bool: True if the client copy is current.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = compression.identity_etag(etag)
+    return any(compression.identity_etag(tag) == etag for tag in if_none_match.split(","))
+
+def conditional_response(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """
+    Add the ETag and Cache-Control headers to a read response, and answer 304 if the client copy is current.
+
+    The ETag is derived for the content coding the response is sent with, either its own Content-Encoding or the
+    one `CompressionMiddleware` will apply, so that the 304 carries the tag of the representation the client has.
+
+    Args:
+        request (Request): The request object, possibly with an If-None-Match and an Accept-Encoding header.
+        response (Response): The response the endpoint will return.
+        etag (str): The current entity tag of the resource.
+
+    Returns:
+        Optional[Response]: A 304 Not Modified response, or None if the full response must be sent.
+    """
+    encoding = response.headers.get("Content-Encoding")
+    if encoding is None and len(response.body) >= compression.COMPRESSION_MIN_SIZE and CompressionMiddleware.compressible(response.raw_headers):
+        encoding = compression.negotiate(request.headers.get("Accept-Encoding"))
+    headers = {
+        "ETag": compression.encoded_etag(etag, encoding),
+        "Cache-Control": f"public, max-age={POINTS_CACHE_MAX_AGE}" if POINTS_CACHE_MAX_AGE > 0 else "no-cache",
+    }
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        vary = {"Vary": "Accept-Encoding"} if encoding is not None else {}
+        return Response(status_code = status.HTTP_304_NOT_MODIFIED, headers = {**headers, **vary})
+    response.headers.update(headers)
+    return None
+
+class InvalidItem:
+    """
+    Placeholder for an NDJSON line which isn't valid JSON.
+    """
+
+async def read_bulk_body(request: Request) -> AsyncIterator[bytes]:
+    """
+    Read the body of a bulk request, chunk by chunk, rejecting it as soon as it exceeds BULK_MAX_BYTES, so an
+    oversized body is neither buffered nor parsed.
+
+    Args:
+        request (Request): The request object.
+
+    Raises:
+        HTTPException (HTTP_413_REQUEST_ENTITY_TOO_LARGE): Error raised if the body is larger than BULK_MAX_BYTES.
+
+    Returns:
+        AsyncIterator[bytes]: The chunks of the body.
+    """
+    length = request.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > BULK_MAX_BYTES:
+        raise HTTPException(status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail = "BODY TOO LARGE")
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > BULK_MAX_BYTES:
+            raise HTTPException(status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail = "BODY TOO LARGE")
+        yield chunk
+
+async def read_bulk_items(request: Request) -> List[Any]:
+    """
+    Read the items of a bulk request, sent either as a JSON array or as an NDJSON stream (`application/x-ndjson`).
+
+    NDJSON bodies are parsed line by line as they arrive, so the whole body is never buffered. JSON arrays are
+    parsed once the whole body arrived, which can't be larger than BULK_MAX_BYTES.
+
+    Args:
+        request (Request): The request object.
+
+    Raises:
+        HTTPException (HTTP_413_REQUEST_ENTITY_TOO_LARGE): Error raised if there are more than BULK_MAX_ITEMS items, or the body is larger than BULK_MAX_BYTES.
+        HTTPException (HTTP_422_UNPROCESSABLE_ENTITY): Error raised if a JSON body isn't an array.
+
+    Returns:
+        List[Any]: The decoded items. NDJSON lines which aren't valid JSON are returned as InvalidItem.
+    """
+    if request.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+        items = []
+        buffer = b""
+        async for chunk in read_bulk_body(request):
+            (*lines, buffer) = (buffer + chunk).split(b"\n")
+            for line in lines:
+                if line.strip():
+                    items.append(decode_line(line))
+            if len(items) > BULK_MAX_ITEMS:
+                raise HTTPException(status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail = "TOO MANY ITEMS")
+        if buffer.strip():
+            items.append(decode_line(buffer))
+    else:
+        body = b"".join([chunk async for chunk in read_bulk_body(request)])
+        try:
+            items = orjson.loads(body)
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            raise HTTPException(status_code = status.HTTP_422_UNPROCESSABLE_ENTITY, detail = "EXPECTED A JSON ARRAY")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail = "TOO MANY ITEMS")
+    return items
+
+def decode_line(line: bytes) -> Any:
+    """
+    Decode one NDJSON line.
+
+    Args:
+        line (bytes): The line.
+
+    Returns:
+        Any: The decoded JSON value, or an InvalidItem.
     """
-    db = database.SessionLocal()
     try:
-        yield db
-    finally:
-        db.close()
+        return json.loads(line)
+    except ValueError:
+        return InvalidItem()
+
+async def run_idempotent(request: Request,
+                         idempotency_key: Optional[str],
+                         payload: Any,
+                         status_code: int,
+                         write: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run a write at most once per Idempotency-Key. The key is scoped to the access token subject and the endpoint.
+
+    Args:
+        request (Request): The request object, with the verified claims in its state.
+        idempotency_key (Optional[str]): The Idempotency-Key header. Without it the write always runs.
+        payload (Any): The JSON-serializable payload of the write, compared on retries.
+        status_code (int): The status code of a successful write.
+        write (Callable[[], Awaitable[Any]]): Runs the write and returns its response body.
+
+    Raises:
+        HTTPException (HTTP_409_CONFLICT): Error raised if the first request with that key is still running.
+        HTTPException (HTTP_422_UNPROCESSABLE_ENTITY): Error raised if the key was used with another payload.
+
+    Returns:
+        Any: The response body of the write, or a replay of the response of the first request.
+    """
+    if idempotency_key is None:
+        return await write()
+    claims = getattr(request.state, "claims", None) or {}
+    key = f"{claims.get('sub')}:{request.method}:{request.url.path}:{idempotency_key}"
+    fingerprint = idempotency_store.fingerprint(payload)
+    try:
+        replay = idempotency_store.begin(key, fingerprint)
+    except IdempotencyConflict as conflict:
+        if conflict.in_flight:
+            raise HTTPException(status_code = status.HTTP_409_CONFLICT, detail = "REQUEST IN PROGRESS")
+        raise HTTPException(status_code = status.HTTP_422_UNPROCESSABLE_ENTITY, detail = "IDEMPOTENCY KEY REUSED")
+    if replay is not None:
+        return JSONResponse(replay[1], status_code = replay[0], headers = {"Idempotent-Replayed": "true"})
+    try:
+        body = await write()
+    except HTTPException as error:
+        if error.status_code >= 500:
+            idempotency_store.release(key)
+            raise
+        idempotency_store.complete(key, fingerprint, error.status_code, {"detail": error.detail})
+        raise
+    except BaseException:
+        idempotency_store.release(key)
+        raise
+    idempotency_store.complete(key, fingerprint, status_code, jsonable_encoder(body))
+    return body
+
+def cache_samples(field: str) -> List[tuple]:
+    """
+    Read one counter of every in-memory cache, for the metrics endpoint.
+
+    Args:
+        field (str): "hits", "misses" or "hit_ratio".
+
+    Returns:
+        List[tuple]: One (labels, value) pair per cache.
+    """
+    token_lookups = auth.token_cache.hits + auth.token_cache.misses
+    token_stats = {"hits": auth.token_cache.hits, "misses": auth.token_cache.misses,
+                   "hit_ratio": auth.token_cache.hits / token_lookups if token_lookups else 0.0}
+    return [({"cache": "catalogue"}, crud.point_catalogue.stats()[field]),
+            ({"cache": "authorizations"}, crud.authorization_map.stats()[field]),
+            ({"cache": "tokens"}, token_stats[field])]
+
+registry.callback("cache_hits", "Lookups served by an in-memory cache.", "counter", lambda: cache_samples("hits"))
+registry.callback("cache_misses", "Lookups missed by an in-memory cache.", "counter", lambda: cache_samples("misses"))
+registry.callback("cache_hit_ratio", "Share of the lookups served by an in-memory cache.", "gauge", lambda: cache_samples("hit_ratio"))
+for (gauge, documentation) in (("size", "Connections kept open by the pool."),
+                               ("checkedin", "Idle connections in the pool."),
+                               ("checkedout", "Connections in use."),
+                               ("overflow", "Connections opened beyond the pool size.")):
+    registry.callback(f"db_pool_{gauge}", documentation, "gauge",
+                      lambda gauge = gauge: [({}, database.get_pool_status().get(gauge))])
+for (counter, documentation) in (("checkouts", "Connections handed out by the pool."),
+                                 ("timeouts", "Checkouts which gave up waiting for a connection."),
+                                 ("overflow_hits", "Checkouts served beyond the pool size.")):
+    registry.callback(f"db_pool_{counter}", documentation, "counter",
+                      lambda counter = counter: [({}, database.get_pool_status()[counter])])
+registry.callback("db_pool_wait_seconds", "Time spent waiting for a connection.", "counter",
+                  lambda: [({}, database.get_pool_status()["wait_seconds_total"])])
+registry.callback("rate_limit_decisions", "Requests checked by the rate limiter, by decision.", "counter",
+                  lambda: [({"decision": "allowed"}, rate_limiter.allowed), ({"decision": "limited"}, rate_limiter.limited)])
+registry.callback("stream_subscribers", "Clients connected to the change streams.", "gauge",
+                  lambda: [({}, len(broadcaster.subscribers))])
+registry.callback("stream_dropped_subscribers", "Stream clients disconnected for falling behind.", "counter",
+                  lambda: [({}, broadcaster.dropped)])
+registry.callback("replica_reads", "Database reads sent to a read replica, by replica.", "counter",
+                  lambda: [({"replica": replica.url}, replica.reads) for replica in database.replica_router.replicas])
+registry.callback("replica_fallbacks", "Replica reads sent to the primary for lack of a healthy replica.", "counter",
+                  lambda: [({}, database.replica_router.fallbacks)])
+registry.callback("coalesced_reads", "Database reads, by whether they ran or shared an identical read in flight.", "counter",
+                  lambda: [({"role": "leader"}, read_flights.leaders), ({"role": "follower"}, read_flights.followers)])
 
 ## INIT DB
 
+warm_up_state = {"ready": False, "components": {}}
+
+async def initialize_database():
+    """
+    Create, migrate and seed the database. Only used with STARTUP_MODE=auto; with STARTUP_MODE=manual this is
+    done once per deployment by `setup_db.py`, so that the replicas don't race to run DDL.
+
+    Return:
+        None
+    """
+    await run_in_threadpool(init_db.create_schema, database.engine)
+    if database.ASYNC_MODE:
+        await init_db.create_async_schema(database.async_engine)
+    async with session_scope() as db:
+        await run_crud(init_db.seed, db)
+
+async def warm_up_component(name: str, warm_up: Callable[[], Awaitable[Any]]) -> bool:
+    """
+    Warm up one component, recording its outcome and duration in the warm-up state.
+
+    Args:
+        name (str): The name of the component.
+        warm_up (Callable[[], Awaitable[Any]]): Warms the component up.
+
+    Returns:
+        bool: True if the component was warmed up.
+    """
+    start = time.perf_counter()
+    try:
+        await warm_up()
+    except Exception as error:
+        warm_up_state["components"][name] = {"ready": False, "error": repr(error)}
+        return False
+    warm_up_state["components"][name] = {"ready": True, "seconds": round(time.perf_counter() - start, 4)}
+    return True
+
+async def load_with_session(function: Callable, *args, routing: Tuple[bool, int] = (False, 0)) -> Any:
+    """
+    Run a `crud` function on a session of its own, so that several loads can run concurrently, and a load shared
+    by several requests doesn't depend on the session of any of them.
+
+    Args:
+        function (Callable): The `crud` function, taking the session as its first argument.
+        routing (Tuple[bool, int]): Where its reads may go, as returned by `read_routing`. Defaults to any healthy replica.
+
+    Returns:
+        Any: The value returned by the function.
+    """
+    async with session_scope(routing) as db:
+        return await run_crud(function, db, *args)
+
+async def warm_up():
+    """
+    Prepare the replica to serve traffic, then mark it ready.
+
+    The connection pool, the points catalogue, the authorization map and the issuer signing keys are loaded
+    concurrently, after the schema is created with STARTUP_MODE=auto. The database components are retried every
+    WARM_UP_RETRY_INTERVAL seconds until they succeed. The signing keys are fetched once and not retried, since
+    they are still fetched on the first request and by the background refresh.
+
+    Return:
+        None
+    """
+    if STARTUP_MODE == "auto":
+        while not await warm_up_component("schema", initialize_database):
+            await asyncio.sleep(WARM_UP_RETRY_INTERVAL)
+    jwks = None
+    if getenv("COGNITO_ISSUER"):
+        jwks = asyncio.create_task(warm_up_component("jwks", lambda: run_in_threadpool(auth.key_store.refresh)))
+    
+    pending = {
+        "pool": database.async_warm_up_pool if database.ASYNC_MODE else lambda: run_in_threadpool(database.warm_up_pool),
+        "catalogue": lambda: load_with_session(crud.load_point_catalogue),
+        "authorizations": lambda: load_with_session(crud.load_authorizations),
+    }
+    while True:
+        results = await asyncio.gather(*[warm_up_component(name, component) for (name, component) in pending.items()])
+        pending = {name: component for ((name, component), ready) in zip(pending.items(), results) if not ready}
+        if not pending:
+            break
+        await asyncio.sleep(WARM_UP_RETRY_INTERVAL)
+    if jwks is not None:
+        await jwks
+    warm_up_state["ready"] = True
+    if getenv("COGNITO_ISSUER"):
+        auth.key_store.start_background_refresh()
+
+async def compact_tombstones_periodically():
+    """
+    Remove the tombstones older than SYNC_TOMBSTONE_HORIZON every SYNC_COMPACTION_INTERVAL seconds. Failures are
+    logged and retried on the next run.
+
+    Return:
+        None
+    """
+    while True:
+        await asyncio.sleep(SYNC_COMPACTION_INTERVAL)
+        try:
+            await load_with_session(crud.compact_tombstones)
+        except Exception:
+            logger.exception("Tombstone compaction failed, retrying in %s seconds", SYNC_COMPACTION_INTERVAL)
+
+def changes_event(changes: Optional[dict]) -> Event:
+    """
+    Build the stream event of a sync.
+
+    Args:
+        changes (Optional[dict]): The result of `crud.get_changes`, or None if the client must sync fully again.
+
+    Returns:
+        Event: A `changes` event identified by the new sync version, or a `resync` event.
+    """
+    if changes is None:
+        return Event("resync", {"reason": "sync version expired"})
+    data = schemas.PointChanges.model_validate(changes).model_dump(mode = "json")
+    return Event("changes", data, id = changes["version"])
+
+async def publish_changes():
+    """
+    Publish the changes of the points to the stream clients every time the catalogue changes, on this replica or
+    another one. Each change is read once from the database, whatever the number of clients, and changes made
+    while the previous one was read are published together. Changes of the authorizations only are skipped.
+    Failures are logged, and the clients are told to resync on the next change, since the changes in between
+    are unknown.
+
+    Return:
+        None
+    """
+    # The sync state can be read once the schema exists and the replica is warm
+    await asyncio.wait([app.state.warm_up])
+    try:
+        (since, _) = await load_with_session(crud.get_sync_state)
+    except Exception:
+        logger.exception("Reading the sync state failed, the stream clients will resync on the next change")
+        since = None
+    while True:
+        await broadcaster.wait_for_change()
+        try:
+            if since is None:
+                # The version before the change is unknown, e.g. the schema didn't exist yet on startup
+                (since, _) = await load_with_session(crud.get_sync_state)
+                broadcaster.publish(Event("changed", {"version": since}, id = since))
+                continue
+            changes = await load_with_session(lambda db: crud.get_changes(db, since, delta = True))
+            if changes is None or changes["version"] != since:
+                broadcaster.publish(changes_event(changes))
+                since = None if changes is None else changes["version"]
+        except Exception:
+            logger.exception("Publishing the point changes failed, the stream clients will resync on the next change")
+            since = None
+
+crud.invalidation_bus.subscribe(lambda version: broadcaster.signal())
+
 @app.on_event("startup")
 async def startup_event():
     """
     Startup Event
 
-    This method is an event handler for the "startup" event. It initializes the database if there are no items in it.
+    This method is an event handler for the "startup" event. It starts listening for catalogue changes made by
+    other replicas and checking the read replicas of the database, and warms the replica up in the background, so that the liveness probe answers right away
+    while the readiness probe waits for the warm-up to finish. It also starts the periodic tombstone compaction
+    and the publication of the changes to the stream clients.
 
     Return:
         None
     """
-    db = database.SessionLocal()
-    try:
-        if crud.get_points(db) == []:
-            init_db.init(db)
-    finally:
-        db.close()
+    warm_up_state.update(ready = False, components = {})
+    broadcaster.start()
+    crud.invalidation_bus.start()
+    crud.authorization_bus.start()
+    database.replica_router.start_health_checks()
+    app.state.warm_up = asyncio.create_task(warm_up())
+    app.state.change_feed = asyncio.create_task(publish_changes())
+    app.state.compaction = asyncio.create_task(compact_tombstones_periodically()) if SYNC_COMPACTION_INTERVAL > 0 else None
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Shutdown Event
+
+    This method is an event handler for the "shutdown" event. It stops the warm-up if still running, the
+    tombstone compaction, the background refresh of the signing keys, the invalidation listener and the read
+    replica checks, ends the change streams, and closes the connections of the async engine.
+
+    Return:
+        None
+    """
+    app.state.warm_up.cancel()
+    if app.state.compaction is not None:
+        app.state.compaction.cancel()
+    app.state.change_feed.cancel()
+    broadcaster.stop()
+    auth.key_store.stop_background_refresh()
+    crud.invalidation_bus.stop()
+    crud.authorization_bus.stop()
+    database.replica_router.stop_health_checks()
+    if database.ASYNC_MODE:
+        await database.async_engine.dispose()
 
 ## ENDPOINTS
 
@@ -71,7 +550,7 @@ async def startup_event():
          response_model = dict,
          tags = ["Points"],
          status_code = status.HTTP_200_OK)
-def base() -> dict:
+async def base() -> dict:
     """
     Root endpoint of the dropoff points API. Mostly used for testing API connectivity.
 
@@ -80,34 +559,448 @@ def base() -> dict:
     """
     return {"response": "Hello World!"}
 
+@app.get("/points/v1/health/live",
+         response_description = "Check that the service is running.",
+         response_model = dict,
+         tags = ["Health"],
+         status_code = status.HTTP_200_OK)
+async def liveness() -> dict:
+    """
+    Liveness probe. It answers as soon as the service accepts requests, even while warming up.
+
+    Returns:
+        dict: A dictionary containing the status of the service.
+    """
+    return {"status": "alive"}
+
+@app.get("/points/v1/health/ready",
+         response_description = "Check that the service is warmed up and can serve traffic.",
+         response_model = dict,
+         tags = ["Health"],
+         status_code = status.HTTP_200_OK,
+         responses = {status.HTTP_503_SERVICE_UNAVAILABLE: {"description": "The service is still warming up."}})
+async def readiness():
+    """
+    Readiness probe. It answers 503 until the warm-up finishes, so that traffic is only routed to warm replicas.
+
+    Returns:
+        dict: A dictionary containing the status of the service and the outcome of the warm-up of each component.
+    """
+    if not warm_up_state["ready"]:
+        return JSONResponse({"status": "warming up", "components": warm_up_state["components"]},
+                            status_code = status.HTTP_503_SERVICE_UNAVAILABLE)
+    return {"status": "ready", "components": warm_up_state["components"]}
+
 @app.get("/points/v1/points",
          response_description = "Get the list of existing points.",
          response_model = List[schemas.Point],
          tags = ["Points"],
          status_code = status.HTTP_200_OK)
-def get_all_points(db: Session = Depends(get_db)) -> List[schemas.Point]:
+async def get_all_points(request: Request,
+                         limit: Optional[int] = Query(None, ge = 1, le = 1000, description = "Maximum number of points to return."),
+                         offset: int = Query(0, ge = 0, description = "Number of points to skip."),
+                         after_id: Optional[int] = Query(None, description = "Keyset cursor: only return points with a greater id."),
+                         fields: Optional[str] = Query(None, description = "Comma separated fields to return, e.g. `id,name,coordinates`."),
+                         db: Session = Depends(get_db)) -> List[schemas.Point]:
     """
     Get the list of existing points.
 
+    Without parameters the whole list is served from the in-memory catalogue snapshot, as JSON encoded once per
+    snapshot and with an ETag computed from it, and a 304 Not Modified is answered when the client copy is current. With `limit`, `offset`,
+    `after_id` or `fields` the page is queried from the database, selecting only the requested columns. When the
+    page is full, the cursor of the next page is sent in the X-Next-Cursor header and in a `rel="next"` Link header.
+
     Args:
+        request (Request): The request object, possibly with an If-None-Match header.
+        limit (Optional[int]): Maximum number of points to return.
+        offset (int): Number of points to skip.
+        after_id (Optional[int]): Keyset cursor: only return points with a greater id.
+        fields (Optional[str]): Comma separated fields to return.
         db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
 
+    Raises:
+        HTTPException (HTTP_422_UNPROCESSABLE_ENTITY): Error raised if an unknown field is requested.
+
     Returns:
         List[schemas.Point]: A list of existing points.
     """    
-    return crud.get_points(db)
+    if limit is None and offset == 0 and after_id is None and fields is None:
+        catalogue = await get_catalogue()
+        # The snapshot keeps its JSON encoding, so the list is neither validated nor serialized again
+        encoded_response = Response(content = catalogue.encoded, media_type = "application/json")
+        # and large lists are compressed once per snapshot rather than by the middleware on every request
+        encoding = compression.negotiate(request.headers.get("Accept-Encoding"))
+        if encoding is not None and len(catalogue.encoded) >= compression.COMPRESSION_MIN_SIZE:
+            encoded_response = Response(content = catalogue.compressed(encoding), media_type = "application/json",
+                                        headers = {"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+        return conditional_response(request, encoded_response, catalogue.etag) or encoded_response
+    
+    field_names = [field.strip() for field in fields.split(",") if field.strip()] if fields else list(crud.POINT_FIELDS)
+    if any(field not in crud.POINT_FIELDS for field in field_names):
+        raise HTTPException(status_code = status.HTTP_422_UNPROCESSABLE_ENTITY, detail = "UNKNOWN FIELD")
+    points = await run_crud(crud.get_points_page, db, limit = limit, offset = offset, after_id = after_id, fields = field_names)
+    
+    headers = {}
+    if limit is not None and len(points) == limit:
+        next_cursor = points[-1]["id"]
+        next_url = request.url.remove_query_params("offset").include_query_params(after_id = next_cursor)
+        headers = {"X-Next-Cursor": str(next_cursor), "Link": f'<{next_url}>; rel="next"'}
+    if "id" not in field_names:
+        points = [{field: point[field] for field in field_names} for point in points]
+    return ORJSONResponse(points, headers = headers)
+
+async def encode_export(partitions: AsyncIterator[list], ndjson: bool) -> AsyncIterator[bytes]:
+    """
+    Encode streamed batches of points as NDJSON lines, or as the items of one JSON array.
+
+    Args:
+        partitions (AsyncIterator[list]): The batches of rows, as mappings.
+        ndjson (bool): Whether to write one JSON document per line instead of a JSON array.
+
+    Returns:
+        AsyncIterator[bytes]: One chunk per batch.
+    """
+    if not ndjson:
+        yield b"["
+    separator = b""
+    async for partition in partitions:
+        if not partition:
+            continue
+        if ndjson:
+            yield b"".join(orjson.dumps(dict(row)) + b"\n" for row in partition)
+        else:
+            yield separator + b",".join(orjson.dumps(dict(row)) for row in partition)
+            separator = b","
+    if not ndjson:
+        yield b"]"
+
+@app.get("/points/v1/points/export",
+         response_description = "Stream every existing point.",
+         response_model = List[schemas.Point],
+         responses = {status.HTTP_200_OK: {"content": {"application/x-ndjson": {}}}},
+         tags = ["Points"],
+         status_code = status.HTTP_200_OK)
+async def export_points(format: str = Query("json", pattern = "^(json|ndjson)$", description = "`json` for a JSON array, `ndjson` for one point per line."),
+                        batch_size: int = Query(crud.EXPORT_BATCH_SIZE, ge = 1, le = 10000, description = "Number of rows read from the database at a time.")) -> StreamingResponse:
+    """
+    Stream every existing point, in id order, straight from the database.
+
+    The rows are read from a server-side cursor in batches and each batch is sent as soon as it is encoded, so the
+    memory used stays flat and the first bytes go out before the whole table is read. Large exports should be
+    taken from here rather than from `GET /points/v1/points`, which builds the whole list in memory.
+
+    Args:
+        format (str): `json` for a JSON array, `ndjson` for one point per line. Defaults to `json`.
+        batch_size (int): Number of rows read from the database at a time.
+
+    Returns:
+        StreamingResponse: The points.
+    """
+    ndjson = format == "ndjson"
+    partitions = stream_rows(crud.get_points_stream_query(batch_size))
+    return StreamingResponse(encode_export(partitions, ndjson),
+                             media_type = "application/x-ndjson" if ndjson else "application/json")
+
+@app.get("/points/v1/points/nearest",
+         response_description = "Get the drop-off points closest to a location.",
+         response_model = List[schemas.PointDistance],
+         tags = ["Points"],
+         status_code = status.HTTP_200_OK)
+async def get_nearest_points(lat: float = Query(..., ge = -90, le = 90, description = "Latitude of the location."),
+                             lon: float = Query(..., ge = -180, le = 180, description = "Longitude of the location."),
+                             k: int = Query(5, ge = 1, le = 100, description = "Maximum number of points to return."),
+                             radius: Optional[float] = Query(None, gt = 0, description = "Maximum distance, in kilometres."),
+                             db: Session = Depends(get_db)) -> List[schemas.PointDistance]:
+    """
+    Get the drop-off points closest to a location, closest first, with their great-circle distance.
+
+    The points are found with the spatial index of the in-memory catalogue snapshot. When the snapshot cache is
+    disabled they are found in the database, prefiltering by bounding box when a radius is given.
+
+    Args:
+        lat (float): Latitude of the location.
+        lon (float): Longitude of the location.
+        k (int): Maximum number of points to return. Defaults to 5.
+        radius (Optional[float]): Maximum distance, in kilometres.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Returns:
+        List[schemas.PointDistance]: The closest points and their distance.
+    """
+    if crud.point_catalogue.ttl > 0:
+        nearest = (await get_catalogue()).geo_index.nearest(lat, lon, k, radius)
+    else:
+        nearest = await run_crud(crud.get_nearest_points, db, lat, lon, k, radius)
+    return [schemas.PointDistance(**schemas.Point.model_validate(point, from_attributes = True).model_dump(), distance_km = distance)
+            for (distance, point) in nearest]
+
+@app.get("/points/v1/points/search",
+         response_description = "Search the drop-off points by name or location.",
+         response_model = List[schemas.Point],
+         tags = ["Points"],
+         status_code = status.HTTP_200_OK)
+async def search_points(q: str = Query(..., min_length = 1, max_length = 100, description = "The text typed by the user."),
+                        limit: int = Query(10, ge = 1, le = 100, description = "Maximum number of points to return."),
+                        db: Session = Depends(get_db)) -> List[schemas.Point]:
+    """
+    Search the drop-off points whose name or location has words starting with the words of the query, ignoring
+    accents and case, e.g. `pavilhao` finds "Pavilhão Aristides Hall". Meant for type-ahead, so clients don't need
+    the whole list of points.
+
+    The points are found with the search index of the in-memory catalogue snapshot, names starting with the
+    query first. When the snapshot cache is disabled they are found with the full-text index of the database.
+
+    Args:
+        q (str): The text typed by the user.
+        limit (int): Maximum number of points to return. Defaults to 10.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Returns:
+        List[schemas.Point]: The matching points, best first.
+    """
+    if crud.point_catalogue.ttl > 0:
+        return (await get_catalogue()).search_index.search(q, limit)
+    return await run_crud(crud.search_points, db, q, limit)
+
+@app.get("/points/v1/points/version",
+         response_description = "Get the current version of the points catalogue.",
+         response_model = dict,
+         tags = ["Points"],
+         status_code = status.HTTP_200_OK)
+async def get_catalogue_version() -> dict:
+    """
+    Get the current version of the points catalogue. It is increased every time a point is created or deleted,
+    by any replica, so clients can tell whether their copy of the points is current.
+
+    Returns:
+        dict: A dictionary containing the catalogue version.
+    """
+    return {"version": await run_in_threadpool(crud.invalidation_bus.current_version)}
+
+@app.get("/points/v1/points/changes",
+         response_description = "Get the changes of the points since a sync version.",
+         response_model = schemas.PointChanges,
+         tags = ["Points"],
+         status_code = status.HTTP_200_OK)
+async def get_point_changes(since: int = Query(0, ge = 0, description = "The `version` of the previous sync, or 0 for a full sync."),
+                            db: Session = Depends(get_db)) -> schemas.PointChanges:
+    """
+    Get the points created, changed and deleted since a sync version, so that clients keeping a copy of the points,
+    e.g. offline, only download what changed. Clients store the returned `version` and send it as `since` on their
+    next sync, remove the `deleted` points and then apply the `points`.
+
+    Args:
+        since (int): The version of the previous sync, or 0 for a full sync. Defaults to 0.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException (HTTP_410_GONE): Error raised if the deletions since that version were compacted, or if the version is unknown. The client must sync fully again, with `since=0`.
+
+    Returns:
+        schemas.PointChanges: The current version and the changes.
+    """
+    changes = await run_crud(crud.get_changes, db, since)
+    if changes is None:
+        raise HTTPException(status_code = status.HTTP_410_GONE, detail = "SYNC VERSION EXPIRED")
+    return changes
+
+async def catch_up(since: Optional[int]) -> Optional[Event]:
+    """
+    Get the first event of a stream client which resumes from a sync version.
+
+    Args:
+        since (Optional[int]): The sync version the client is at, or None to only receive the new changes.
+
+    Returns:
+        Optional[Event]: The changes since that version, or a `resync` event if it expired.
+    """
+    if since is None:
+        return None
+    return changes_event(await load_with_session(lambda db: crud.get_changes(db, since)))
+
+async def encode_events(subscriber: Subscriber, first: Optional[Event]) -> AsyncIterator[bytes]:
+    """
+    Encode the events of a stream client as Server-Sent Events, and heartbeats as comments.
+
+    Args:
+        subscriber (Subscriber): The subscription of the client.
+        first (Optional[Event]): An event to send before the others.
+
+    Returns:
+        AsyncIterator[bytes]: One frame per event.
+    """
+    try:
+        if first is not None:
+            yield first.sse
+            if first.type == "resync":
+                return
+        async for event in broadcaster.events(subscriber):
+            yield b": heartbeat\n\n" if event is HEARTBEAT else event.sse
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+@app.get("/points/v1/points/stream",
+         response_description = "Stream the changes of the points as Server-Sent Events.",
+         response_class = StreamingResponse,
+         responses = {status.HTTP_200_OK: {"content": {"text/event-stream": {}}}},
+         tags = ["Points"],
+         status_code = status.HTTP_200_OK)
+async def stream_point_changes(since: Optional[int] = Query(None, ge = 0, description = "The `version` of the previous sync, to first receive the changes since then."),
+                               last_event_id: Optional[int] = Header(None, ge = 0, description = "Set by browsers when they reconnect. Takes precedence over `since`.")) -> StreamingResponse:
+    """
+    Stream the changes of the points as Server-Sent Events, as they are committed, instead of polling
+    `GET /points/v1/points/changes`.
+
+    Every `changes` event has the same data as `GET /points/v1/points/changes` and the new sync version as its id,
+    so browsers resume from the last event they received when they reconnect. A `changed` event only carries the
+    new version, when the changes could not be read; clients then sync with `GET /points/v1/points/changes`. A
+    `resync` event ends the stream: the version expired, or the client read too slowly and was dropped. Clients
+    then sync again and reconnect. A heartbeat comment is sent when there were no events for
+    STREAM_HEARTBEAT_INTERVAL seconds.
+
+    Args:
+        since (Optional[int]): The version of the previous sync, to first receive the changes since then.
+        last_event_id (Optional[int]): The id of the last event received, sent by browsers when they reconnect.
+
+    Returns:
+        StreamingResponse: The event stream.
+    """
+    # Subscribed before catching up, so that no change committed meanwhile is missed
+    subscriber = broadcaster.subscribe()
+    try:
+        first = await catch_up(last_event_id if last_event_id is not None else since)
+    except BaseException:
+        broadcaster.unsubscribe(subscriber)
+        raise
+    return StreamingResponse(encode_events(subscriber, first),
+                             media_type = "text/event-stream",
+                             headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/points/v1/points/ws")
+async def stream_point_changes_ws(websocket: WebSocket,
+                                  since: Optional[int] = Query(None, ge = 0, description = "The `version` of the previous sync, to first receive the changes since then.")):
+    """
+    Stream the changes of the points over a WebSocket. Each message is a JSON object with the `type`, `id` and
+    `data` of the events of `GET /points/v1/points/stream`, heartbeats included. The server closes the socket
+    after a `resync` event.
+
+    Args:
+        websocket (WebSocket): The connection.
+        since (Optional[int]): The version of the previous sync, to first receive the changes since then.
+
+    Return:
+        None
+    """
+    await websocket.accept()
+    subscriber = broadcaster.subscribe()
+    try:
+        first = await catch_up(since)
+        if first is not None:
+            await websocket.send_text(first.json)
+        if first is None or first.type != "resync":
+            async for event in broadcaster.events(subscriber):
+                await websocket.send_text(event.json)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+async def get_points_batch(batch: schemas.PointBatch, db: Session) -> dict:
+    """
+    Resolve the points of a batch request, from the in-memory catalogue snapshot, or with a single query when
+    the snapshot cache is disabled.
+
+    Args:
+        batch (schemas.PointBatch): The requested names and ids.
+        db (Session): The database session object.
+
+    Raises:
+        HTTPException (HTTP_413_REQUEST_ENTITY_TOO_LARGE): Error raised if there are more than BULK_MAX_ITEMS names and ids.
+
+    Returns:
+        dict: The point of each requested name and id, None if there is none, and the names and ids without a point.
+    """
+    if len(batch.names) + len(batch.ids) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail = "TOO MANY ITEMS")
+    if crud.point_catalogue.ttl > 0:
+        catalogue = await get_catalogue()
+        (by_name, by_id) = (catalogue.by_name, catalogue.by_id)
+    else:
+        points = await run_crud(crud.get_points_by_keys, db, batch.names, batch.ids)
+        (by_name, by_id) = ({point.name: point for point in points}, {point.id: point for point in points})
+    names = {name: by_name.get(name) for name in batch.names}
+    ids = {point_id: by_id.get(point_id) for point_id in batch.ids}
+    return {
+        "names": names,
+        "ids": ids,
+        "missing": {"names": [name for (name, point) in names.items() if point is None],
+                    "ids": [point_id for (point_id, point) in ids.items() if point is None]},
+    }
+
+@app.get("/points/v1/points/batch",
+         response_description = "Get many points by name or id in a single request.",
+         response_model = schemas.PointBatchResult,
+         tags = ["Points"],
+         status_code = status.HTTP_200_OK)
+async def get_points_by_keys(names: List[str] = Query([], description = "Names of the points, repeated, e.g. `names=CP&names=DETI`."),
+                             ids: List[int] = Query([], description = "Ids of the points, repeated, e.g. `ids=1&ids=2`."),
+                             db: Session = Depends(get_db)) -> schemas.PointBatchResult:
+    """
+    Get many points by name or id in a single request, instead of one `GET /points/v1/points/name/{point_name}`
+    per point. Long lists should be sent to `POST /points/v1/points/batch` instead.
+
+    Args:
+        names (List[str]): Names of the points.
+        ids (List[int]): Ids of the points.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException (HTTP_413_REQUEST_ENTITY_TOO_LARGE): Error raised if there are more than BULK_MAX_ITEMS names and ids.
+
+    Returns:
+        schemas.PointBatchResult: The point of each requested name and id, null if there is none, and the names and ids without a point.
+    """
+    return await get_points_batch(schemas.PointBatch(names = names, ids = ids), db)
+
+@app.post("/points/v1/points/batch",
+          response_description = "Get many points by name or id in a single request.",
+          response_model = schemas.PointBatchResult,
+          tags = ["Points"],
+          status_code = status.HTTP_200_OK)
+async def post_points_by_keys(batch: schemas.PointBatch,
+                              db: Session = Depends(get_db)) -> schemas.PointBatchResult:
+    """
+    Get many points by name or id in a single request, with the names and ids in the body, for lists too long
+    for a URL. It only reads, so it requires no access token.
+
+    Args:
+        batch (schemas.PointBatch): The names and ids of the points.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException (HTTP_413_REQUEST_ENTITY_TOO_LARGE): Error raised if there are more than BULK_MAX_ITEMS names and ids.
+
+    Returns:
+        schemas.PointBatchResult: The point of each requested name and id, null if there is none, and the names and ids without a point.
+    """
+    return await get_points_batch(batch, db)
 
 @app.get("/points/v1/points/name/{point_name}",
          response_description = "Get a specific point by its name.",
          response_model = schemas.Point,
          tags = ["Points"],
          status_code = status.HTTP_200_OK)
-def get_point(point_name: str,
-              db: Session = Depends(get_db)) -> schemas.Point:
+async def get_point(request: Request,
+                    point_name: str,
+                    db: Session = Depends(get_db)) -> schemas.Point:
     """
-    Get a specific point by its name.
+    Get a specific point by its name. The point is served from the in-memory catalogue snapshot, as cached JSON
+    with an ETag computed from it, and a 304 Not Modified is answered when the client copy is current. When the
+    snapshot cache is disabled the point is queried, and identical concurrent reads share one query.
 
     Args:
+        request (Request): The request object, possibly with an If-None-Match header.
         point_name (str): The name attribute of a specify unique point.
         db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
 
@@ -117,60 +1010,228 @@ def get_point(point_name: str,
     Returns:
         schemas.Point: The stored point.
     """
-    point = crud.get_point_by_name(db = db, name = point_name)
+    if crud.point_catalogue.ttl <= 0:
+        # Only reads routed the same way are shared, so a client never gets a replica read older than its writes
+        routing = read_routing(db)
+        point = await read_flights.do(("point", point_name, routing),
+                                      lambda: load_with_session(crud.get_point_by_name, point_name, routing = routing))
+        if not point:
+            raise HTTPException(status_code = status.HTTP_204_NO_CONTENT, detail = "POINT NOT FOUND")
+        encoded = schemas.Point.model_validate(point).model_dump_json().encode()
+        encoded_response = Response(content = encoded, media_type = "application/json")
+        return conditional_response(request, encoded_response, CatalogueSnapshot.bytes_tag(encoded)) or encoded_response
+
+    catalogue = await get_catalogue()
+    point = catalogue.by_name.get(point_name)
     if not point:
         raise HTTPException(status_code = status.HTTP_204_NO_CONTENT, detail = "POINT NOT FOUND")
-    return point
+    encoded_response = Response(content = catalogue.point_encoded(point_name), media_type = "application/json")
+    return conditional_response(request, encoded_response, catalogue.point_etag(point_name)) or encoded_response
+
+@app.get("/points/v1/points/{point_id}/image",
+         response_description = "Get the image of a point, resized.",
+         response_class = Response,
+         responses = {status.HTTP_200_OK: {"content": {"image/jpeg": {}, "image/png": {}}}},
+         tags = ["Points"],
+         status_code = status.HTTP_200_OK)
+async def get_point_image(request: Request,
+                          point_id: int,
+                          w: Optional[int] = Query(None, ge = 1, le = 4096, description = "Width of the image, rounded up to the next available size.")) -> Response:
+    """
+    Get the image of a point, scaled down to a width. Instead of every client downloading the full-size image from
+    its host, the source is fetched once and each size is generated once, off the event loop, and kept in a bounded
+    disk cache. Responses carry an ETag computed from their content and can be cached by clients.
+
+    Args:
+        request (Request): The request object, possibly with an If-None-Match header.
+        point_id (int): The id of the point.
+        w (Optional[int]): Width of the image. Defaults to the largest available size.
+
+    Raises:
+        HTTPException (HTTP_204_NO_CONTENT): Error raised if there's no stored point with that id, or if it has no image.
+        HTTPException (HTTP_502_BAD_GATEWAY): Error raised if the image can't be fetched from its host or decoded.
+
+    Returns:
+        Response: The image, as JPEG or PNG.
+    """
+    point = (await get_catalogue()).by_id.get(point_id)
+    if not point:
+        raise HTTPException(status_code = status.HTTP_204_NO_CONTENT, detail = "POINT NOT FOUND")
+    if not point.image:
+        raise HTTPException(status_code = status.HTTP_204_NO_CONTENT, detail = "IMAGE NOT FOUND")
+    try:
+        (image, content) = await images.image_service.get(point.image, w)
+    except images.ImageError:
+        raise HTTPException(status_code = status.HTTP_502_BAD_GATEWAY, detail = "ERROR: Error fetching image")
+    image_response = Response(content = content, media_type = image.media_type)
+    response = conditional_response(request, image_response, f'"{image.digest}"') or image_response
+    response.headers["Cache-Control"] = f"public, max-age={IMAGE_CACHE_MAX_AGE}"
+    return response
 
 @app.post("/points/v1/points",
           response_description = "Create a new point.",
           response_model = schemas.Point,
           tags = ["Points"],
-          status_code = status.HTTP_201_CREATED)
-def create_point(request: Request,
-                 point: schemas.PointCreate,
-                 db: Session = Depends(get_db)) -> schemas.Point:
+          status_code = status.HTTP_201_CREATED,
+          dependencies = [Depends(rate_limit("write")), Depends(auth.get_claims)])
+async def create_point(request: Request,
+                       point: schemas.PointCreate,
+                       idempotency_key: Optional[str] = Header(None, max_length = 255, description = "Key making retries of this create safe."),
+                       db: Session = Depends(get_db)) -> schemas.Point:
     """
-    Create a new point.
+    Create a new point. Requires a valid access token.
+
+    The point is inserted with a single statement, and a point whose name or coordinates are already registered,
+    even by a concurrent request, is answered with 409. A retry sent with the same Idempotency-Key and payload
+    is answered with the response of the first request.
 
     Args:
-        request (Request): The request object containing information about the request.
+        request (Request): The request object.
         point (schemas.PointCreate): The payload data to create a new point.
+        idempotency_key (Optional[str]): The Idempotency-Key header, if any.
         db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
 
     Raises:
-        HTTPException (HTTP_409_CONFLICT): Error raised if there's already a stored point with that name. 
+        HTTPException (HTTP_409_CONFLICT): Error raised if there's already a stored point with that name or coordinates.
 
     Returns:
         _type_: The created point.
     """
-    auth.verify_access(request)
-    if crud.get_point_by_name(db, name = point.name):
-        raise HTTPException(status_code = status.HTTP_409_CONFLICT, detail = "POINT ALREADY REGISTERED")
-    return crud.create_point(db = db, new_point = point)
+    async def create() -> schemas.Point:
+        created = await run_crud(crud.create_point, db, new_point = point)
+        if created == None:
+            raise HTTPException(status_code = status.HTTP_409_CONFLICT, detail = "POINT ALREADY REGISTERED")
+        return created
+    return await run_idempotent(request, idempotency_key, point.model_dump(), status.HTTP_201_CREATED, create)
+
+@app.post("/points/v1/points/bulk",
+          response_description = "Create many points in a single transaction.",
+          response_model = dict,
+          tags = ["Points"],
+          status_code = status.HTTP_200_OK,
+          dependencies = [Depends(rate_limit("write")), Depends(auth.get_claims)],
+          openapi_extra = {"requestBody": {"required": True, "content": {
+              "application/json": {"schema": {"type": "array", "items": {"$ref": "#/components/schemas/PointCreate"}}},
+              "application/x-ndjson": {"schema": {"$ref": "#/components/schemas/PointCreate"}},
+          }}})
+async def create_points_bulk(request: Request,
+                             db: Session = Depends(get_db)) -> dict:
+    """
+    Create many points in a single transaction. Requires a valid access token.
+
+    The body is a JSON array of points, or an NDJSON stream with one point per line. Points whose name or coordinates
+    are already registered, or repeated in the body, are reported as conflicts and the others are created.
+
+    Args:
+        request (Request): The request object containing the points.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException (HTTP_409_CONFLICT): Error raised if a concurrent write conflicted with the batch. Nothing was created.
+        HTTPException (HTTP_413_REQUEST_ENTITY_TOO_LARGE): Error raised if there are more than BULK_MAX_ITEMS points.
+
+    Returns:
+        dict: The number of created, conflicting and invalid points, and one result per point, in order.
+    """
+    items = await read_bulk_items(request)
+    results: List[Optional[dict]] = [None] * len(items)
+    (new_points, positions) = ([], [])
+    for (index, item) in enumerate(items):
+        try:
+            new_points.append(schemas.PointCreate.model_validate(item))
+            positions.append(index)
+        except ValidationError:
+            results[index] = {"index": index, "status": "invalid"}
+    
+    created = await run_crud(crud.bulk_create_points, db, new_points) if new_points else []
+    if created is None:
+        raise HTTPException(status_code = status.HTTP_409_CONFLICT, detail = "BULK IMPORT CONFLICT")
+    for (index, result) in zip(positions, created):
+        results[index] = {"index": index, **result}
+    return {
+        "created": sum(result["status"] == "created" for result in results),
+        "conflicts": sum(result["status"] == "conflict" for result in results),
+        "invalid": sum(result["status"] == "invalid" for result in results),
+        "results": results,
+    }
+
+@app.delete("/points/v1/points/bulk",
+            response_description = "Delete many points in a single transaction.",
+            response_model = dict,
+            tags = ["Points"],
+            status_code = status.HTTP_200_OK,
+            dependencies = [Depends(rate_limit("write")), Depends(auth.get_claims)],
+            openapi_extra = {"requestBody": {"required": True, "content": {
+                "application/json": {"schema": {"type": "array", "items": {"type": "string"}}},
+                "application/x-ndjson": {"schema": {"type": "string"}},
+            }}})
+async def delete_points_bulk(request: Request,
+                             db: Session = Depends(get_db)) -> dict:
+    """
+    Delete many points, by name, in a single transaction. Requires a valid access token.
+
+    The body is a JSON array of names, or an NDJSON stream with one name per line.
+
+    Args:
+        request (Request): The request object containing the names.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException (HTTP_413_REQUEST_ENTITY_TOO_LARGE): Error raised if there are more than BULK_MAX_ITEMS names.
+        HTTPException (HTTP_422_UNPROCESSABLE_ENTITY): Error raised if an item isn't a name.
+
+    Returns:
+        dict: The number of deleted and missing points, and one result per name, in order.
+    """
+    names = await read_bulk_items(request)
+    if not all(isinstance(name, str) for name in names):
+        raise HTTPException(status_code = status.HTTP_422_UNPROCESSABLE_ENTITY, detail = "EXPECTED POINT NAMES")
+    results = await run_crud(crud.bulk_delete_points, db, names) if names else []
+    return {
+        "deleted": sum(result["status"] == "deleted" for result in results),
+        "not_found": sum(result["status"] == "not_found" for result in results),
+        "results": [{"index": index, **result} for (index, result) in enumerate(results)],
+    }
 
 @app.get("/points/v1/access",
          response_description = "Get the access name and drop-off point ID from the access token.",
          response_model = Optional[dict],
          tags = ["Points"],
-         status_code = status.HTTP_200_OK)
-def get_point_id_of_access(request: Request,
-                           db: Session = Depends(get_db)) -> Optional[dict]:
+         status_code = status.HTTP_200_OK,
+         dependencies = [Depends(rate_limit("access"))])
+async def get_point_id_of_access(include_point: bool = Query(False, description = "Also return the full drop-off point."),
+                                 claims: dict = Depends(auth.get_claims),
+                                 db: Session = Depends(get_db)) -> Optional[dict]:
     """
     Get the access name and drop-off point ID from the access token.
 
+    The access is looked up in the in-memory authorization map, so the database is only queried when the
+    subject isn't in the map yet. With `include_point` the authorization is read with its drop-off point,
+    joined-loaded in the same query.
+
     Args:
-        request (Request): request object containing information about the request.
+        include_point (bool): Also return the full drop-off point. Defaults to False.
+        claims (dict): The decoded claims of the access token, verified once per request. Defaults to Depends(auth.get_claims).
         db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
 
     Raises:
         HTTPException (HTTP_204_NO_CONTENT): Error raised if the tokens provided don't associate to any stored access.
 
     Returns:
-        Optional[dict]: A dictionary containing the name and the drop-off point ID of the access.
+        Optional[dict]: A dictionary containing the name and the drop-off point ID of the access, and the point if requested.
     """
-    auth.verify_access(request)
-    (access_name, access_point_id) = crud.get_auth(db = db, request = request)
+    if include_point:
+        authorization = await run_crud(crud.get_authorization, db, sub = claims.get("sub"))
+        if authorization == None or authorization.dropoff_point == None:
+            raise HTTPException(status_code = status.HTTP_204_NO_CONTENT, detail = "ACCESS NOT FOUND")
+        return {
+            "name": authorization.name,
+            "point_id": authorization.point_id,
+            "point": schemas.Point.model_validate(authorization.dropoff_point, from_attributes = True).model_dump()
+            }
+    
+    access = crud.authorization_map.get(claims["sub"]) if "sub" in claims else None
+    (access_name, access_point_id) = access or await run_crud(crud.get_auth, db, claims = claims)
     if access_name == None or access_point_id == None:
         raise HTTPException(status_code = status.HTTP_204_NO_CONTENT, detail = "ACCESS NOT FOUND")
     return {
@@ -178,18 +1239,150 @@ def get_point_id_of_access(request: Request,
         "point_id": access_point_id
         }
 
+@app.get("/points/v1/access/authorizations",
+         response_description = "Get the list of authorizations.",
+         response_model = List[schemas.AuthorizationToPoint],
+         tags = ["Access"],
+         status_code = status.HTTP_200_OK,
+         dependencies = [Depends(auth.require_admin)])
+async def get_authorizations(db: Session = Depends(get_db)) -> List[schemas.AuthorizationToPoint]:
+    """
+    Get the list of users authorized to access a drop-off point. Requires the access token of an admin.
+
+    Args:
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Returns:
+        List[schemas.AuthorizationToPoint]: A list of existing authorizations.
+    """
+    return await run_crud(crud.get_authorizations, db)
+
+@app.post("/points/v1/access/authorizations",
+          response_description = "Authorize a user to access a drop-off point.",
+          response_model = schemas.AuthorizationToPoint,
+          tags = ["Access"],
+          status_code = status.HTTP_201_CREATED,
+          dependencies = [Depends(rate_limit("write")), Depends(auth.require_admin)])
+async def create_authorization(authorization: schemas.AuthorizationCreate,
+                               db: Session = Depends(get_db)) -> schemas.AuthorizationToPoint:
+    """
+    Authorize a user to access a drop-off point. Requires the access token of an admin.
+
+    Args:
+        authorization (schemas.AuthorizationCreate): The payload data to create a new authorization.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException (HTTP_409_CONFLICT): Error raised if the user is already authorized or the point doesn't exist.
+
+    Returns:
+        schemas.AuthorizationToPoint: The created authorization.
+    """
+    created = await run_crud(crud.create_authorization, db, new_authorization = authorization)
+    if created == None:
+        raise HTTPException(status_code = status.HTTP_409_CONFLICT, detail = "AUTHORIZATION NOT CREATED")
+    return created
+
+@app.delete("/points/v1/access/authorizations/{sub}",
+            response_description = "Revoke the authorization of a user.",
+            response_model = dict,
+            tags = ["Access"],
+            status_code = status.HTTP_200_OK,
+            dependencies = [Depends(rate_limit("write")), Depends(auth.require_admin)])
+async def delete_authorization(sub: str,
+                               db: Session = Depends(get_db)) -> dict:
+    """
+    Revoke the authorization of a user. Requires the access token of an admin.
+
+    Args:
+        sub (str): The subject identifier of the user.
+        db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException (HTTP_204_NO_CONTENT): Error raised if the user has no authorization.
+
+    Returns:
+        dict: A dictionary containing a success message.
+    """
+    if await run_crud(crud.delete_authorization, db, sub) == None:
+        raise HTTPException(status_code = status.HTTP_204_NO_CONTENT, detail = "AUTHORIZATION NOT FOUND")
+    return {"message": "AUTHORIZATION DELETED"}
+
+@app.get("/points/v1/stats/pool",
+         response_description = "Get the usage of the database connection pool.",
+         response_model = dict,
+         tags = ["Stats"],
+         status_code = status.HTTP_200_OK,
+         dependencies = [Depends(auth.require_admin)])
+async def get_pool_stats() -> dict:
+    """
+    Get the usage of the database connection pool: its gauges (size, checked in/out connections, overflow)
+    and its counters (checkouts, wait time, overflow hits, timeouts). Requires an admin access token.
+
+    Returns:
+        dict: The pool gauges and counters.
+    """
+    return database.get_pool_status()
+
+@app.get("/points/v1/stats/replicas",
+         response_description = "Get the state of the read replicas of the database.",
+         response_model = dict,
+         tags = ["Stats"],
+         status_code = status.HTTP_200_OK,
+         dependencies = [Depends(auth.require_admin)])
+async def get_replica_stats() -> dict:
+    """
+    Get the state of the read replicas of the database: their health, version, lag and reads at the last check,
+    the reads which fell back to the primary for lack of a healthy replica, and the clients whose reads stick to
+    the primary after a write. Requires an admin access token.
+
+    Returns:
+        dict: The replica states and counters.
+    """
+    return database.replica_router.stats()
+
+@app.get("/points/v1/stats/cache",
+         response_description = "Get the usage of the points catalogue cache.",
+         response_model = dict,
+         tags = ["Stats"],
+         status_code = status.HTTP_200_OK,
+         dependencies = [Depends(auth.require_admin)])
+async def get_cache_stats() -> dict:
+    """
+    Get the usage of the points catalogue cache: its hit/miss counters, version and the age of the cached snapshot,
+    and the same counters for the authorization map and the image cache. Requires an admin access token.
+
+    Returns:
+        dict: The cache counters.
+    """
+    return {**crud.point_catalogue.stats(), "authorizations": crud.authorization_map.stats(), "images": images.image_service.stats()}
+
+@app.get("/points/v1/metrics",
+         response_description = "Get the service metrics in the Prometheus text format.",
+         response_class = PlainTextResponse,
+         tags = ["Stats"],
+         status_code = status.HTTP_200_OK)
+async def get_metrics() -> PlainTextResponse:
+    """
+    Get the service metrics in the Prometheus text format: request latency histograms per route, SQL statement
+    durations, token verification and JWKS fetch durations, connection pool gauges and cache hit ratios.
+
+    Returns:
+        PlainTextResponse: The metrics, to be scraped by Prometheus.
+    """
+    return PlainTextResponse(registry.render(), media_type = "text/plain; version=0.0.4")
+
 @app.delete("/points/v1/points/name/{point_name}",
             response_description = "Delete a specific point by its name.",
             response_model = dict,
             tags = ["Points"],
-            status_code = status.HTTP_200_OK)
-def delete_point(request: Request,
-                 point_name: str,
+            status_code = status.HTTP_200_OK,
+            dependencies = [Depends(rate_limit("write")), Depends(auth.get_claims)])
+async def delete_point(point_name: str,
                  db: Session = Depends(get_db)):
-    """Delete a specific point by its name.
+    """Delete a specific point by its name. Requires a valid access token.
 
     Args:
-        request (Request): The request object containing information about the request.
         point_name (str): The name attribute of a specify unique point.
         db (Session, optional): Optional database session object. If not included the system will connect to the default one. Defaults to Depends(get_db).
 
@@ -199,8 +1392,7 @@ def delete_point(request: Request,
     Returns:
         _type_: A dictionary containing a success message.
     """
-    auth.verify_access(request)
-    if crud.delete_point(db, point_name) == None:
+    if await run_crud(crud.delete_point, db, point_name) == None:
         raise HTTPException(status_code = status.HTTP_204_NO_CONTENT, detail = "POINT NOT FOUND")
     return {"message": "POINT DELETED"}
 
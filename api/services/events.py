@@ -0,0 +1,191 @@
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Optional, Set
+
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "64"))
+STREAM_HEARTBEAT_INTERVAL = float(os.getenv("STREAM_HEARTBEAT_INTERVAL", "15"))
+
+class Event:
+    """
+    A change event, encoded once however many subscribers receive it.
+
+    Attributes:
+        type (str): The event type, e.g. "changes".
+        data (dict): The JSON-serializable payload.
+        id (Optional[int]): The sync version the event brings clients to, sent as the SSE event id.
+    """
+
+    def __init__(self, type: str, data: dict, id: Optional[int] = None):
+        self.type = type
+        self.data = data
+        self.id = id
+        self._json: Optional[str] = None
+        self._sse: Optional[bytes] = None
+
+    @property
+    def json(self) -> str:
+        """
+        :return: The event as a JSON message, for the WebSocket endpoint.
+        """
+        if self._json is None:
+            self._json = json.dumps({"type": self.type, "id": self.id, "data": self.data}, separators = (",", ":"))
+        return self._json
+
+    @property
+    def sse(self) -> bytes:
+        """
+        :return: The event as a Server-Sent Events frame.
+        """
+        if self._sse is None:
+            frame = f"id: {self.id}\n" if self.id is not None else ""
+            frame += f"event: {self.type}\ndata: {json.dumps(self.data, separators = (',', ':'))}\n\n"
+            self._sse = frame.encode()
+        return self._sse
+
+# Sent to a subscriber which fell too far behind, before it is disconnected
+RESYNC = Event("resync", {"reason": "slow consumer"})
+HEARTBEAT = Event("heartbeat", {})
+
+class Subscriber:
+    """
+    The bounded queue of events of one client.
+
+    Attributes:
+        queue (asyncio.Queue): The events not sent yet.
+        dropped (bool): True once the subscriber fell behind and was dropped.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize = queue_size)
+        self.dropped = False
+
+class Broadcaster:
+    """
+    Fans change events out to every connected stream client.
+
+    Each subscriber has a bounded queue, so a client which stops reading can't make the process buffer events
+    without limit. When a queue is full, its subscriber is dropped: its queue is replaced with a single `resync`
+    event and the stream ends, and the client reconnects and catches up with `GET /points/v1/points/changes`.
+    Idle subscribers are a suspended coroutine and an empty queue, woken by an event or their heartbeat.
+
+    :param queue_size: Maximum number of events queued per subscriber.
+    :param heartbeat: Seconds without events after which a heartbeat is sent, so that proxies keep idle streams
+        open and closed clients are noticed.
+    """
+
+    def __init__(self, queue_size: int = STREAM_QUEUE_SIZE, heartbeat: float = STREAM_HEARTBEAT_INTERVAL):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.published = 0
+        self.dropped = 0
+        self.subscribers: Set[Subscriber] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._changed: Optional[asyncio.Event] = None
+
+    def start(self):
+        """
+        Bind the broadcaster to the running event loop, so that :meth:`signal` can be called from any thread.
+
+        :return: None
+        """
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+    def stop(self):
+        """
+        End every stream.
+
+        :return: None
+        """
+        for subscriber in list(self.subscribers):
+            self._drop(subscriber, None)
+        self._loop = None
+
+    def signal(self):
+        """
+        Announce that the catalogue changed. Thread-safe; does nothing before :meth:`start`.
+
+        :return: None
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._changed.set)
+
+    async def wait_for_change(self):
+        """
+        Wait until :meth:`signal` is called. Changes signalled while the caller was busy are coalesced into one.
+
+        :return: None
+        """
+        await self._changed.wait()
+        self._changed.clear()
+
+    def subscribe(self) -> Subscriber:
+        """
+        :return: A new subscriber, receiving the events published from now on.
+        """
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """
+        :param subscriber: A subscriber whose client disconnected.
+        :return: None
+        """
+        self.subscribers.discard(subscriber)
+
+    def publish(self, event: Event):
+        """
+        Queue an event for every subscriber, dropping those whose queue is full. Must be called on the event loop.
+
+        :param event: The event.
+        :return: None
+        """
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._drop(subscriber, RESYNC)
+
+    def _drop(self, subscriber: Subscriber, last_event: Optional[Event]):
+        self.subscribers.discard(subscriber)
+        subscriber.dropped = True
+        self.dropped += last_event is not None
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        # Wakes the stream up, which ends after sending it
+        subscriber.queue.put_nowait(last_event)
+
+    async def events(self, subscriber: Subscriber) -> AsyncIterator[Event]:
+        """
+        Yield the events of a subscriber, and a heartbeat whenever none came for `heartbeat` seconds. Ends when the
+        subscriber is dropped; the subscriber is removed when the iteration stops.
+
+        :param subscriber: The subscriber.
+        :return: The events.
+        """
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+                    continue
+                if event is None:
+                    return
+                yield event
+                if subscriber.dropped and subscriber.queue.empty():
+                    return
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self) -> dict:
+        """
+        :return: The number of subscribers, of published events and of dropped subscribers.
+        """
+        return {"subscribers": len(self.subscribers), "published": self.published, "dropped": self.dropped}
+
+broadcaster = Broadcaster()
@@ -0,0 +1,414 @@
+import asyncio
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Sequence, Tuple
+from urllib.parse import unquote, urlparse
+
+import httpx
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "drop-off-points-images"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+IMAGE_WIDTHS = tuple(sorted(int(width) for width in os.getenv("IMAGE_WIDTHS", "160,320,640,1200").split(",")))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "82"))
+IMAGE_FETCH_TIMEOUT = float(os.getenv("IMAGE_FETCH_TIMEOUT", "10"))
+IMAGE_MAX_SOURCE_BYTES = int(os.getenv("IMAGE_MAX_SOURCE_BYTES", str(20 * 1024 * 1024)))
+IMAGE_MAX_REDIRECTS = int(os.getenv("IMAGE_MAX_REDIRECTS", "3"))
+
+SOURCE_MEDIA_TYPE = "application/octet-stream"
+EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", SOURCE_MEDIA_TYPE: "src"}
+MEDIA_TYPES = {extension: media_type for (media_type, extension) in EXTENSIONS.items()}
+
+class ImageError(Exception):
+    """
+    Raised when the source image of a point can't be fetched or decoded.
+    """
+
+class ImageFetcher(ABC):
+    """
+    Downloads the source images of the points.
+    """
+
+    @abstractmethod
+    async def fetch(self, url: str) -> bytes:
+        """
+        :param url: The URL stored in the `image` column of a point.
+        :return: The content of the image.
+        :raises ImageError: If the image can't be fetched.
+        """
+
+def is_public_address(address: str) -> bool:
+    """
+    :param address: An IPv4 or IPv6 address.
+    :return: True if the address is routable on the internet, i.e. not private, loopback, link-local (like the
+        cloud metadata endpoints), multicast or reserved.
+    """
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+class HTTPImageFetcher(ImageFetcher):
+    """
+    Fetches the images from their hosts over HTTP.
+
+    Any user allowed to write points chooses the URLs, so they are not trusted: only http(s) URLs of hosts which
+    resolve to public addresses are fetched. The request is sent to the address which was checked, so the host
+    can't resolve to an internal one in between, and redirects are followed one by one, each checked the same way.
+    Sources larger than `max_bytes` are refused without being downloaded in full.
+
+    :param timeout: Timeout, in seconds, of a download.
+    :param max_bytes: Largest source accepted, in bytes.
+    :param max_redirects: Maximum number of redirects followed.
+    :param is_allowed: Tells whether an address may be connected to.
+    """
+
+    def __init__(self, timeout: float = IMAGE_FETCH_TIMEOUT, max_bytes: int = IMAGE_MAX_SOURCE_BYTES,
+                 max_redirects: int = IMAGE_MAX_REDIRECTS, is_allowed: Callable[[str], bool] = is_public_address):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_redirects = max_redirects
+        self.is_allowed = is_allowed
+
+    async def fetch(self, url: str) -> bytes:
+        try:
+            async with httpx.AsyncClient(timeout = self.timeout, follow_redirects = False) as client:
+                target = httpx.URL(url)
+                for _ in range(self.max_redirects + 1):
+                    response = await client.send(await self._request(client, target), stream = True)
+                    try:
+                        if response.is_redirect:
+                            target = target.join(response.headers["Location"])
+                            continue
+                        response.raise_for_status()
+                        return await self._read(response, url)
+                    finally:
+                        await response.aclose()
+                raise ImageError(f"{url} redirects more than {self.max_redirects} times")
+        except (httpx.HTTPError, httpx.InvalidURL) as error:
+            raise ImageError(f"{url} could not be fetched: {error}") from error
+
+    async def _request(self, client: httpx.AsyncClient, url: httpx.URL) -> httpx.Request:
+        if url.scheme not in ("http", "https") or not url.host:
+            raise ImageError(f"{url} is not an http(s) URL")
+        port = url.port or (443 if url.scheme == "https" else 80)
+        try:
+            addresses = [info[4][0] for info in await asyncio.get_running_loop().getaddrinfo(url.host, port, type = socket.SOCK_STREAM)]
+        except OSError as error:
+            raise ImageError(f"{url.host} could not be resolved: {error}") from error
+        if not addresses or not all(self.is_allowed(address) for address in addresses):
+            raise ImageError(f"{url.host} is not a public host")
+        # Connect to the checked address, keeping the host name for the Host header and the TLS certificate check
+        return client.build_request("GET", url.copy_with(host = addresses[0].split("%")[0]),
+                                    headers = {"Host": url.netloc.decode("ascii")},
+                                    extensions = {"sni_hostname": url.raw_host.decode("ascii")})
+
+    async def _read(self, response: httpx.Response, url: str) -> bytes:
+        if int(response.headers.get("Content-Length") or 0) > self.max_bytes:
+            raise ImageError(f"{url} is larger than {self.max_bytes} bytes")
+        content = bytearray()
+        async for chunk in response.aiter_bytes():
+            content += chunk
+            if len(content) > self.max_bytes:
+                raise ImageError(f"{url} is larger than {self.max_bytes} bytes")
+        return bytes(content)
+
+class FileImageFetcher(ImageFetcher):
+    """
+    Reads the images from a local directory, e.g. in tests. Only the file name of the URL is used, so
+    `https://host/path/room.jpg` and `file:///path/room.jpg` are both read from `root/room.jpg`.
+
+    :param root: The directory holding the images.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    async def fetch(self, url: str) -> bytes:
+        name = os.path.basename(unquote(urlparse(url).path))
+        path = os.path.join(self.root, name)
+        try:
+            return await asyncio.to_thread(self._read, path)
+        except OSError as error:
+            raise ImageError(f"{url} could not be read: {error}") from error
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, "rb") as image_file:
+            return image_file.read()
+
+def create_fetcher() -> ImageFetcher:
+    """
+    Create the fetcher selected by the `IMAGE_SOURCE_DIR` variable: images are read from that directory when
+    it is set, and downloaded otherwise.
+
+    :return: The image fetcher.
+    """
+    source_dir = os.getenv("IMAGE_SOURCE_DIR")
+    if source_dir:
+        return FileImageFetcher(source_dir)
+    return HTTPImageFetcher()
+
+def resize(source: bytes, width: int, quality: int = IMAGE_QUALITY) -> Tuple[bytes, str]:
+    """
+    Scale an image down to a width, keeping its aspect ratio. Images are never scaled up. Images with
+    transparency are encoded as PNG, the others as progressive JPEG.
+
+    :param source: The content of the source image.
+    :param width: The width of the variant, in pixels.
+    :param quality: The JPEG quality.
+    :return: The content and the media type of the variant.
+    :raises ImageError: If the source isn't an image Pillow can decode.
+    """
+    try:
+        with Image.open(io.BytesIO(source)) as image:
+            # Decode JPEG sources at a reduced scale when possible, which is much faster than a full decode
+            image.draft("RGB", (width, width))
+            image = ImageOps.exif_transpose(image)
+            if image.width > width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+                image.save(output, "PNG", optimize = True)
+                return (output.getvalue(), "image/png")
+            image.convert("RGB").save(output, "JPEG", quality = quality, optimize = True, progressive = True)
+            return (output.getvalue(), "image/jpeg")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as error:
+        raise ImageError(f"the source is not a supported image: {error}") from error
+
+class CachedImage:
+    """
+    An image stored in the disk cache.
+
+    Attributes:
+        path (str): The file holding the image.
+        digest (str): The SHA-256 of the content, used as its entity tag.
+        media_type (str): The media type of the content.
+        size (int): The size of the content, in bytes.
+    """
+
+    def __init__(self, path: str, digest: str, media_type: str, size: int):
+        self.path = path
+        self.digest = digest
+        self.media_type = media_type
+        self.size = size
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as image_file:
+            return image_file.read()
+
+class ImageCache:
+    """
+    Bounded on-disk LRU cache of the source images and of their variants.
+
+    Files are named `{key}-{digest}.{extension}`, so the index is rebuilt from the directory listing on first use,
+    without reading the files, and the least recently used files are deleted once the cache outgrows `max_bytes`.
+    Files are written to a temporary name and renamed, so concurrent readers never see partial content.
+
+    :param directory: The directory of the cache, created on first use.
+    :param max_bytes: Total size, in bytes, above which the least recently used files are evicted.
+    """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries: Optional["OrderedDict[str, CachedImage]"] = None
+        self._lock = threading.Lock()
+
+    def _index(self) -> "OrderedDict[str, CachedImage]":
+        if self._entries is None:
+            os.makedirs(self.directory, exist_ok = True)
+            files = []
+            for entry in os.scandir(self.directory):
+                (stem, _, extension) = entry.name.rpartition(".")
+                (key, _, digest) = stem.partition("-")
+                if entry.is_file() and digest and extension in MEDIA_TYPES:
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, key, CachedImage(entry.path, digest, MEDIA_TYPES[extension], stat.st_size)))
+            self._entries = OrderedDict((key, image) for (_, key, image) in sorted(files, key = lambda file: file[0]))
+            self.size = sum(image.size for image in self._entries.values())
+        return self._entries
+
+    def get(self, key: str) -> Optional[CachedImage]:
+        """
+        :param key: The key of the image.
+        :return: The cached image, or None if it isn't cached.
+        """
+        with self._lock:
+            entries = self._index()
+            image = entries.get(key)
+            if image is None or not os.path.exists(image.path):
+                if image is not None:
+                    del entries[key]
+                    self.size -= image.size
+                self.misses += 1
+                return None
+            entries.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key: str, content: bytes, media_type: str) -> CachedImage:
+        """
+        Store an image, evicting the least recently used ones if the cache is full.
+
+        :param key: The key of the image.
+        :param content: The content of the image.
+        :param media_type: Its media type, one of `EXTENSIONS`.
+        :return: The cached image.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        path = os.path.join(self.directory, f"{key}-{digest[:32]}.{EXTENSIONS[media_type]}")
+        with self._lock:
+            entries = self._index()
+            (descriptor, temporary) = tempfile.mkstemp(dir = self.directory, suffix = ".tmp")
+            with os.fdopen(descriptor, "wb") as image_file:
+                image_file.write(content)
+            os.replace(temporary, path)
+            previous = entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+                if previous.path != path:
+                    self._unlink(previous.path)
+            image = entries[key] = CachedImage(path, digest[:32], media_type, len(content))
+            self.size += image.size
+            while self.size > self.max_bytes and len(entries) > 1:
+                (_, evicted) = entries.popitem(last = False)
+                self.size -= evicted.size
+                self._unlink(evicted.path)
+            return image
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """
+        Delete every cached image.
+
+        :return: None
+        """
+        with self._lock:
+            for image in self._index().values():
+                self._unlink(image.path)
+            self._entries = OrderedDict()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """
+        :return: The hit and miss counters and the size of the cache.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "cached_images": len(self._entries or ()), "bytes": self.size}
+
+class ImageService:
+    """
+    Serves resized variants of the point images.
+
+    A source is fetched once and kept in the cache, and each variant is generated once, in a pool of worker
+    threads so the event loop stays free. Concurrent requests for the same variant share one generation.
+
+    :param fetcher: Downloads the source images.
+    :param cache: Stores the sources and the variants.
+    :param widths: The widths of the variants. A requested width is rounded up to the next one.
+    :param workers: Number of threads resizing images.
+    """
+
+    def __init__(self, fetcher: ImageFetcher, cache: ImageCache, widths: Sequence[int] = IMAGE_WIDTHS,
+                 workers: int = IMAGE_WORKERS):
+        self.fetcher = fetcher
+        self.cache = cache
+        self.widths = tuple(sorted(widths))
+        self.workers = workers
+        self.fetches = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def variant_width(self, width: Optional[int]) -> int:
+        """
+        :param width: The requested width, or None for the largest variant.
+        :return: The smallest variant width at least as large, or the largest variant width.
+        """
+        if width is None:
+            return self.widths[-1]
+        return next((variant for variant in self.widths if variant >= width), self.widths[-1])
+
+    @staticmethod
+    def key(url: str, variant: str) -> str:
+        return hashlib.sha256(f"{url}\n{variant}".encode()).hexdigest()[:32]
+
+    async def get(self, url: str, width: Optional[int] = None) -> Tuple[CachedImage, bytes]:
+        """
+        :param url: The URL of the source image.
+        :param width: The requested width, rounded with :meth:`variant_width`.
+        :return: The cached variant and its content.
+        :raises ImageError: If the source can't be fetched or decoded.
+        """
+        key = self.key(url, str(self.variant_width(width)))
+        cached = await asyncio.to_thread(self._cached, key)
+        if cached is not None:
+            return cached
+        return await self._single_flight(key, lambda: self._generate(key, url, self.variant_width(width)))
+
+    def _cached(self, key: str) -> Optional[Tuple[CachedImage, bytes]]:
+        # Reads the directory and the file, so it runs in a thread
+        image = self.cache.get(key)
+        if image is None:
+            return None
+        try:
+            return (image, image.read())
+        except FileNotFoundError:
+            return None
+
+    async def _single_flight(self, key: str, produce):
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(produce())
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _source(self, url: str) -> bytes:
+        key = self.key(url, "source")
+        cached = await asyncio.to_thread(self._cached, key)
+        if cached is not None:
+            return cached[1]
+
+        async def fetch() -> bytes:
+            self.fetches += 1
+            content = await self.fetcher.fetch(url)
+            await asyncio.to_thread(self.cache.put, key, content, SOURCE_MEDIA_TYPE)
+            return content
+        return await self._single_flight(key, fetch)
+
+    async def _generate(self, key: str, url: str, width: int) -> Tuple[CachedImage, bytes]:
+        source = await self._source(url)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "image-worker")
+        loop = asyncio.get_running_loop()
+        (content, media_type) = await loop.run_in_executor(self._executor, resize, source, width)
+        image = await asyncio.to_thread(self.cache.put, key, content, media_type)
+        return (image, content)
+
+    def stats(self) -> dict:
+        """
+        :return: The cache statistics and the number of sources fetched.
+        """
+        return {**self.cache.stats(), "fetches": self.fetches}
+
+image_service = ImageService(create_fetcher(), ImageCache())
@@ -0,0 +1,30 @@
+"""
+One-shot database setup: creates the schema, migrates it and seeds the initial items.
+
+Run it once per deployment, before starting the replicas with `STARTUP_MODE=manual`:
+
+    cd api && python setup_db.py
+"""
+from os import getenv
+
+from dotenv import load_dotenv
+
+ENV_FILE_PATH = getenv("ENV_FILE_PATH")
+load_dotenv(ENV_FILE_PATH)
+
+from db_info import database, init_db
+
+def setup():
+    """
+    Create and migrate the schema of the configured database, and seed it if it has no points.
+
+    Return:
+        None
+    """
+    migrated = init_db.create_schema(database.engine)
+    with database.SessionLocal() as db:
+        seeded = init_db.seed(db)
+    print(f"Schema ready ({migrated} points migrated); {'seeded the initial items' if seeded else 'already seeded'}.")
+
+if __name__ == '__main__':
+    setup()
@@ -0,0 +1,70 @@
+"""
+Benchmark of the bulk import and delete against the one-at-a-time path.
+
+The one-at-a-time path is what looping `POST /points/v1/points` does: an existence check, then an
+add/commit/refresh per point. The bulk path is `crud.bulk_create_points`/`crud.bulk_delete_points`.
+A file-backed SQLite database is used so that every commit pays for a real write.
+
+Usage (from the repository root):
+    python benchmarks/bench_bulk.py [--sizes 100 1000] [--database-url sqlite:///bench.db]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_info import crud, database, schemas
+
+def new_points(size: int):
+    return [schemas.PointCreate(name = f"bench-{index}", location = "benchmark",
+                                coordinates = f"{40 + index / 1e6}, {-8 - index / 1e6}", image = None)
+            for index in range(size)]
+
+def one_at_a_time(db, points):
+    start = time.perf_counter()
+    for point in points:
+        if crud.get_point_by_name(db, name = point.name) is None:
+            crud.create_point(db, new_point = point)
+    created = time.perf_counter() - start
+    start = time.perf_counter()
+    for point in points:
+        crud.delete_point(db, point.name)
+    return (created, time.perf_counter() - start)
+
+def bulk(db, points):
+    start = time.perf_counter()
+    crud.bulk_create_points(db, points)
+    created = time.perf_counter() - start
+    start = time.perf_counter()
+    crud.bulk_delete_points(db, [point.name for point in points])
+    return (created, time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [100, 1000])
+    parser.add_argument("--database-url", help = "Database to run against. Defaults to a temporary SQLite file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.database_url or f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        engine = create_engine(url, **database.engine_options(url))
+        database.Base.metadata.create_all(bind = engine)
+        Session = sessionmaker(bind = engine)
+
+        for size in args.sizes:
+            points = new_points(size)
+            for (name, path) in (("one at a time", one_at_a_time), ("bulk", bulk)):
+                with Session() as db:
+                    (created, deleted) = path(db, points)
+                print(f"{size:>6} points, {name:<14} create {created * 1e3:10.1f} ms ({size / created:10.0f}/s)"
+                      f"   delete {deleted * 1e3:10.1f} ms ({size / deleted:10.0f}/s)")
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
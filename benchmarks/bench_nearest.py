@@ -0,0 +1,78 @@
+"""
+Benchmark of the nearest drop-off point queries at 10k and 100k points.
+
+Compares the in-memory grid index used by `GET /points/v1/points/nearest`, a brute-force haversine scan and the
+SQL bounding-box prefilter of `crud.get_nearest_points` on an in-memory SQLite database.
+
+Usage (from the repository root):
+    python benchmarks/bench_nearest.py [--sizes 10000 100000] [--queries 200] [--radius 1.0]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from db_info import crud, database, models
+from db_info.geo import GridIndex, haversine_km
+
+# Roughly the area around the University of Aveiro campus
+AREA = (40.55, 40.70, -8.75, -8.55)
+
+def random_location():
+    return (random.uniform(AREA[0], AREA[1]), random.uniform(AREA[2], AREA[3]))
+
+def timed(function, queries) -> float:
+    start = time.perf_counter()
+    for (latitude, longitude) in queries:
+        function(latitude, longitude)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [10_000, 100_000])
+    parser.add_argument("--queries", type = int, default = 200)
+    parser.add_argument("--k", type = int, default = 5)
+    parser.add_argument("--radius", type = float, default = 1.0, help = "Radius, in km, of the SQL bounding-box queries.")
+    args = parser.parse_args()
+    random.seed(0)
+
+    for size in args.sizes:
+        locations = [random_location() for _ in range(size)]
+        queries = [random_location() for _ in range(args.queries)]
+
+        start = time.perf_counter()
+        index = GridIndex([(latitude, longitude, position) for (position, (latitude, longitude)) in enumerate(locations)])
+        build_ms = (time.perf_counter() - start) * 1e3
+
+        engine = create_engine("sqlite:///:memory:", **database.engine_options("sqlite:///:memory:"))
+        database.Base.metadata.create_all(bind = engine)
+        with engine.begin() as connection:
+            connection.execute(insert(models.Point), [
+                {"name": f"point-{position}", "location": "benchmark", "coordinates": f"{latitude}, {longitude}",
+                 "latitude": latitude, "longitude": longitude}
+                for (position, (latitude, longitude)) in enumerate(locations)])
+        db = sessionmaker(bind = engine)()
+
+        results = {
+            "grid index": timed(lambda latitude, longitude: index.nearest(latitude, longitude, args.k), queries),
+            f"grid index, {args.radius} km": timed(lambda latitude, longitude: index.nearest(latitude, longitude, args.k, args.radius), queries),
+            "brute force": timed(lambda latitude, longitude: sorted(haversine_km(latitude, longitude, *location) for location in locations)[:args.k],
+                                 queries[:max(1, args.queries // 10)]),
+            f"SQL bounding box, {args.radius} km": timed(lambda latitude, longitude: crud.get_nearest_points(db, latitude, longitude, args.k, args.radius),
+                                                     queries[:max(1, args.queries // 10)]),
+        }
+        db.close()
+        engine.dispose()
+
+        print(f"{size} points (grid index built in {build_ms:.0f} ms, cell size {index.cell_size:.5f} deg)")
+        for (name, microseconds) in results.items():
+            print(f"  {name:<28} {microseconds:12.1f} us/query")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark of `GET /points/v1/points/search` at 100k points.
+
+Measures, for type-ahead queries of growing length:
+
+    index_build     building the search index of a catalogue snapshot from scratch, and deriving it from the
+                    index of the previous snapshot after a change of one point
+    scan            folding and matching every point on each query, as a client-side filter does
+    index           the in-memory search index of the catalogue snapshot
+    fts5            the SQLite FTS5 fallback of `crud.search_points`, on a temporary database
+
+Usage (from the repository root):
+    python benchmarks/bench_search.py [--size 100000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+from db_info import crud, init_db, models
+from db_info.search import SearchIndex, normalize, tokenize
+
+WORDS = ["Pavilhão", "Cantina", "Departamento", "Biblioteca", "Reitoria", "Complexo", "Laboratório", "Residência",
+         "Santiago", "Crasto", "Aristides", "Hall", "Pedagógico", "Música", "Química", "Física", "Geociências"]
+QUERIES = ["p", "pav", "pavilhao", "pavilhao ari", "cantina santiago 12", "zzz"]
+
+def make_points(size: int) -> list:
+    generator = random.Random(42)
+    return [{"id": index + 1, "name": f"{generator.choice(WORDS)} {generator.choice(WORDS)} {index}",
+             "location": f"{generator.choice(WORDS)} {index % 100}",
+             "coordinates": f"{40 + index / 1e6}, {-8 - index / 1e6}", "image": None}
+            for index in range(size)]
+
+def scan(points: list, query: str, limit: int) -> list:
+    words = tokenize(query)
+    matches = []
+    for point in points:
+        text = tokenize(f"{point['name']} {point['location']}")
+        if all(any(word.startswith(prefix) for word in text) for prefix in words):
+            matches.append(point)
+    return sorted(matches, key = lambda point: normalize(point["name"]))[:limit]
+
+def timed(function, repeat: int) -> float:
+    """
+    :return: The median duration of a call, in milliseconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1e3
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type = int, default = 100_000)
+    parser.add_argument("--repeat", type = int, default = 20)
+    parser.add_argument("--limit", type = int, default = 10)
+    args = parser.parse_args()
+
+    points = make_points(args.size)
+    entries = [(point["id"], point["name"], point["location"], point) for point in points]
+    tokenize.cache_clear()
+    start = time.perf_counter()
+    index = SearchIndex(entries)
+    cold = (time.perf_counter() - start) * 1e3
+    changed = [(key, "Renamed point", location, point) if key == 1 else (key, name, location, point) for (key, name, location, point) in entries]
+    rebuild = timed(lambda: SearchIndex(changed), 3)
+    derived = timed(lambda: index.updated(changed), args.repeat)
+    print(f"{args.size} points: index_build {cold:.0f} ms cold, {rebuild:.0f} ms warm, {derived:.0f} ms derived after a change")
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'search.db')}")
+        init_db.create_schema(engine)
+        with Session(engine) as db:
+            db.execute(insert(models.Point), points)
+            db.commit()
+            print(f"  {'query':<22} {'scan':>10} {'index':>10} {'fts5':>10}   (ms)")
+            for query in QUERIES:
+                results = (timed(lambda: scan(points, query, args.limit), max(1, args.repeat // 10)),
+                           timed(lambda: index.search(query, args.limit), args.repeat),
+                           timed(lambda: crud.search_points(db, query, args.limit), args.repeat))
+                print(f"  {query!r:<22} " + " ".join(f"{milliseconds:10.3f}" for milliseconds in results))
+
+if __name__ == "__main__":
+    main()
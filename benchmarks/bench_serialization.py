@@ -0,0 +1,71 @@
+"""
+Benchmark of the serialization of the points list at 1k and 10k points.
+
+Compares the ways `GET /points/v1/points` can turn the catalogue into a response body:
+
+    jsonable_encoder    validate the rows, then `jsonable_encoder` and `json.dumps`, as FastAPI does by default
+    type_adapter        validate the rows and dump them with the `List[Point]` TypeAdapter of the schemas
+    orjson              dump the validated points with orjson, as ORJSONResponse does
+    cached_bytes        send the encoding kept by the catalogue snapshot
+
+Usage (from the repository root):
+    python benchmarks/bench_serialization.py [--sizes 1000 10000] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from db_info import models, schemas
+from db_info.cache import CatalogueSnapshot
+
+def make_rows(size: int) -> list:
+    return [models.Point(id = index, name = f"point-{index}", location = "benchmark",
+                         coordinates = f"{40 + index / 1e6}, {-8 - index / 1e6}", image = None)
+            for index in range(size)]
+
+def timed(function, repeat: int) -> float:
+    """
+    :return: The median duration of a call, in milliseconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1e3
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [1000, 10_000])
+    parser.add_argument("--repeat", type = int, default = 20)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        rows = make_rows(size)
+        points = schemas.PointList.validate_python(rows, from_attributes = True)
+        snapshot = CatalogueSnapshot(1, rows)
+        snapshot.encoded
+
+        results = {
+            "jsonable_encoder": timed(lambda: json.dumps(jsonable_encoder(
+                [schemas.Point.model_validate(row, from_attributes = True) for row in rows])).encode(), args.repeat),
+            "type_adapter": timed(lambda: schemas.PointList.dump_json(
+                schemas.PointList.validate_python(rows, from_attributes = True)), args.repeat),
+            "orjson": timed(lambda: orjson.dumps([point.model_dump() for point in points]), args.repeat),
+            "cached_bytes": timed(lambda: snapshot.encoded, args.repeat),
+        }
+        baseline = results["jsonable_encoder"]
+        print(f"{size} points ({len(snapshot.encoded) / 1024:.0f} KiB)")
+        for (name, milliseconds) in results.items():
+            print(f"  {name:<18} {milliseconds:10.3f} ms   {baseline / milliseconds if milliseconds else float('inf'):8.1f}x")
+
+if __name__ == "__main__":
+    main()
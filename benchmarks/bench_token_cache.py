@@ -0,0 +1,62 @@
+"""
+Micro-benchmark of `auth.verify_access` with and without the verified-token cache.
+
+Usage (from the repository root):
+    python benchmarks/bench_token_cache.py [--iterations 2000] [--tokens 10]
+"""
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import rsa
+from jose import jwk, jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from db_info import auth
+from db_info.jwks import JWKSKeyStore
+from db_info.token_cache import VerifiedTokenCache
+
+ISSUER = "http://issuer.local"
+AUDIENCE = "benchmark"
+
+def build_tokens(count: int):
+    _, private_key = rsa.newkeys(2048)
+    pem = private_key.save_pkcs1().decode()
+    public_key = jwk.construct(pem, "RS256").public_key().to_dict()
+    public_key["kid"] = "bench"
+    tokens = [jwt.encode({"sub": f"user-{i}", "iss": ISSUER, "aud": AUDIENCE, "exp": int(time.time()) + 3600},
+                         pem, algorithm = "RS256", headers = {"kid": "bench"})
+              for i in range(count)]
+    return public_key, tokens
+
+def run(iterations: int, tokens: list) -> float:
+    requests = [SimpleNamespace(headers = {"Authorization": f"Bearer {token}"}) for token in tokens]
+    start = time.perf_counter()
+    for i in range(iterations):
+        auth.verify_access(requests[i % len(requests)])
+    return iterations / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type = int, default = 2000)
+    parser.add_argument("--tokens", type = int, default = 10, help = "Distinct tokens cycled through.")
+    args = parser.parse_args()
+
+    os.environ["COGNITO_ISSUER"] = ISSUER
+    os.environ["COGNITO_AUDIENCE"] = AUDIENCE
+    public_key, tokens = build_tokens(args.tokens)
+    auth.key_store = JWKSKeyStore(fetcher = lambda url, timeout: [public_key])
+
+    auth.token_cache = VerifiedTokenCache(maxsize = 0)
+    uncached = run(args.iterations, tokens)
+    auth.token_cache = VerifiedTokenCache(maxsize = 1024)
+    cached = run(args.iterations, tokens)
+
+    print(f"without cache: {uncached:12.0f} verifications/s")
+    print(f"with cache:    {cached:12.0f} verifications/s ({cached / uncached:.1f}x)")
+
+if __name__ == "__main__":
+    main()
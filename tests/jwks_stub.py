@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwk, jwt
+
+class JWKSStub:
+    """
+    Local stand-in for the Cognito issuer: serves `/.well-known/jwks.json` and signs RS256 tokens.
+    """
+
+    def __init__(self, audience: str = "test-audience"):
+        self.audience = audience
+        self.private_keys = {}
+        self.public_keys = {}
+        self.requests = 0
+        self.available = True
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.issuer = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                if not stub.available or self.path != "/.well-known/jwks.json":
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = json.dumps({"keys": list(stub.public_keys.values())}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def jwks_url(self) -> str:
+        return f"{self.issuer}/.well-known/jwks.json"
+
+    def add_key(self, kid: str, publish: bool = True):
+        _, private_key = rsa.newkeys(1024)
+        pem = private_key.save_pkcs1().decode()
+        self.private_keys[kid] = pem
+        if publish:
+            self.publish_key(kid)
+
+    def publish_key(self, kid: str):
+        public_key = jwk.construct(self.private_keys[kid], "RS256").public_key().to_dict()
+        public_key["kid"] = kid
+        self.public_keys[kid] = public_key
+
+    def token(self, kid: str, sub: str = "test-sub", expires_in: int = 3600, **claims) -> str:
+        payload = {"sub": sub, "iss": self.issuer, "aud": self.audience,
+                   "exp": int(time.time()) + expires_in, **claims}
+        return jwt.encode(payload, self.private_keys[kid], algorithm = "RS256", headers = {"kid": kid})
@@ -0,0 +1,179 @@
+import asyncio
+import ipaddress
+from threading import Event, Thread
+from time import perf_counter, sleep
+from types import SimpleNamespace
+from pytest import fixture, raises
+from fastapi import HTTPException, Request
+from api.db_info import auth
+from api.db_info.jwks import JWKSKeyStore
+from api.db_info.token_cache import VerifiedTokenCache
+from tests.jwks_stub import JWKSStub
+
+## HELPER COMPONENTS
+
+def request_with(token: str):
+    return SimpleNamespace(headers = {"Authorization": f"Bearer {token}"})
+
+# BEFORE and AFTER
+
+@fixture(scope="module")
+def stub():
+    with JWKSStub() as jwks_stub:
+        jwks_stub.add_key("key-1")
+        jwks_stub.add_key("key-2", publish = False)
+        yield jwks_stub
+
+@fixture(scope="function")
+def key_store(stub, monkeypatch):
+    monkeypatch.setenv("COGNITO_ISSUER", stub.issuer)
+    monkeypatch.setenv("COGNITO_AUDIENCE", stub.audience)
+    stub.available = True
+    stub.public_keys.pop("key-2", None)
+    store = JWKSKeyStore(jwks_url = stub.jwks_url, ttl = 60, min_refresh_interval = 60)
+    monkeypatch.setattr(auth, "key_store", store)
+    auth.token_cache.clear()
+    yield store
+    store.stop_background_refresh()
+
+## UNIT TESTS
+
+def test_keys_are_cached(stub, key_store):
+    for _ in range(5):
+        decoded_token = auth.verify_access(request_with(stub.token("key-1", sub = "cached")))
+        assert decoded_token["sub"] == "cached"
+    assert key_store.fetch_count == 1
+
+def test_unknown_kid_forces_refresh(stub, key_store):
+    auth.verify_access(request_with(stub.token("key-1")))
+    stub.publish_key("key-2")
+
+    decoded_token = auth.verify_access(request_with(stub.token("key-2", sub = "rotated")))
+    assert decoded_token["sub"] == "rotated"
+    assert key_store.fetch_count == 2
+
+def test_forced_refresh_is_rate_limited(stub, key_store):
+    auth.verify_access(request_with(stub.token("key-1")))
+
+    for _ in range(5):
+        with raises(HTTPException) as error:
+            auth.verify_access(request_with(stub.token("key-2")))
+        assert error.value.status_code == 401
+    assert key_store.fetch_count == 2
+
+def test_stale_keys_served_while_issuer_down(stub, key_store):
+    key_store.refresh()
+    key_store.ttl = 0
+    key_store.min_refresh_interval = 0
+    stub.available = False
+
+    decoded_token = auth.verify_access(request_with(stub.token("key-1", sub = "stale")))
+    assert decoded_token["sub"] == "stale"
+    assert key_store.keys
+
+def test_slow_refresh_does_not_block_cached_keys(stub, key_store):
+    key_store.refresh()
+    key_store.ttl = 0
+    key_store.min_refresh_interval = 0
+    fetching = Event()
+    release = Event()
+    fetcher = key_store.fetcher
+    def slow_fetcher(url, timeout):
+        fetching.set()
+        release.wait(5)
+        return fetcher(url, timeout)
+    key_store.fetcher = slow_fetcher
+
+    refresh = Thread(target = key_store.get_key, args = ("key-1",))
+    refresh.start()
+    assert fetching.wait(5)
+    # Served from the current keys while the other thread is still fetching
+    start = perf_counter()
+    assert key_store.get_key("key-1")["kid"] == "key-1"
+    assert perf_counter() - start < 1
+    assert key_store.fetch_count == 2
+    release.set()
+    refresh.join()
+
+def test_issuer_down_without_keys(stub, key_store):
+    stub.available = False
+
+    with raises(HTTPException) as error:
+        auth.verify_access(request_with(stub.token("key-1")))
+    assert error.value.status_code == 400
+
+def test_background_refresh(stub, key_store):
+    key_store.start_background_refresh(interval = 0.05)
+    stub.publish_key("key-2")
+    for _ in range(100):
+        if "key-2" in key_store.keys:
+            break
+        sleep(0.01)
+    assert "key-2" in key_store.keys
+
+def test_verified_tokens_are_cached(stub, key_store, monkeypatch):
+    token = stub.token("key-1", sub = "cached")
+    auth.verify_access(request_with(token))
+
+    monkeypatch.setattr(auth.jwt, "decode", lambda *args, **kwargs: {"sub": "decoded again"})
+    decoded_token = auth.verify_access(request_with(token))
+    assert decoded_token["sub"] == "cached"
+    assert auth.token_cache.hits == 1
+
+def test_token_cache_expiry_and_bound():
+    cache = VerifiedTokenCache(maxsize = 2)
+    cache.put("expired", {"exp": 0})
+    assert cache.get("expired") == None
+
+    cache.put("no_exp", {"sub": "no_exp"})
+    assert cache.get("no_exp") == None
+
+    for token in ["first", "second", "third"]:
+        cache.put(token, {"sub": token, "exp": 2 ** 40})
+    assert len(cache) == 2
+    assert cache.get("first") == None
+    assert cache.get("third")["sub"] == "third"
+
+    assert VerifiedTokenCache(maxsize = 0).put("token", {"exp": 2 ** 40}) == None
+    assert len(VerifiedTokenCache(maxsize = 0)) == 0
+
+def test_get_claims_verifies_once(stub, key_store):
+    request = request_with(stub.token("key-1", sub = "once"))
+    request.state = SimpleNamespace()
+
+    assert asyncio.run(auth.get_claims(request))["sub"] == "once"
+    assert asyncio.run(auth.get_claims(request))["sub"] == "once"
+    assert auth.token_cache.hits == 0
+    assert auth.token_cache.misses == 1
+
+def test_verify_access_async(stub, key_store):
+    stub.publish_key("key-2")
+
+    decoded_token = asyncio.run(auth.verify_access_async(request_with(stub.token("key-2", sub = "async"))))
+    assert decoded_token["sub"] == "async"
+    assert key_store.fetch_count == 1
+
+    with raises(HTTPException) as error:
+        asyncio.run(auth.verify_access_async(request_with("not.a.token")))
+    assert error.value.status_code == 401
+
+def test_missing_authorization_header():
+    with raises(HTTPException) as error:
+        auth.verify_access(SimpleNamespace(headers = {}))
+    assert error.value.status_code == 401
+
+def test_client_address_behind_trusted_proxies(monkeypatch):
+    def request_from(address: str, *forwarded: str):
+        headers = [(b"x-forwarded-for", value.encode()) for value in forwarded]
+        return Request({"type": "http", "headers": headers, "client": (address, 1234)})
+    
+    # Without trusted proxies the forwarded addresses can't be trusted
+    assert auth.client_identity(request_from("10.0.0.5", "198.51.100.7")) == "ip:10.0.0.5"
+    
+    monkeypatch.setattr(auth, "TRUSTED_PROXIES", [ipaddress.ip_network("10.0.0.0/8")])
+    assert auth.client_identity(request_from("10.0.0.5", "198.51.100.7")) == "ip:198.51.100.7"
+    # The addresses a client prepends itself are ignored
+    assert auth.client_address(request_from("10.0.0.5", "203.0.113.9, 198.51.100.7")) == "198.51.100.7"
+    assert auth.client_address(request_from("10.0.0.5", "203.0.113.9", "198.51.100.7, 10.0.0.6")) == "198.51.100.7"
+    assert auth.client_address(request_from("10.0.0.5")) == "10.0.0.5"
+    assert auth.client_address(request_from("198.51.100.8", "203.0.113.9")) == "198.51.100.8"
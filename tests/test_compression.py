@@ -0,0 +1,90 @@
+import gzip
+import zlib
+from fastapi import FastAPI
+from fastapi.responses import Response, StreamingResponse
+from fastapi.testclient import TestClient
+from api.db_info import compression
+from api.db_info.compression import CompressionMiddleware, StreamCompressor, negotiate
+
+## HELPER COMPONENTS
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware, minimum_size = 100)
+
+@app.get("/small")
+def small():
+    return Response(b'{"a":1}', media_type = "application/json")
+
+@app.get("/large")
+def large():
+    return Response(b'{"a":1}' * 100, media_type = "application/json")
+
+@app.get("/tagged")
+def tagged():
+    return Response(b'{"a":1}' * 100, media_type = "application/json", headers = {"ETag": '"abc"'})
+
+@app.get("/image")
+def image():
+    return Response(b"\x89PNG" * 100, media_type = "image/png")
+
+@app.get("/stream")
+def stream():
+    return StreamingResponse((f'{{"row":{index}}}\n'.encode() for index in range(50)), media_type = "application/x-ndjson")
+
+@app.get("/events")
+def events():
+    return StreamingResponse((b"event: changes\ndata: {}\n\n" for _ in range(50)), media_type = "text/event-stream")
+
+client = TestClient(app)
+
+## UNIT TESTS
+
+def test_negotiate():
+    assert negotiate(None) is None
+    assert negotiate("identity") is None
+    assert negotiate("gzip, deflate") == "gzip"
+    assert negotiate("gzip;q=0") is None
+    assert negotiate("*") == compression.supported_encodings()[0]
+    assert negotiate("br;q=0.5, gzip;q=0.8") == "gzip"
+
+def test_stream_compressor_flushes_every_chunk():
+    compressor = StreamCompressor("gzip")
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    assert decompressor.decompress(compressor.compress(b"first")) == b"first"
+    assert decompressor.decompress(compressor.compress(b"second") + compressor.finish()) == b"second"
+
+def test_middleware_compresses_large_responses():
+    response = client.get("/large", headers = {"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert int(response.headers["Content-Length"]) < 700
+    assert response.content == b'{"a":1}' * 100
+    
+    response = client.get("/large", headers = {"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+    assert response.content == b'{"a":1}' * 100
+
+def test_middleware_skips_small_and_binary_responses():
+    for path in ("/small", "/image", "/events"):
+        response = client.get(path, headers = {"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+
+def test_middleware_compresses_streams():
+    response = client.get("/stream", headers = {"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    assert response.text.splitlines() == [f'{{"row":{index}}}' for index in range(50)]
+
+def test_compress_gzip_is_deterministic():
+    assert compression.compress(b"points", "gzip") == compression.compress(b"points", "gzip")
+    assert gzip.decompress(compression.compress(b"points", "gzip")) == b"points"
+
+def test_compressed_representations_have_their_own_etag():
+    assert client.get("/tagged", headers = {"Accept-Encoding": "identity"}).headers["ETag"] == '"abc"'
+    assert client.get("/tagged", headers = {"Accept-Encoding": "gzip"}).headers["ETag"] == '"abc-gzip"'
+    
+    assert compression.encoded_etag('"abc"', None) == '"abc"'
+    assert compression.encoded_etag('W/"abc"', "br") == 'W/"abc-br"'
+    assert compression.encoded_etag('"abc-gzip"', "gzip") == '"abc-gzip"'
+    assert [compression.identity_etag(tag) for tag in ('"abc"', ' W/"abc-br"', '"abc-gzip"')] == ['"abc"'] * 3
@@ -1,8 +1,13 @@
+import asyncio
+import threading
 from typing import List
 from pytest import fixture
-from unittest.mock import patch
+from sqlalchemy import create_engine, insert, inspect, select, text, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session
-from api.db_info import schemas, database, crud, models
+from api.db_info import schemas, database, crud, init_db, migrations, models
+from api.db_info.cache import AuthorizationMap, PointCatalogue
+from api.dependencies.database import run_crud
 
 ## HELPER COMPONENTS
 
@@ -34,12 +39,15 @@ def db():
     session = database.SessionLocal(bind = connection)
 
     database.Base.metadata.create_all(bind = connection)
+    crud.authorization_map.clear()
 
     try:
         yield session
     finally:
-        transaction.rollback()
+        if transaction.is_active:
+            transaction.rollback()
         connection.close()
+        crud.authorization_map.clear()
 
 ## UNIT TESTS
 
@@ -55,6 +63,12 @@ def test_get_points(db):
     assert len(points) == 6
     assert points[0].name == points_bucket[0].name
     
+def test_has_points(db):
+    
+    assert crud.has_points(db = db) == False
+    add_points_to_db(db = db, points = [points_bucket[0]])
+    assert crud.has_points(db = db) == True
+
 def test_get_point_id(db):
     
     point = crud.get_point_id(db = db, id = 1)
@@ -80,11 +94,9 @@ def test_get_point_by_name(db):
     assert point != None
     assert point.name == points_bucket[0].name
 
-@patch("api.db_info.auth.verify_access")
-def test_get_auth(mock_verify_access, db):
-    mock_verify_access.return_value = {"sub":"None"}
+def test_get_auth(db):
     
-    access = crud.get_auth(db = db, request = None)
+    access = crud.get_auth(db = db, claims = {"sub":"None"})
     assert access == (None, None)
 
     add_points_to_db(db, [points_bucket[0]])
@@ -97,10 +109,53 @@ def test_get_auth(mock_verify_access, db):
     db.add(new_entry)
     db.commit()
     
-    mock_verify_access.return_value = {"sub":"fake_sub_identifier"}
-    
-    access = crud.get_auth(db = db, request = None)
+    access = crud.get_auth(db = db, claims = {"sub":"fake_sub_identifier"})
     assert access == ("fake_name", point.id)
+    assert crud.authorization_map.peek("fake_sub_identifier") == ("fake_name", point.id)
+
+def test_create_and_delete_authorization(db):
+    
+    add_points_to_db(db, [points_bucket[0]])
+    point = crud.get_points(db)[0]
+    new_authorization = schemas.AuthorizationCreate(sub = "fake_sub_identifier", name = "fake_name", point_id = point.id)
+    
+    authorization = crud.create_authorization(db = db, new_authorization = new_authorization)
+    assert authorization.sub == "fake_sub_identifier"
+    assert crud.create_authorization(db = db, new_authorization = schemas.AuthorizationCreate(sub = "other", name = "other", point_id = point.id + 1)) == None
+    
+    crud.load_authorizations(db)
+    assert crud.get_auth(db = db, claims = {"sub":"fake_sub_identifier"}) == ("fake_name", point.id)
+    assert crud.get_authorization(db = db, sub = "fake_sub_identifier").dropoff_point.name == point.name
+    assert len(crud.get_authorizations(db)) == 1
+    
+    # Revocations only drop the authorization maps, not the points catalogue
+    (points_version, authorizations_version) = (crud.invalidation_bus.current_version(), crud.authorization_bus.current_version())
+    assert crud.delete_authorization(db = db, sub = "fake_sub_identifier") == "OK"
+    assert crud.delete_authorization(db = db, sub = "fake_sub_identifier") == None
+    assert crud.get_auth(db = db, claims = {"sub":"fake_sub_identifier"}) == (None, None)
+    assert crud.invalidation_bus.current_version() == points_version
+    assert crud.authorization_bus.current_version() == authorizations_version + 1
+    
+    # A second authorization of the same user is rejected by the unique constraint. Its rollback ends the test transaction
+    assert crud.create_authorization(db = db, new_authorization = new_authorization).sub == "fake_sub_identifier"
+    assert crud.create_authorization(db = db, new_authorization = new_authorization) == None
+
+def test_authorization_map_ttl():
+    authorization_map = AuthorizationMap(ttl = 60)
+    assert authorization_map.get("sub") == None
+    
+    authorization_map.load([models.AuthorizationToPoint(id = 1, sub = "sub", name = "name", point_id = 3)])
+    assert authorization_map.get("sub") == ("name", 3)
+    assert authorization_map.last_id == 1
+    
+    authorization_map.update([models.AuthorizationToPoint(id = 4, sub = "other", name = "other", point_id = 2)])
+    assert authorization_map.get("other") == ("other", 2)
+    assert authorization_map.last_id == 4
+    assert authorization_map.stats()["hits"] == 2
+    
+    authorization_map.ttl = 0
+    assert authorization_map.is_stale()
+    assert authorization_map.get("sub") == None
 
 def test_create_point(db):
     
@@ -117,6 +172,49 @@ def test_create_point(db):
     
     points = crud.get_points(db = db)
     assert len(points) == 1
+    assert point.id == points[0].id
+
+def test_create_point_conflict(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'points.db'}")
+    database.Base.metadata.create_all(bind = engine)
+    new_point = schemas.PointCreate(name = "DETI", location = "Departamento 4", coordinates = "40.63331148617483, -8.659589862642955", image = None)
+    
+    with Session(engine) as session:
+        assert crud.create_point(db = session, new_point = new_point).id == 1
+        point = crud.create_point(db = session, new_point = new_point.model_copy(update = {"name": "other"}))
+        assert point == None
+        point = crud.create_point(db = session, new_point = new_point.model_copy(update = {"coordinates": "40.6, -8.6"}))
+        assert point == None
+        point = crud.create_point(db = session, new_point = new_point.model_copy(update = {"name": "other", "coordinates": "40.6, -8.6"}))
+        assert point.name == "other"
+        assert [(stored.name, stored.latitude) for stored in crud.get_points(session)] == [("DETI", 40.63331148617483), ("other", 40.6)]
+        # The failed creates gave their sync versions back
+        assert crud.get_sync_state(session) == (2, 0)
+    
+    engine.dialect.insert_returning = False
+    with Session(engine) as session:
+        point = crud.create_point(db = session, new_point = new_point.model_copy(update = {"name": "third", "coordinates": "40.7, -8.7"}))
+        assert (point.id, point.name) == (3, "third")
+
+def test_next_version_when_another_writer_created_the_counter(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'points.db'}")
+    database.Base.metadata.create_all(bind = engine)
+    new_point = schemas.PointCreate(name = "DETI", location = "Departamento 4", coordinates = "40.63331148617483, -8.659589862642955", image = None)
+    
+    with Session(engine) as session:
+        execute = session.execute
+        def execute_after_race(statement, *args, **kwargs):
+            # A concurrent writer creates the counter row right after this one found none to increment
+            if getattr(statement, "is_update", False) and statement.table.name == "sync_state" and not race:
+                race.append(execute(insert(models.SyncState).values(id = 1, version = 1, compacted_version = 0)))
+                return execute(update(models.SyncState).where(models.SyncState.id == 0).values(version = 0))
+            return execute(statement, *args, **kwargs)
+        race = []
+        session.execute = execute_after_race
+        
+        assert crud.create_point(db = session, new_point = new_point).name == "DETI"
+        assert crud.get_sync_state(session) == (2, 0)
+        assert [point["name"] for point in crud.get_changes(session, 1)["points"]] == ["DETI"]
 
 def test_delete_point(db):
     
@@ -136,4 +234,249 @@ def test_delete_point(db):
     assert return_value == "OK"
     
     points = crud.get_points(db = db)
-    assert len(points) == 0
\ No newline at end of file
+    assert len(points) == 0
+
+def test_get_points_page(db):
+    
+    assert crud.get_points_page(db = db, limit = 2) == []
+    
+    add_points_to_db(db, points_bucket)
+    
+    page = crud.get_points_page(db = db, limit = 4, fields = ["name", "coordinates"])
+    assert len(page) == 4
+    assert set(page[0].keys()) == {"id", "name", "coordinates"}
+    assert page[0]["name"] == points_bucket[0].name
+    
+    next_page = crud.get_points_page(db = db, limit = 4, after_id = page[-1]["id"])
+    assert [point["name"] for point in next_page] == [point.name for point in points_bucket[4:]]
+    assert set(next_page[0].keys()) == set(crud.POINT_FIELDS)
+    
+    assert crud.get_points_page(db = db, limit = 1, offset = 5)[0]["name"] == points_bucket[5].name
+
+def test_point_latitude_longitude(db):
+    
+    add_points_to_db(db, points_bucket)
+    point = crud.get_point_by_name(db = db, name = "DETI")
+    assert (point.latitude, point.longitude) == (40.63331148617483, -8.659589862642955)
+    
+    crud.create_point(db = db, new_point = schemas.PointCreate(name = "new_name", location = "new_location", coordinates = "new_coordinates", image = None))
+    point = crud.get_point_by_name(db = db, name = "new_name")
+    assert (point.latitude, point.longitude) == (None, None)
+
+def test_get_nearest_points(db):
+    
+    assert crud.get_nearest_points(db = db, latitude = 40.63, longitude = -8.65, k = 3) == []
+    
+    add_points_to_db(db, points_bucket)
+    
+    nearest = crud.get_nearest_points(db = db, latitude = 40.6332, longitude = -8.6596, k = 2)
+    assert [point.name for (_, point) in nearest] == ["DETI", "Reitoria"]
+    assert nearest[0][0] < nearest[1][0]
+    
+    nearest = crud.get_nearest_points(db = db, latitude = 40.6332, longitude = -8.6596, k = 6, radius_km = 0.1)
+    assert [point.name for (_, point) in nearest] == ["DETI"]
+
+def test_migrate_coordinates(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE points (id INTEGER PRIMARY KEY, name VARCHAR(30), location VARCHAR(50), coordinates VARCHAR(200), image VARCHAR(500))"))
+        connection.execute(text("INSERT INTO points (name, location, coordinates) VALUES ('DETI', 'Departamento 4', '40.63331148617483, -8.659589862642955'), ('Other', 'Nowhere', 'unknown')"))
+    
+    assert migrations.migrate_coordinates(engine) == 1
+    assert migrations.migrate_coordinates(engine) == 0
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT name, latitude, longitude FROM points ORDER BY id")).all()
+    assert rows == [("DETI", 40.63331148617483, -8.659589862642955), ("Other", None, None)]
+    assert "ix_points_latitude_longitude" in {index["name"] for index in inspect(engine).get_indexes("points")}
+
+def test_migrate_sync(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE points (id INTEGER PRIMARY KEY, name VARCHAR(30), location VARCHAR(50), coordinates VARCHAR(200), image VARCHAR(500))"))
+        connection.execute(text("INSERT INTO points (name, location, coordinates) VALUES ('DETI', 'Departamento 4', '40.63331148617483, -8.659589862642955')"))
+    
+    init_db.create_schema(engine)
+    assert not migrations.migrate_sync(engine)
+    assert "ix_points_version" in {index["name"] for index in inspect(engine).get_indexes("points")}
+    with Session(engine) as db:
+        assert crud.get_sync_state(db) == (0, 0)
+        assert [point["name"] for point in crud.get_changes(db, 0)["points"]] == ["DETI"]
+        crud.create_point(db, schemas.PointCreate(name = "CP", location = "Departamento 23", coordinates = "40.6, -8.6", image = None))
+        assert [point["name"] for point in crud.get_changes(db, 0)["points"]] == ["DETI", "CP"]
+        crud.create_point(db, schemas.PointCreate(name = "DETI 2", location = "Departamento 4", coordinates = "40.7, -8.7", image = None))
+        assert [point["name"] for point in crud.get_changes(db, 1)["points"]] == ["DETI 2"]
+
+def test_get_points_by_keys(db):
+    crud.bulk_create_points(db, [schemas.PointCreate(name = name, location = "location", coordinates = f"40.{index}, -8.{index}", image = None)
+                                 for (index, name) in enumerate(["first", "second", "third"])])
+    first = crud.get_point_by_name(db, "first")
+    
+    points = crud.get_points_by_keys(db, names = ["second", "missing", "second"], ids = [first.id, 999])
+    assert sorted(point.name for point in points) == ["first", "second"]
+    assert crud.get_points_by_keys(db, ids = [first.id])[0]._asdict() == {"id": first.id, "name": "first", "location": "location", "coordinates": "40.0, -8.0", "image": None}
+    assert crud.get_points_by_keys(db) == []
+
+def test_search_points(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'search.db'}")
+    init_db.create_schema(engine)
+    assert not migrations.migrate_search(engine)
+    with Session(engine) as db:
+        init_db.seed(db)
+        assert [point.name for point in crud.search_points(db, "pavilhao", 10)] == ["Pavilhão Aristides Hall"]
+        assert [point.name for point in crud.search_points(db, "CANT", 10)] == ["Cantina de Santiago", "Cantina do Crasto"]
+        assert len(crud.search_points(db, "departamento", 3)) == 3
+        assert crud.search_points(db, "", 10) == []
+        
+        crud.delete_point(db, "DETI")
+        crud.create_point(db, schemas.PointCreate(name = "Órgão", location = "Departamento 9", coordinates = "40.6, -8.6", image = None))
+        assert crud.search_points(db, "deti", 10) == []
+        assert [point.name for point in crud.search_points(db, "orgao", 10)] == ["Órgão"]
+        
+        db.execute(text("DROP TABLE points_search"))
+        db.commit()
+        assert [point.name for point in crud.search_points(db, "pavilhao", 10)] == ["Pavilhão Aristides Hall"]
+
+def test_get_changes(db):
+    assert crud.get_changes(db, 0) == {"version": 0, "points": [], "deleted": []}
+    
+    reitoria = crud.create_point(db, schemas.PointCreate(name = "Reitoria", location = "Departamento 25", coordinates = "40.63, -8.65", image = None))
+    crud.bulk_create_points(db, [schemas.PointCreate(name = name, location = "location", coordinates = f"40.{index}, -8.{index}", image = None)
+                                 for (index, name) in enumerate(["first", "second", "third"])])
+    after_creates = crud.get_changes(db, 0)
+    assert after_creates["version"] == 2
+    assert [point["name"] for point in after_creates["points"]] == ["Reitoria", "first", "second", "third"]
+    assert db.execute(select(models.Point.updated_at).where(models.Point.name == "first")).scalar() is not None
+    
+    crud.delete_point(db, "Reitoria")
+    crud.bulk_delete_points(db, ["first", "missing"])
+    crud.create_point(db, schemas.PointCreate(name = "Reitoria", location = "Departamento 25", coordinates = "40.63, -8.65", image = "image"))
+    changes = crud.get_changes(db, 2)
+    assert changes["version"] == 5
+    assert [(point["name"], point["image"]) for point in changes["points"]] == [("Reitoria", "image")]
+    assert changes["deleted"] == [{"id": reitoria.id, "name": "Reitoria"}, {"id": after_creates["points"][1]["id"], "name": "first"}]
+    assert crud.get_changes(db, 5) == {"version": 5, "points": [], "deleted": []}
+    assert crud.get_changes(db, 0)["deleted"] == []
+    assert crud.get_changes(db, 0, delta = True)["deleted"] == changes["deleted"]
+    assert crud.get_changes(db, 6) is None
+
+def test_compact_tombstones(db):
+    crud.bulk_create_points(db, [schemas.PointCreate(name = name, location = "location", coordinates = f"40.{index}, -8.{index}", image = None)
+                                 for (index, name) in enumerate(["first", "second"])])
+    crud.delete_point(db, "first")
+    
+    assert crud.compact_tombstones(db, horizon = 3600) == 0
+    assert crud.get_changes(db, 1)["deleted"] == [{"id": 1, "name": "first"}]
+    assert crud.compact_tombstones(db, horizon = -1) == 1
+    assert crud.get_sync_state(db) == (2, 2)
+    assert crud.get_changes(db, 1) is None
+    assert crud.get_changes(db, 2) == {"version": 2, "points": [], "deleted": []}
+    assert [point["name"] for point in crud.get_changes(db, 0)["points"]] == ["second"]
+
+def test_bulk_create_points(db):
+    
+    add_points_to_db(db, [points_bucket[0]])
+    version = crud.invalidation_bus.current_version()
+    
+    new_points = [
+        schemas.PointCreate(name = "first", location = "location", coordinates = "40.1, -8.1", image = None),
+        schemas.PointCreate(name = points_bucket[0].name, location = "location", coordinates = "40.2, -8.2", image = None),
+        schemas.PointCreate(name = "first", location = "location", coordinates = "40.3, -8.3", image = None),
+        schemas.PointCreate(name = "second", location = "location", coordinates = points_bucket[0].coordinates, image = None),
+        schemas.PointCreate(name = "third", location = "location", coordinates = "40.4, -8.4", image = None),
+    ]
+    results = crud.bulk_create_points(db = db, new_points = new_points)
+    assert [result["status"] for result in results] == ["created", "conflict", "conflict", "conflict", "created"]
+    assert results[0]["id"] == crud.get_point_by_name(db = db, name = "first").id
+    assert crud.get_point_by_name(db = db, name = "third").latitude == 40.4
+    assert len(crud.get_points(db = db)) == 3
+    assert crud.invalidation_bus.current_version() == version + 1
+    
+    results = crud.bulk_create_points(db = db, new_points = new_points[:1])
+    assert results == [{"name": "first", "status": "conflict"}]
+    assert crud.invalidation_bus.current_version() == version + 1
+
+def test_bulk_delete_points(db):
+    
+    add_points_to_db(db, points_bucket)
+    
+    results = crud.bulk_delete_points(db = db, names = ["DETI", "missing", "CP"])
+    assert results == [{"name": "DETI", "status": "deleted"}, {"name": "missing", "status": "not_found"}, {"name": "CP", "status": "deleted"}]
+    assert len(crud.get_points(db = db)) == 4
+    assert crud.get_point_by_name(db = db, name = "DETI") == None
+
+def test_load_point_catalogue(db):
+    crud.point_catalogue.invalidate()
+    assert crud.point_catalogue.current() == None
+    
+    add_points_to_db(db, points_bucket)
+    snapshot = crud.load_point_catalogue(db)
+    assert len(snapshot.points) == 6
+    assert snapshot.by_name["DETI"].location == "Departamento 4"
+    assert snapshot.by_id[snapshot.by_name["CP"].id].name == "CP"
+    assert crud.point_catalogue.current() is snapshot
+
+def test_point_catalogue_invalidated_on_write(db):
+    crud.load_point_catalogue(db)
+    version = crud.invalidation_bus.current_version()
+    
+    new_point = schemas.PointCreate(name = "new_name", location = "new_location", coordinates = "new_coordinates", image = None)
+    crud.create_point(db = db, new_point = new_point)
+    assert crud.point_catalogue.current() == None
+    assert crud.invalidation_bus.current_version() == version + 1
+    assert "new_name" in crud.load_point_catalogue(db).by_name
+    
+    crud.delete_point(db = db, name = "new_name")
+    assert crud.point_catalogue.current() == None
+    assert crud.load_point_catalogue(db).points == []
+
+def test_point_catalogue_ttl_and_concurrent_writes():
+    catalogue = PointCatalogue(ttl = 0)
+    catalogue.install([], catalogue.generation)
+    assert catalogue.current() == None
+    
+    catalogue = PointCatalogue(ttl = 60)
+    generation = catalogue.generation
+    catalogue.invalidate()
+    catalogue.install([], generation)
+    assert catalogue.current() == None
+    assert catalogue.stats()["misses"] == 1
+
+def test_point_catalogue_search_index_derived_from_previous():
+    catalogue = PointCatalogue(ttl = 60)
+    points = [{"id": index, "name": name, "location": "Departamento", "coordinates": f"40.{index}, -8.{index}", "image": None}
+              for (index, name) in enumerate(["Pavilhão", "Cantina"] + [f"Departamento {number}" for number in range(10)])]
+    first = catalogue.install(points, catalogue.generation).search_index
+    
+    catalogue.invalidate()
+    snapshot = catalogue.install(points[1:] + [{**points[0], "id": 99, "name": "Biblioteca"}], catalogue.generation)
+    assert [point.name for point in snapshot.search_index.search("bib", 10)] == ["Biblioteca"]
+    assert snapshot.search_index.search("pav", 10) == []
+    assert snapshot.search_index.postings["cantina"] is first.postings["cantina"]
+    assert [point.name for point in first.search("pav", 10)] == ["Pavilhão"]
+
+def test_crud_on_async_session(tmp_path, monkeypatch):
+    publish_threads = []
+    monkeypatch.setattr(crud.invalidation_bus, "publish", lambda: publish_threads.append(threading.current_thread()))
+    
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'async.db'}")
+        async with engine.begin() as connection:
+            await connection.run_sync(database.Base.metadata.create_all)
+        async with async_sessionmaker(engine, expire_on_commit = False)() as session:
+            assert await run_crud(crud.get_points, session) == []
+            
+            new_point = schemas.PointCreate(**{key: f"new_{key}" for key in ["name", "location", "coordinates", "image"]})
+            point = await run_crud(crud.create_point, session, new_point = new_point)
+            assert point.id != None
+            
+            point = await run_crud(crud.get_point_by_name, session, name = "new_name")
+            assert point.location == "new_location"
+            
+            assert await run_crud(crud.delete_point, session, "new_name") == "OK"
+            assert await run_crud(crud.get_points, session) == []
+        await engine.dispose()
+    
+    asyncio.run(scenario())
+    # Publishing the changes is a network call with Redis, kept off the event loop
+    assert len(publish_threads) == 2
+    assert threading.main_thread() not in publish_threads
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+from api.services.events import HEARTBEAT, RESYNC, Broadcaster, Event
+
+## UNIT TESTS
+
+def test_event_encodings():
+    event = Event("changes", {"version": 3, "points": []}, id = 3)
+    assert event.sse == b'id: 3\nevent: changes\ndata: {"version":3,"points":[]}\n\n'
+    assert event.json == '{"type":"changes","id":3,"data":{"version":3,"points":[]}}'
+    assert Event("resync", {}).sse == b"event: resync\ndata: {}\n\n"
+
+def test_events_fan_out_to_every_subscriber():
+    broadcaster = Broadcaster(queue_size = 4, heartbeat = 10)
+
+    async def run():
+        subscribers = [broadcaster.subscribe() for _ in range(3)]
+        events = [Event("changes", {"version": version}, id = version) for version in (1, 2)]
+        for event in events:
+            broadcaster.publish(event)
+        received = []
+        for subscriber in subscribers:
+            stream = broadcaster.events(subscriber)
+            received.append([await stream.__anext__(), await stream.__anext__()])
+            await stream.aclose()
+        return (events, received)
+
+    (events, received) = asyncio.run(run())
+    assert received == [events] * 3
+    assert broadcaster.stats() == {"subscribers": 0, "published": 2, "dropped": 0}
+
+def test_slow_subscriber_is_dropped():
+    broadcaster = Broadcaster(queue_size = 2, heartbeat = 10)
+
+    async def run():
+        slow = broadcaster.subscribe()
+        fast = broadcaster.subscribe()
+        fast_stream = broadcaster.events(fast)
+        received = []
+        for version in range(4):
+            broadcaster.publish(Event("changes", {}, id = version))
+            received.append((await fast_stream.__anext__()).id)
+        slow_events = [event async for event in broadcaster.events(slow)]
+        assert broadcaster.subscribers == {fast}
+        return (received, slow_events)
+
+    (received, slow_events) = asyncio.run(run())
+    assert received == [0, 1, 2, 3]
+    assert slow_events == [RESYNC]
+    assert broadcaster.stats()["dropped"] == 1
+
+def test_heartbeat_and_stop():
+    broadcaster = Broadcaster(queue_size = 2, heartbeat = 0.01)
+
+    async def run():
+        broadcaster.start()
+        stream = broadcaster.events(broadcaster.subscribe())
+        heartbeat = await stream.__anext__()
+        broadcaster.stop()
+        return (heartbeat, [event async for event in stream])
+
+    assert asyncio.run(run()) == (HEARTBEAT, [])
+    assert broadcaster.stats()["subscribers"] == 0
+
+def test_signal_from_another_thread():
+    broadcaster = Broadcaster()
+    broadcaster.signal()
+
+    async def run():
+        broadcaster.start()
+        threading.Thread(target = broadcaster.signal).start()
+        await asyncio.wait_for(broadcaster.wait_for_change(), 1)
+
+    asyncio.run(run())
@@ -0,0 +1,43 @@
+import random
+from pytest import approx
+from api.db_info.geo import GridIndex, bounding_box, haversine_km, parse_coordinates
+
+## UNIT TESTS
+
+def test_parse_coordinates():
+    assert parse_coordinates("40.631417730224, -8.657526476133642") == (40.631417730224, -8.657526476133642)
+    assert parse_coordinates("-123456789 123456") == None
+    assert parse_coordinates("40.6 -8.6") == (40.6, -8.6)
+    assert parse_coordinates("new_coordinates") == None
+    assert parse_coordinates(None) == None
+
+def test_haversine_km():
+    assert haversine_km(40.63, -8.65, 40.63, -8.65) == 0
+    assert haversine_km(0, 0, 0, 1) == approx(111.195, rel = 1e-3)
+    assert haversine_km(40.631417730224, -8.657526476133642, 40.62450887522072, -8.656864475040406) == approx(0.77, abs = 0.01)
+
+def test_bounding_box():
+    (min_latitude, max_latitude, min_longitude, max_longitude) = bounding_box(40.63, -8.65, 10)
+    for bearing_point in [(40.63 + 0.0899, -8.65), (40.63, -8.65 + 0.1183), (40.63, -8.65 - 0.1183)]:
+        assert haversine_km(40.63, -8.65, *bearing_point) <= 10.01
+        assert min_latitude <= bearing_point[0] <= max_latitude
+        assert min_longitude <= bearing_point[1] <= max_longitude
+    assert bounding_box(89.99, 0, 10)[2:] == (-180.0, 180.0)
+    assert bounding_box(0, 179.99, 10)[2:] == (-180.0, 180.0)
+
+def test_grid_index_matches_brute_force():
+    random.seed(9)
+    entries = [(random.uniform(40.5, 40.8), random.uniform(-8.8, -8.5), index) for index in range(2000)]
+    index = GridIndex(entries)
+    
+    for (latitude, longitude) in [(40.63, -8.65), (40.5, -8.8), (38.72, -9.14), (-33.86, 151.2)]:
+        for (k, radius_km) in [(1, None), (10, None), (10, 0.5), (3, 0.001)]:
+            expected = sorted((haversine_km(latitude, longitude, entry[0], entry[1]), entry[2]) for entry in entries)
+            if radius_km is not None:
+                expected = [entry for entry in expected if entry[0] <= radius_km]
+            found = index.nearest(latitude, longitude, k, radius_km)
+            assert [distance for (distance, _) in found] == approx([distance for (distance, _) in expected[:k]])
+
+def test_grid_index_empty():
+    assert GridIndex([]).nearest(40.63, -8.65, 5) == []
+    assert GridIndex([(40.63, -8.65, "only")]).nearest(0, 0, 5)[0][1] == "only"
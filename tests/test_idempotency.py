@@ -0,0 +1,37 @@
+from pytest import raises
+from api.db_info.idempotency import IdempotencyConflict, IdempotencyStore
+
+## UNIT TESTS
+
+def test_idempotency_store_replays_completed_writes():
+    store = IdempotencyStore(maxsize = 10, ttl = 60)
+    fingerprint = store.fingerprint({"name": "point1"})
+    
+    assert store.begin("key", fingerprint) == None
+    with raises(IdempotencyConflict) as conflict:
+        store.begin("key", fingerprint)
+    assert conflict.value.in_flight
+    
+    store.complete("key", fingerprint, 201, {"id": 1})
+    assert store.begin("key", fingerprint) == (201, {"id": 1})
+    assert store.replays == 1
+    with raises(IdempotencyConflict) as conflict:
+        store.begin("key", store.fingerprint({"name": "point2"}))
+    assert not conflict.value.in_flight
+
+def test_idempotency_store_release_and_bounds():
+    store = IdempotencyStore(maxsize = 2, ttl = 60)
+    
+    assert store.begin("key", "a") == None
+    store.release("key")
+    assert store.begin("key", "a") == None
+    
+    for key in ("other", "third"):
+        store.begin(key, "a")
+        store.complete(key, "a", 201, {})
+    assert len(store) == 2
+    assert store.begin("key", "a") == None
+    
+    store = IdempotencyStore(maxsize = 2, ttl = 0)
+    store.complete("key", "a", 201, {})
+    assert store.begin("key", "a") == None
@@ -0,0 +1,152 @@
+import asyncio
+import io
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from pytest import fixture, raises
+from api.services.images import FileImageFetcher, HTTPImageFetcher, ImageCache, ImageError, ImageService, is_public_address, resize
+
+## HELPER COMPONENTS
+
+def make_image(width: int, height: int, mode: str = "RGB", image_format: str = "JPEG") -> bytes:
+    output = io.BytesIO()
+    Image.new(mode, (width, height), "red").save(output, image_format)
+    return output.getvalue()
+
+class CountingFetcher(FileImageFetcher):
+    def __init__(self, root: str):
+        super().__init__(root)
+        self.calls = 0
+
+    async def fetch(self, url: str) -> bytes:
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return await super().fetch(url)
+
+class ImageHost(BaseHTTPRequestHandler):
+    routes = {
+        "/room.jpg": (200, {}, make_image(40, 30)),
+        "/moved.jpg": (302, {"Location": "/room.jpg"}, b""),
+        "/metadata.jpg": (302, {"Location": "http://169.254.169.254/latest/meta-data/"}, b""),
+        "/loop.jpg": (302, {"Location": "/loop.jpg"}, b""),
+        "/large.jpg": (200, {}, b"0" * 2048),
+    }
+
+    def do_GET(self):
+        (status, headers, body) = self.routes.get(self.path, (404, {}, b""))
+        self.send_response(status)
+        for (name, value) in {**headers, "Content-Length": str(len(body))}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# BEFORE and AFTER
+
+@fixture(scope="module")
+def image_host():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHost)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+@fixture
+def sources(tmp_path):
+    directory = tmp_path / "sources"
+    directory.mkdir()
+    (directory / "room.jpg").write_bytes(make_image(1200, 800))
+    (directory / "logo.png").write_bytes(make_image(400, 400, "RGBA", "PNG"))
+    (directory / "broken.jpg").write_bytes(b"not an image")
+    return str(directory)
+
+@fixture
+def service(tmp_path, sources):
+    return ImageService(CountingFetcher(sources), ImageCache(str(tmp_path / "cache")), widths = (160, 640))
+
+## UNIT TESTS
+
+def test_resize():
+    (content, media_type) = resize(make_image(1200, 800), 160)
+    assert media_type == "image/jpeg"
+    assert Image.open(io.BytesIO(content)).size == (160, 107)
+    
+    (content, media_type) = resize(make_image(100, 50), 160)
+    assert Image.open(io.BytesIO(content)).size == (100, 50)
+    
+    (content, media_type) = resize(make_image(400, 400, "RGBA", "PNG"), 160)
+    assert media_type == "image/png"
+    
+    with raises(ImageError):
+        resize(b"not an image", 160)
+
+def test_variant_width(service):
+    assert service.variant_width(None) == 640
+    assert service.variant_width(100) == 160
+    assert service.variant_width(161) == 640
+    assert service.variant_width(5000) == 640
+
+def test_service_fetches_each_source_once(service):
+    async def get_all():
+        return await asyncio.gather(*[service.get("https://images.example/room.jpg", width) for width in (100, 160, 600)])
+    
+    results = asyncio.run(get_all())
+    assert service.fetcher.calls == 1
+    assert [Image.open(io.BytesIO(content)).width for (_, content) in results] == [160, 160, 640]
+    assert results[0][0].digest == results[1][0].digest
+    
+    (image, content) = asyncio.run(service.get("file:///elsewhere/room.jpg", 640))
+    assert service.fetcher.calls == 2
+    assert asyncio.run(service.get("https://images.example/room.jpg", 640))[1] == results[2][1]
+    assert service.fetcher.calls == 2
+    assert service.stats()["fetches"] == 2
+
+def test_service_errors(service):
+    with raises(ImageError):
+        asyncio.run(service.get("https://images.example/missing.jpg"))
+    with raises(ImageError):
+        asyncio.run(service.get("https://images.example/broken.jpg"))
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ImageCache(str(tmp_path / "cache"), max_bytes = 250)
+    first = cache.put("first", b"1" * 100, "image/jpeg")
+    cache.put("second", b"2" * 100, "image/jpeg")
+    assert cache.get("first") is not None
+    cache.put("third", b"3" * 100, "image/png")
+    
+    assert cache.get("second") is None
+    assert cache.get("first").read() == b"1" * 100
+    assert cache.size == 200
+    assert sorted(os.listdir(cache.directory)) == sorted(os.path.basename(image.path) for image in (first, cache.get("third")))
+    
+    reopened = ImageCache(cache.directory, max_bytes = 250)
+    assert reopened.get("third").media_type == "image/png"
+    assert reopened.get("third").digest == cache.get("third").digest
+    assert reopened.size == 200
+
+def test_is_public_address():
+    assert is_public_address("93.184.216.34")
+    assert is_public_address("2606:2800:220:1:248:1893:25c8:1946")
+    for address in ("127.0.0.1", "10.1.2.3", "172.16.0.1", "192.168.1.1", "169.254.169.254", "0.0.0.0",
+                    "::1", "fe80::1", "fd00::1", "::ffff:127.0.0.1", "224.0.0.1"):
+        assert not is_public_address(address)
+
+def test_http_fetcher_refuses_internal_hosts(image_host):
+    fetcher = HTTPImageFetcher(timeout = 2)
+    for url in (f"{image_host}/room.jpg", "http://169.254.169.254/latest/meta-data/", "http://[::1]/room.jpg",
+                "file:///etc/passwd", "ftp://images.example/room.jpg"):
+        with raises(ImageError):
+            asyncio.run(fetcher.fetch(url))
+
+def test_http_fetcher_checks_redirects_and_size(image_host):
+    # Only the local image host is allowed, standing for a public host
+    fetcher = HTTPImageFetcher(timeout = 2, max_bytes = 1024, max_redirects = 2, is_allowed = lambda address: address == "127.0.0.1")
+    assert asyncio.run(fetcher.fetch(f"{image_host}/room.jpg")) == make_image(40, 30)
+    assert asyncio.run(fetcher.fetch(f"{image_host}/moved.jpg")) == make_image(40, 30)
+    
+    for path in ("/metadata.jpg", "/loop.jpg", "/large.jpg", "/missing.jpg"):
+        with raises(ImageError):
+            asyncio.run(fetcher.fetch(f"{image_host}{path}"))
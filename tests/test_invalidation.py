@@ -0,0 +1,82 @@
+from time import sleep
+import fakeredis
+from pytest import fixture
+from api.db_info.cache import PointCatalogue
+from api.db_info.invalidation import InMemoryInvalidationBus, RedisInvalidationBus
+
+## HELPER COMPONENTS
+
+def wait_until(condition, timeout: float = 2.0) -> bool:
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return True
+        sleep(0.01)
+    return condition()
+
+def replica(server: fakeredis.FakeServer, poll_interval: float = 0.05):
+    bus = RedisInvalidationBus(client = fakeredis.FakeRedis(server = server), poll_interval = poll_interval)
+    catalogue = PointCatalogue(ttl = 60)
+    bus.subscribe(lambda version: catalogue.invalidate())
+    catalogue.install([], catalogue.generation)
+    return (bus, catalogue)
+
+# BEFORE and AFTER
+
+@fixture(scope="function")
+def replicas():
+    server = fakeredis.FakeServer()
+    buses = []
+
+    def create(**kwargs):
+        (bus, catalogue) = replica(server, **kwargs)
+        buses.append(bus)
+        return (bus, catalogue)
+
+    yield create
+    for bus in buses:
+        bus.stop()
+
+## UNIT TESTS
+
+def test_in_memory_bus():
+    bus = InMemoryInvalidationBus()
+    versions = []
+    bus.subscribe(versions.append)
+    
+    assert bus.current_version() == 0
+    assert bus.publish() == 1
+    assert bus.publish() == 2
+    assert versions == [1, 2]
+    assert bus.current_version() == 2
+
+def test_redis_bus_invalidates_other_replicas(replicas):
+    (first_bus, first_catalogue) = replicas()
+    (second_bus, second_catalogue) = replicas()
+    first_bus.start()
+    second_bus.start()
+    sleep(0.1)
+    first_catalogue.install([], first_catalogue.generation)
+    second_catalogue.install([], second_catalogue.generation)
+    
+    version = first_bus.publish()
+    assert first_catalogue.current() == None
+    assert wait_until(lambda: second_catalogue.current() == None)
+    assert second_bus.seen_version == version
+    assert second_bus.current_version() == version
+
+def test_redis_bus_catches_up_on_missed_messages(replicas):
+    (bus, catalogue) = replicas()
+    bus.start()
+    sleep(0.1)
+    catalogue.install([], catalogue.generation)
+    
+    bus.client.incr(bus.version_key)
+    assert wait_until(lambda: catalogue.current() == None)
+
+def test_redis_bus_versions_are_monotonic(replicas):
+    (first_bus, _) = replicas()
+    (second_bus, _) = replicas()
+    
+    versions = [first_bus.publish(), second_bus.publish(), first_bus.publish()]
+    assert versions == sorted(versions)
+    assert len(set(versions)) == 3
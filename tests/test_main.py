@@ -1,6 +1,14 @@
+import asyncio
+import io
+import json
+import logging
+import time
+from PIL import Image
 from fastapi.testclient import TestClient
-from unittest.mock import patch
+from pytest import fixture
+from unittest.mock import AsyncMock, patch
 from api import main
+from api.db_info.rate_limit import InMemoryRateLimiter
 
 client = TestClient(main.app)
 
@@ -13,6 +21,38 @@ urls = {
     "delete_point": "/points/v1/points/name",
 }
 
+# BEFORE and AFTER
+
+@fixture(scope="module", autouse=True)
+def database_schema():
+    main.init_db.create_schema(main.database.engine)
+    if not main.database.ASYNC_MODE:
+        yield
+        return
+    # `sqlite:///:memory:` is a different database for the async engine, dropped when the engine is disposed on shutdown
+    asyncio.run(main.init_db.create_async_schema(main.database.async_engine))
+    with patch.object(type(main.database.async_engine), "dispose", AsyncMock()):
+        yield
+
+@fixture(autouse=True)
+def async_verify_access(monkeypatch):
+    # The tests patch `auth.verify_access`, which async mode reaches through `auth.verify_access_async`
+    async def verify_access_async(request):
+        return main.auth.verify_access(request)
+    monkeypatch.setattr(main.auth, "verify_access_async", verify_access_async)
+
+@fixture(autouse=True)
+def point_catalogue():
+    main.crud.point_catalogue.invalidate()
+    main.crud.authorization_map.clear()
+    main.rate_limiter.clear()
+    yield main.crud.point_catalogue
+    main.crud.point_catalogue.invalidate()
+    main.crud.authorization_map.clear()
+    main.rate_limiter.clear()
+
+## UNIT TESTS
+
 def test_base():
     response = client.get(urls["base"])
     assert response.status_code == 200
@@ -29,26 +69,29 @@ def test_get_all_points(mock_get_points):
     response = client.get(urls["get_all_points"])
     assert response.status_code == 200
     assert response.json() == mock_points
+    
+    response = client.get(urls["get_all_points"])
+    assert response.status_code == 200
+    assert response.json() == mock_points
+    assert mock_get_points.call_count == 1
 
-@patch("api.main.crud.get_point_by_name")
-def test_get_point_by_name(mock_get_point_by_name):
+@patch("api.main.crud.get_points")
+def test_get_point_by_name(mock_get_points):
     mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
-    mock_get_point_by_name.return_value = mock_point
+    mock_get_points.return_value = [mock_point]
     
     response = client.get(urls["get_point_by_name"]+"/point1")
     assert response.status_code == 200
     assert response.json() == mock_point
 
-    mock_get_point_by_name.return_value = None
     response = client.get(urls["get_point_by_name"]+"/999")
     assert response.status_code == 204
+    assert mock_get_points.call_count == 1
 
 @patch("api.main.auth.verify_access")
-@patch("api.main.crud.get_point_by_name")
 @patch("api.main.crud.create_point")
-def test_create_point(mock_create_point, mock_get_point_by_name, mock_verify_access):
+def test_create_point(mock_create_point, mock_verify_access):
     mock_verify_access.return_value = {"user": "dummy_user"}
-    mock_get_point_by_name.return_value = None
     mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
     mock_create_point.return_value = mock_point
     
@@ -56,11 +99,40 @@ def test_create_point(mock_create_point, mock_get_point_by_name, mock_verify_acc
     assert response.status_code == 201
     assert response.json() == mock_point
 
-    mock_get_point_by_name.return_value = mock_point
+    mock_create_point.return_value = None
     response = client.post(urls["create_point"], json = {"name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"})
     assert response.status_code == 409
     assert response.json() == {"detail": "POINT ALREADY REGISTERED"}
 
+@patch("api.main.auth.verify_access")
+@patch("api.main.crud.create_point")
+def test_create_point_idempotency_key(mock_create_point, mock_verify_access):
+    main.idempotency_store.clear()
+    mock_verify_access.return_value = {"sub": "dummy_user"}
+    mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
+    mock_create_point.return_value = mock_point
+    payload = {"name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
+    
+    response = client.post(urls["create_point"], json = payload, headers = {"Idempotency-Key": "key1"})
+    assert response.status_code == 201
+    mock_create_point.return_value = None
+    
+    response = client.post(urls["create_point"], json = payload, headers = {"Idempotency-Key": "key1"})
+    assert response.status_code == 201
+    assert response.json() == mock_point
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert mock_create_point.call_count == 1
+    
+    response = client.post(urls["create_point"], json = {**payload, "name": "point2"}, headers = {"Idempotency-Key": "key1"})
+    assert response.status_code == 422
+    
+    response = client.post(urls["create_point"], json = payload, headers = {"Idempotency-Key": "key2"})
+    assert response.status_code == 409
+    assert response.json() == {"detail": "POINT ALREADY REGISTERED"}
+    assert "Idempotent-Replayed" not in response.headers
+    assert mock_create_point.call_count == 2
+    main.idempotency_store.clear()
+
 @patch("api.main.auth.verify_access")
 @patch("api.main.crud.get_auth")
 def test_get_point_id_of_access(mock_get_auth, mock_verify_access):
@@ -75,12 +147,93 @@ def test_get_point_id_of_access(mock_get_auth, mock_verify_access):
         "name": mock_access[0],
         "point_id": mock_access[1]
     }
+    assert mock_verify_access.call_count == 1
+    mock_get_auth.assert_called_once()
+    assert mock_get_auth.call_args.kwargs["claims"] == {"user": "dummy_user"}
     
     mock_get_auth.return_value = (None, None)
 
     response = client.get(urls["get_point_id_of_access"])
     assert response.status_code == 204
 
+@patch("api.main.auth.verify_access")
+@patch("api.main.crud.get_auth")
+def test_get_point_id_of_access_cached(mock_get_auth, mock_verify_access):
+    mock_verify_access.return_value = {"sub": "fake_sub_identifier"}
+    main.crud.authorization_map.load([main.crud.models.AuthorizationToPoint(id = 1, sub = "fake_sub_identifier", name = "fake_name", point_id = 1)])
+    
+    response = client.get(urls["get_point_id_of_access"])
+    assert response.status_code == 200
+    assert response.json() == {"name": "fake_name", "point_id": 1}
+    mock_get_auth.assert_not_called()
+
+@patch("api.main.auth.verify_access")
+@patch("api.main.crud.get_authorization")
+def test_get_point_id_of_access_with_point(mock_get_authorization, mock_verify_access):
+    mock_verify_access.return_value = {"sub": "fake_sub_identifier"}
+    mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
+    mock_get_authorization.return_value = main.crud.models.AuthorizationToPoint(id = 1, sub = "fake_sub_identifier", name = "fake_name",
+                                                                                point_id = 1, dropoff_point = main.crud.models.Point(**mock_point))
+    
+    response = client.get(urls["get_point_id_of_access"], params = {"include_point": True})
+    assert response.status_code == 200
+    assert response.json() == {"name": "fake_name", "point_id": 1, "point": mock_point}
+    
+    mock_get_authorization.return_value = None
+    response = client.get(urls["get_point_id_of_access"], params = {"include_point": True})
+    assert response.status_code == 204
+
+@patch("api.main.auth.verify_access")
+@patch("api.main.crud.create_authorization")
+@patch("api.main.crud.delete_authorization")
+def test_authorizations(mock_delete_authorization, mock_create_authorization, mock_verify_access):
+    mock_verify_access.return_value = {"sub": "admin", "cognito:groups": ["admin"]}
+    mock_authorization = {"id": 1, "sub": "fake_sub_identifier", "name": "fake_name", "point_id": 1}
+    mock_create_authorization.return_value = mock_authorization
+    
+    response = client.post("/points/v1/access/authorizations", json = {"sub": "fake_sub_identifier", "name": "fake_name", "point_id": 1})
+    assert response.status_code == 201
+    assert response.json() == mock_authorization
+    
+    mock_create_authorization.return_value = None
+    response = client.post("/points/v1/access/authorizations", json = {"sub": "fake_sub_identifier", "name": "fake_name", "point_id": 1})
+    assert response.status_code == 409
+    
+    mock_delete_authorization.return_value = "OK"
+    response = client.delete("/points/v1/access/authorizations/fake_sub_identifier")
+    assert response.status_code == 200
+    assert response.json() == {"message": "AUTHORIZATION DELETED"}
+    
+    mock_delete_authorization.return_value = None
+    response = client.delete("/points/v1/access/authorizations/fake_sub_identifier")
+    assert response.status_code == 204
+
+@patch("api.main.auth.verify_access")
+@patch("api.main.crud.get_authorizations")
+@patch("api.main.crud.create_authorization")
+@patch("api.main.crud.delete_authorization")
+def test_authorizations_require_admin(mock_delete_authorization, mock_create_authorization, mock_get_authorizations, mock_verify_access):
+    for claims in [{"sub": "operator"}, {"sub": "operator", "cognito:groups": ["operators"]}]:
+        mock_verify_access.return_value = claims
+        
+        response = client.get("/points/v1/access/authorizations")
+        assert response.status_code == 403
+        response = client.post("/points/v1/access/authorizations", json = {"sub": "operator", "name": "fake_name", "point_id": 1})
+        assert response.status_code == 403
+        response = client.delete("/points/v1/access/authorizations/other_operator")
+        assert response.status_code == 403
+        assert response.json() == {"detail": "ERROR: Admin access required"}
+    
+    assert not mock_get_authorizations.called
+    assert not mock_create_authorization.called
+    assert not mock_delete_authorization.called
+    
+    mock_verify_access.return_value = {"sub": "admin", "cognito:groups": ["admin"]}
+    mock_get_authorizations.return_value = []
+    response = client.get("/points/v1/access/authorizations")
+    assert response.status_code == 200
+    assert response.json() == []
+
 @patch("api.main.auth.verify_access")
 @patch("api.main.crud.get_point_by_name")
 @patch("api.main.crud.delete_point")
@@ -97,3 +250,505 @@ def test_delete_point(mock_delete_point, mock_get_point_by_name, mock_verify_acc
     mock_delete_point.return_value = None
     response = client.delete(urls["delete_point"]+"/999")
     assert response.status_code == 204
+
+@patch("api.main.auth.verify_access")
+def test_get_pool_stats(mock_verify_access):
+    mock_verify_access.return_value = {"sub": "operator"}
+    response = client.get("/points/v1/stats/pool")
+    assert response.status_code == 403
+    
+    mock_verify_access.return_value = {"sub": "admin", "cognito:groups": ["admin"]}
+    engine = main.database.async_engine.sync_engine if main.database.ASYNC_MODE else main.database.engine
+    response = client.get("/points/v1/stats/pool")
+    assert response.status_code == 200
+    assert response.json()["pool"] == type(engine.pool).__name__
+    assert "checkouts" in response.json()
+
+@patch("api.main.auth.verify_access")
+def test_get_replica_stats(mock_verify_access):
+    mock_verify_access.return_value = {"sub": "operator"}
+    response = client.get("/points/v1/stats/replicas")
+    assert response.status_code == 403
+    
+    mock_verify_access.return_value = {"sub": "admin", "cognito:groups": ["admin"]}
+    response = client.get("/points/v1/stats/replicas")
+    assert response.status_code == 200
+    assert response.json() == {"replicas": [], "fallbacks": 0, "sticky_clients": 0}
+
+@patch("api.main.auth.verify_access")
+@patch("api.main.crud.get_points")
+def test_get_cache_stats(mock_get_points, mock_verify_access):
+    mock_get_points.return_value = []
+    client.get(urls["get_all_points"])
+    client.get(urls["get_all_points"])
+    
+    mock_verify_access.return_value = {"sub": "operator"}
+    response = client.get("/points/v1/stats/cache")
+    assert response.status_code == 403
+    
+    mock_verify_access.return_value = {"sub": "admin", "cognito:groups": ["admin"]}
+    response = client.get("/points/v1/stats/cache")
+    assert response.status_code == 200
+    assert response.json()["hits"] >= 1
+    assert response.json()["misses"] >= 1
+
+def test_get_catalogue_survives_cancelled_leader():
+    (sessions, snapshot, gate) = ([], main.CatalogueSnapshot(0, []), [])
+    
+    async def load_catalogue(function, db):
+        sessions.append(db)
+        await gate[0].wait()
+        return snapshot
+    
+    async def read_catalogue():
+        gate.append(asyncio.Event())
+        leader = asyncio.create_task(main.get_catalogue())
+        await asyncio.sleep(0.01)
+        followers = [asyncio.create_task(main.get_catalogue()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        # The request which started the load goes away while the others wait for it
+        leader.cancel()
+        gate[0].set()
+        return (await asyncio.gather(leader, *followers, return_exceptions = True))
+    
+    with patch("api.main.run_crud", load_catalogue):
+        (leader, *followers) = asyncio.run(read_catalogue())
+    assert isinstance(leader, asyncio.CancelledError)
+    assert followers == [snapshot, snapshot]
+    # The load ran once, on a session opened for it
+    assert len(sessions) == 1 and sessions[0] is not None
+
+@patch("api.main.crud.get_points")
+def test_get_metrics(mock_get_points):
+    mock_get_points.return_value = []
+    client.get(urls["get_all_points"])
+    client.get(urls["get_point_by_name"]+"/point1")
+    
+    response = client.get("/points/v1/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert any(line.startswith('http_request_duration_seconds_count{method="GET",route="/points/v1/points/name/{point_name}",status="204"}') for line in lines)
+    assert any(line.startswith('db_query_duration_seconds_count{statement="SELECT"}') for line in lines)
+    assert "# TYPE cache_hit_ratio gauge" in lines
+    assert any(line.startswith("db_pool_checkouts_total ") for line in lines)
+
+def test_get_catalogue_version():
+    version = client.get("/points/v1/points/version").json()["version"]
+    main.crud.invalidation_bus.publish()
+    assert client.get("/points/v1/points/version").json() == {"version": version + 1}
+
+@patch("api.main.crud.get_points")
+def test_get_all_points_etag(mock_get_points):
+    mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
+    mock_get_points.return_value = [mock_point]
+    
+    response = client.get(urls["get_all_points"])
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.headers["Cache-Control"] == f"public, max-age={main.POINTS_CACHE_MAX_AGE}"
+    
+    response = client.get(urls["get_all_points"], headers = {"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+    
+    response = client.get(urls["get_all_points"], headers = {"If-None-Match": f'"other", W/{etag}'})
+    assert response.status_code == 304
+    
+    mock_get_points.return_value = [mock_point, {**mock_point, "id": 2, "name": "point2"}]
+    main.crud.invalidation_bus.publish()
+    response = client.get(urls["get_all_points"], headers = {"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()) == 2
+
+def test_catalogue_snapshot_encoded():
+    mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": None}
+    snapshot = main.CatalogueSnapshot(1, [mock_point, {**mock_point, "id": 2, "name": "point2"}])
+    
+    assert json.loads(snapshot.encoded) == [mock_point, {**mock_point, "id": 2, "name": "point2"}]
+    assert snapshot.encoded is snapshot.encoded
+    assert json.loads(snapshot.point_encoded("point2"))["id"] == 2
+    
+    with patch("db_info.cache.ENCODED_CACHE", False):
+        snapshot = main.CatalogueSnapshot(1, [mock_point])
+        assert snapshot.encoded == snapshot.encoded
+        assert snapshot.encoded is not snapshot.encoded
+        assert snapshot.etag == main.CatalogueSnapshot(1, [mock_point]).etag
+
+@patch("api.main.crud.get_points")
+def test_get_point_by_name_etag(mock_get_points):
+    mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
+    mock_get_points.return_value = [mock_point, {**mock_point, "id": 2, "name": "point2"}]
+    
+    response = client.get(urls["get_point_by_name"]+"/point1")
+    etag = response.headers["ETag"]
+    assert etag != client.get(urls["get_point_by_name"]+"/point2").headers["ETag"]
+    
+    response = client.get(urls["get_point_by_name"]+"/point1", headers = {"If-None-Match": etag})
+    assert response.status_code == 304
+    
+    mock_get_points.return_value = [{**mock_point, "image": "image2"}]
+    main.crud.invalidation_bus.publish()
+    response = client.get(urls["get_point_by_name"]+"/point1", headers = {"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["image"] == "image2"
+
+@patch("api.main.crud.get_points_page")
+def test_get_all_points_paginated(mock_get_points_page):
+    mock_get_points_page.return_value = [{"id": 1, "name": "point1"}, {"id": 2, "name": "point2"}]
+    
+    response = client.get(urls["get_all_points"], params = {"limit": 2, "offset": 4, "fields": "name"})
+    assert response.status_code == 200
+    assert response.json() == [{"name": "point1"}, {"name": "point2"}]
+    assert response.headers["X-Next-Cursor"] == "2"
+    assert response.headers["Link"] == '<http://testserver/points/v1/points?limit=2&fields=name&after_id=2>; rel="next"'
+    assert mock_get_points_page.call_args.kwargs == {"limit": 2, "offset": 4, "after_id": None, "fields": ["name"]}
+    
+    response = client.get(urls["get_all_points"], params = {"limit": 3, "after_id": 2, "fields": "id,name"})
+    assert response.json() == mock_get_points_page.return_value
+    assert "X-Next-Cursor" not in response.headers
+    
+    response = client.get(urls["get_all_points"], params = {"fields": "name,password"})
+    assert response.status_code == 422
+    assert response.json() == {"detail": "UNKNOWN FIELD"}
+    
+    response = client.get(urls["get_all_points"], params = {"limit": 0})
+    assert response.status_code == 422
+
+@patch("api.main.crud.get_points")
+def test_get_nearest_points(mock_get_points):
+    mock_get_points.return_value = [
+        {"id": 1, "name": "Reitoria", "location": "Departamento 25", "coordinates": "40.631417730224, -8.657526476133642", "image": None},
+        {"id": 2, "name": "DETI", "location": "Departamento 4", "coordinates": "40.63331148617483, -8.659589862642955", "image": None},
+        {"id": 3, "name": "Crasto", "location": "Departamento M", "coordinates": "40.62450887522072, -8.656864475040406", "image": None},
+        {"id": 4, "name": "Unknown", "location": "Nowhere", "coordinates": "coordinates", "image": None},
+    ]
+    
+    response = client.get("/points/v1/points/nearest", params = {"lat": 40.6332, "lon": -8.6596, "k": 2})
+    assert response.status_code == 200
+    assert [point["name"] for point in response.json()] == ["DETI", "Reitoria"]
+    assert response.json()[0]["distance_km"] < response.json()[1]["distance_km"]
+    
+    response = client.get("/points/v1/points/nearest", params = {"lat": 40.6332, "lon": -8.6596, "radius": 0.1})
+    assert [point["name"] for point in response.json()] == ["DETI"]
+    
+    response = client.get("/points/v1/points/nearest", params = {"lat": 91, "lon": 0})
+    assert response.status_code == 422
+
+@patch("api.main.auth.verify_access")
+def test_bulk_points(mock_verify_access):
+    mock_verify_access.return_value = {"sub": "dummy_sub"}
+    points = [{"name": f"bulk{index}", "location": "location", "coordinates": f"40.{index}, -8.{index}", "image": None} for index in range(3)]
+    
+    response = client.post("/points/v1/points/bulk", json = points + [{"name": "bulk0"}, points[0]])
+    assert response.status_code == 200
+    assert response.json()["created"] == 3
+    assert response.json()["invalid"] == 1
+    assert response.json()["conflicts"] == 1
+    assert [result["status"] for result in response.json()["results"]] == ["created", "created", "created", "invalid", "conflict"]
+    assert [result["index"] for result in response.json()["results"]] == [0, 1, 2, 3, 4]
+    
+    body = "\n".join([json.dumps({**points[0], "name": "bulk3", "coordinates": "40.3, -8.3"}), "{not json", json.dumps(points[1]), ""])
+    response = client.post("/points/v1/points/bulk", content = body.encode(), headers = {"Content-Type": "application/x-ndjson"})
+    assert [result["status"] for result in response.json()["results"]] == ["created", "invalid", "conflict"]
+    
+    assert client.get(urls["get_point_by_name"]+"/bulk3").status_code == 200
+    
+    response = client.request("DELETE", "/points/v1/points/bulk", json = ["bulk0", "bulk1", "bulk2", "bulk3", "missing"])
+    assert response.status_code == 200
+    assert response.json()["deleted"] == 4
+    assert response.json()["not_found"] == 1
+    assert client.get(urls["get_point_by_name"]+"/bulk3").status_code == 204
+    
+    response = client.request("DELETE", "/points/v1/points/bulk", json = [1])
+    assert response.status_code == 422
+    response = client.post("/points/v1/points/bulk", json = {"name": "bulk0"})
+    assert response.status_code == 422
+
+@patch("api.main.auth.verify_access")
+def test_export_points(mock_verify_access):
+    mock_verify_access.return_value = {"sub": "dummy_sub"}
+    points = [{"name": f"export{index}", "location": "location", "coordinates": f"41.{index}, -7.{index}", "image": None} for index in range(5)]
+    assert client.post("/points/v1/points/bulk", json = points).json()["created"] == 5
+    
+    response = client.get("/points/v1/points/export", params = {"batch_size": 2})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/json"
+    exported = [point for point in response.json() if point["name"].startswith("export")]
+    assert [point["name"] for point in exported] == [point["name"] for point in points]
+    assert set(exported[0]) == set(main.crud.POINT_FIELDS)
+    
+    response = client.get("/points/v1/points/export", params = {"format": "ndjson", "batch_size": 2}, headers = {"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    assert response.headers["Content-Encoding"] == "gzip"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [point for point in lines if point["name"].startswith("export")] == exported
+    
+    assert client.get("/points/v1/points/export", params = {"format": "xml"}).status_code == 422
+    client.request("DELETE", "/points/v1/points/bulk", json = [point["name"] for point in points])
+
+@patch("api.main.crud.get_points")
+def test_get_all_points_compressed(mock_get_points):
+    mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
+    mock_get_points.return_value = [{**mock_point, "id": index, "name": f"point{index}"} for index in range(100)]
+    
+    response = client.get(urls["get_all_points"], headers = {"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.json()) == 100
+    catalogue = main.crud.point_catalogue.current()
+    assert catalogue.compressed("gzip") is catalogue.compressed("gzip")
+    
+    gzip_etag = response.headers["ETag"]
+    identity_etag = client.get(urls["get_all_points"], headers = {"Accept-Encoding": "identity"}).headers["ETag"]
+    assert gzip_etag == identity_etag[:-1] + '-gzip"'
+    
+    response = client.get(urls["get_all_points"], headers = {"Accept-Encoding": "gzip", "If-None-Match": gzip_etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == gzip_etag
+    response = client.get(urls["get_all_points"], headers = {"Accept-Encoding": "gzip", "If-None-Match": identity_etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == gzip_etag
+    response = client.get(urls["get_all_points"], headers = {"Accept-Encoding": "identity", "If-None-Match": gzip_etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == identity_etag
+
+@patch("api.main.crud.get_points")
+def test_get_point_image(mock_get_points, tmp_path):
+    source = io.BytesIO()
+    Image.new("RGB", (1200, 600), "blue").save(source, "JPEG")
+    (tmp_path / "room.jpg").write_bytes(source.getvalue())
+    mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "https://images.example/room.jpg"}
+    mock_get_points.return_value = [mock_point, {**mock_point, "id": 2, "name": "point2", "image": None}]
+    service = main.images.ImageService(main.images.FileImageFetcher(str(tmp_path)), main.images.ImageCache(str(tmp_path / "cache")), widths = (160, 640))
+    
+    with patch.object(main.images, "image_service", service):
+        response = client.get("/points/v1/points/1/image", params = {"w": 150})
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "image/jpeg"
+        assert response.headers["Cache-Control"] == f"public, max-age={main.IMAGE_CACHE_MAX_AGE}"
+        assert Image.open(io.BytesIO(response.content)).size == (160, 80)
+        
+        response = client.get("/points/v1/points/1/image", params = {"w": 160}, headers = {"If-None-Match": response.headers["ETag"]})
+        assert response.status_code == 304
+        assert client.get("/points/v1/points/1/image").headers["ETag"] != response.headers["ETag"]
+        
+        assert client.get("/points/v1/points/2/image").status_code == 204
+        assert client.get("/points/v1/points/3/image").status_code == 204
+        assert client.get("/points/v1/points/1/image", params = {"w": 0}).status_code == 422
+        
+        mock_get_points.return_value = [{**mock_point, "image": "https://images.example/missing.jpg"}]
+        main.crud.invalidation_bus.publish()
+        assert client.get("/points/v1/points/1/image").status_code == 502
+
+@patch("api.main.auth.verify_access")
+@patch("api.main.crud.delete_point")
+def test_rate_limit_writes(mock_delete_point, mock_verify_access):
+    mock_verify_access.return_value = {"sub": "dummy_sub"}
+    mock_delete_point.return_value = "OK"
+    
+    with patch("api.main.rate_limiter", InMemoryRateLimiter(burst = 2, rate = 0.5)):
+        assert [client.delete(urls["delete_point"]+"/point1").status_code for _ in range(2)] == [200, 200]
+        response = client.delete(urls["delete_point"]+"/point1")
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "2"
+        assert mock_verify_access.call_count == 2
+        
+        # Reads aren't limited, and /access has a bucket of its own
+        assert client.get(urls["get_all_points"]).status_code == 200
+        assert client.get("/points/v1/access").status_code != 429
+
+@patch("api.main.crud.get_point_by_name")
+def test_get_point_by_name_without_catalogue(mock_get_point_by_name):
+    mock_point = {"id": 1, "name": "point1", "location": "location1", "coordinates": "coordinates1", "image": "image1"}
+    mock_get_point_by_name.return_value = mock_point
+    
+    with patch.object(main.crud.point_catalogue, "ttl", 0):
+        response = client.get(urls["get_point_by_name"]+"/point1")
+        assert response.status_code == 200
+        assert response.json() == mock_point
+        assert client.get(urls["get_point_by_name"]+"/point1", headers = {"If-None-Match": response.headers["ETag"]}).status_code == 304
+        
+        mock_get_point_by_name.return_value = None
+        assert client.get(urls["get_point_by_name"]+"/point2").status_code == 204
+
+@patch("api.main.auth.verify_access")
+def test_get_point_changes(mock_verify_access):
+    mock_verify_access.return_value = {"sub": "dummy_sub"}
+    start = client.get("/points/v1/points/changes").json()
+    points = [{"name": f"sync{index}", "location": "location", "coordinates": f"42.{index}, -7.{index}", "image": None} for index in range(2)]
+    client.post("/points/v1/points/bulk", json = points)
+    client.delete(urls["delete_point"]+"/sync0")
+    
+    response = client.get("/points/v1/points/changes", params = {"since": start["version"]})
+    assert response.status_code == 200
+    changes = response.json()
+    assert changes["version"] == start["version"] + 2
+    assert [point["name"] for point in changes["points"]] == ["sync1"]
+    assert [point["name"] for point in changes["deleted"]] == ["sync0"]
+    
+    assert client.get("/points/v1/points/changes", params = {"since": changes["version"]}).json()["points"] == []
+    assert client.get("/points/v1/points/changes", params = {"since": changes["version"] + 1}).status_code == 410
+    assert client.get("/points/v1/points/changes", params = {"since": -1}).status_code == 422
+    client.delete(urls["delete_point"]+"/sync1")
+
+@patch("api.main.auth.verify_access")
+def test_stream_point_changes(mock_verify_access):
+    mock_verify_access.return_value = {"sub": "dummy_sub"}
+    since = client.get("/points/v1/points/changes").json()["version"]
+    point = {"name": "stream0", "location": "location", "coordinates": "42.1, -7.1", "image": None}
+    
+    with TestClient(main.app) as started_client:
+        for _ in range(100):
+            if started_client.get("/points/v1/health/ready").status_code == 200:
+                break
+            time.sleep(0.05)
+        with started_client.websocket_connect(f"/points/v1/points/ws?since={since}") as websocket:
+            first = websocket.receive_json()
+            assert (first["type"], first["id"], first["data"]["version"]) == ("changes", since, since)
+            started_client.post(urls["create_point"], json = point)
+            event = websocket.receive_json()
+            assert event["type"] == "changes" and event["id"] == since + 1
+            assert [point["name"] for point in event["data"]["points"]] == ["stream0"]
+        
+        with started_client.websocket_connect(f"/points/v1/points/ws?since={since + 5}") as websocket:
+            assert websocket.receive_json()["type"] == "resync"
+    client.delete(urls["delete_point"]+"/stream0")
+    
+    async def read_stream():
+        response = await main.stream_point_changes(since = since, last_event_id = None)
+        assert response.media_type == "text/event-stream"
+        frames = response.body_iterator
+        first = await frames.__anext__()
+        await frames.aclose()
+        return first
+    
+    first = asyncio.run(read_stream())
+    assert first.startswith(f"id: {since + 2}\nevent: changes\n".encode())
+    assert main.broadcaster.subscribers == set()
+
+def test_compaction_failures_are_logged(monkeypatch, caplog):
+    async def load_with_session(function):
+        raise RuntimeError("database is down")
+    
+    async def compact():
+        task = asyncio.create_task(main.compact_tombstones_periodically())
+        await asyncio.sleep(0.1)
+        task.cancel()
+    
+    monkeypatch.setattr(main, "SYNC_COMPACTION_INTERVAL", 0.01)
+    monkeypatch.setattr(main, "load_with_session", load_with_session)
+    with caplog.at_level(logging.ERROR, logger = main.logger.name):
+        asyncio.run(compact())
+    # Every failed run is logged with its error, and the next runs still happen
+    failures = [record for record in caplog.records if "Tombstone compaction failed" in record.message]
+    assert len(failures) >= 2
+    assert "database is down" in str(failures[0].exc_info[1])
+
+def test_change_feed_failures_are_logged(monkeypatch, caplog):
+    # The sync state, then the changes since version 7 (expired), then the sync state again
+    (results, published) = (iter([RuntimeError("database is down"), (7, 0), None, (9, 0)]), [])
+    
+    async def load_with_session(function):
+        result = next(results, StopIteration)
+        if result is StopIteration:
+            await asyncio.Future()
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    def publish(event):
+        published.append(event)
+        if len(published) == 2:
+            raise RuntimeError("broadcast failed")
+    
+    async def wait_for_change():
+        await asyncio.sleep(0.01)
+    
+    async def feed():
+        monkeypatch.setattr(main.app.state, "warm_up", asyncio.ensure_future(asyncio.sleep(0)), raising = False)
+        task = asyncio.create_task(main.publish_changes())
+        await asyncio.sleep(0.1)
+        task.cancel()
+    
+    monkeypatch.setattr(main, "load_with_session", load_with_session)
+    monkeypatch.setattr(main.broadcaster, "publish", publish)
+    monkeypatch.setattr(main.broadcaster, "wait_for_change", wait_for_change)
+    with caplog.at_level(logging.ERROR, logger = main.logger.name):
+        asyncio.run(feed())
+    assert [record.message for record in caplog.records] == [
+        "Reading the sync state failed, the stream clients will resync on the next change",
+        "Publishing the point changes failed, the stream clients will resync on the next change",
+    ]
+    # The feed kept running, and told the clients to resync after each failure
+    assert [(event.type, event.id) for event in published] == [("changed", 7), ("resync", None), ("changed", 9)]
+
+def test_search_points():
+    response = client.get("/points/v1/points/search", params = {"q": "pavilhao"})
+    assert response.status_code == 200
+    assert [point["name"] for point in response.json()] == ["Pavilhão Aristides Hall"]
+    assert [point["name"] for point in client.get("/points/v1/points/search", params = {"q": "cantina", "limit": 1}).json()] == ["Cantina de Santiago"]
+    assert client.get("/points/v1/points/search", params = {"q": "missing"}).json() == []
+    assert client.get("/points/v1/points/search", params = {"q": ""}).status_code == 422
+    
+    with patch.object(main.crud.point_catalogue, "ttl", 0):
+        response = client.get("/points/v1/points/search", params = {"q": "PAVILHÃO hall"})
+    assert [point["name"] for point in response.json()] == ["Pavilhão Aristides Hall"]
+
+def test_get_points_batch():
+    response = client.get("/points/v1/points/batch", params = {"names": ["CP", "missing"], "ids": [3, 999]})
+    assert response.status_code == 200
+    batch = response.json()
+    assert batch["names"]["CP"]["name"] == "CP" and batch["names"]["missing"] is None
+    assert batch["ids"]["3"]["name"] == "DETI" and batch["ids"]["999"] is None
+    assert batch["missing"] == {"names": ["missing"], "ids": [999]}
+    
+    with patch.object(main.crud.point_catalogue, "ttl", 0):
+        assert client.post("/points/v1/points/batch", json = {"names": ["CP", "missing"], "ids": [3, 999]}).json() == batch
+    assert client.post("/points/v1/points/batch", json = {}).json() == {"names": {}, "ids": {}, "missing": {"names": [], "ids": []}}
+    assert client.post("/points/v1/points/batch", json = {"ids": ["three"]}).status_code == 422
+    assert client.post("/points/v1/points/batch", json = {"names": ["CP"] * (main.BULK_MAX_ITEMS + 1)}).status_code == 413
+
+@patch("api.main.auth.verify_access")
+def test_bulk_points_limit(mock_verify_access):
+    mock_verify_access.return_value = {"sub": "dummy_sub"}
+    
+    response = client.post("/points/v1/points/bulk", json = [{}] * (main.BULK_MAX_ITEMS + 1))
+    assert response.status_code == 413
+    
+    body = "{}\n" * (main.BULK_MAX_ITEMS + 1)
+    response = client.post("/points/v1/points/bulk", content = body.encode(), headers = {"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 413
+
+@patch("api.main.auth.verify_access")
+@patch("api.main.crud.bulk_create_points")
+def test_bulk_points_body_limit(mock_bulk_create_points, mock_verify_access, monkeypatch):
+    mock_verify_access.return_value = {"sub": "dummy_sub"}
+    monkeypatch.setattr(main, "BULK_MAX_BYTES", 64)
+    
+    response = client.post("/points/v1/points/bulk", content = json.dumps([{"name": "x" * 64}]).encode(), headers = {"Content-Type": "application/json"})
+    assert response.status_code == 413
+    assert response.json() == {"detail": "BODY TOO LARGE"}
+    
+    # Bodies without a Content-Length are cut off as they arrive
+    chunks = iter([b'{"name": "' + b"x" * 40, b"x" * 40 + b'"}\n'])
+    response = client.post("/points/v1/points/bulk", content = chunks, headers = {"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 413
+    assert not mock_bulk_create_points.called
+
+def test_health_probes():
+    assert client.get("/points/v1/health/live").json() == {"status": "alive"}
+    
+    with TestClient(main.app) as started_client:
+        for _ in range(100):
+            response = started_client.get("/points/v1/health/ready")
+            if response.status_code == 200:
+                break
+            assert response.status_code == 503
+            time.sleep(0.05)
+        assert response.json()["status"] == "ready"
+        assert set(response.json()["components"]) >= {"pool", "catalogue", "authorizations"}
+        assert all(component["ready"] for component in response.json()["components"].values())
+        assert main.crud.point_catalogue.current() != None
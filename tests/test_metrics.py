@@ -0,0 +1,34 @@
+from api.db_info.metrics import MetricsRegistry
+
+## UNIT TESTS
+
+def test_counter_and_callback_rendering():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests", "Requests served.", ("route",))
+    counter.labels("/points").inc()
+    counter.labels("/points").inc(2)
+    counter.labels('a"b').inc()
+    registry.callback("pool_size", "Connections in the pool.", "gauge", lambda: [({}, 5), ({"pool": "replica"}, None)])
+    
+    assert registry.render() == (
+        "# HELP requests_total Requests served.\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{route="/points"} 3\n'
+        'requests_total{route="a\\"b"} 1\n'
+        "# HELP pool_size Connections in the pool.\n"
+        "# TYPE pool_size gauge\n"
+        "pool_size 5\n"
+    )
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency.", ("route",), buckets = (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.labels("/points").observe(value)
+    
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{route="/points",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{route="/points",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{route="/points",le="+Inf"} 4' in lines
+    assert 'latency_seconds_count{route="/points"} 4' in lines
+    assert 'latency_seconds_sum{route="/points"} 3.65' in lines
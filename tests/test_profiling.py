@@ -0,0 +1,79 @@
+import logging
+import os
+import pstats
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from api.db_info import profiling
+
+## HELPER COMPONENTS
+
+async def authorize(request: Request):
+    if request.headers.get("Authorization") != "Bearer valid":
+        raise HTTPException(status_code = 401)
+    profiling.record("auth", 0.002)
+    request.state.claims = {"sub": "admin"}
+
+def build_app(**options) -> FastAPI:
+    app = FastAPI()
+    app.router.route_class = profiling.ProfiledRoute
+    app.add_middleware(profiling.ProfilingMiddleware, authorize = authorize, **options)
+    
+    @app.get("/points")
+    async def get_points(request: Request):
+        profiling.record("db", 0.001)
+        return [{"id": index, "name": f"point{index}"} for index in range(100)]
+    return app
+
+def phases(header: str) -> dict:
+    return {entry.split(";")[0].strip(): float(entry.split("dur=")[1]) for entry in header.split(",")}
+
+## UNIT TESTS
+
+def test_server_timing_for_authorized_callers():
+    client = TestClient(build_app())
+    
+    assert "Server-Timing" not in client.get("/points").headers
+    assert "Server-Timing" not in client.get("/points", headers = {"X-Profile": "1", "Authorization": "Bearer forged"}).headers
+    
+    response = client.get("/points", headers = {"X-Profile": "1", "Authorization": "Bearer valid"})
+    assert response.status_code == 200
+    timings = phases(response.headers["Server-Timing"])
+    assert set(timings) == {"auth", "db", "serialize", "total"}
+    assert timings["auth"] == 2.0 and timings["db"] == 1.0
+    assert timings["serialize"] > 0
+    assert profiling.current_timings.get() == None
+
+def test_sampled_requests_dump_cprofile_reports(tmp_path):
+    client = TestClient(build_app(sample_rate = 1.0, report_dir = str(tmp_path)))
+    
+    # Anonymous callers are profiled but don't get the timings
+    response = client.get("/points")
+    assert "Server-Timing" not in response.headers
+    assert "X-Profile-Report" not in response.headers
+    assert len(os.listdir(tmp_path)) == 1
+    response = client.get("/points", headers = {"Authorization": "Bearer forged"})
+    assert "Server-Timing" not in response.headers
+    
+    response = client.get("/points", headers = {"Authorization": "Bearer valid"})
+    assert "total" in phases(response.headers["Server-Timing"])
+    report = tmp_path / response.headers["X-Profile-Report"]
+    assert os.path.exists(report)
+    assert pstats.Stats(str(report)).total_calls > 0
+
+def test_slow_query_log(caplog):
+    engine = create_engine("sqlite://")
+    profiling.instrument_engine(engine, threshold_ms = 0)
+    
+    with caplog.at_level(logging.WARNING, logger = "db_info.slow_queries"):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT   1"))
+    assert any("Slow query" in record.message and "SELECT 1" in record.message for record in caplog.records)
+    
+    engine = create_engine("sqlite://")
+    profiling.instrument_engine(engine, threshold_ms = -1)
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger = "db_info.slow_queries"):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    assert caplog.records == []
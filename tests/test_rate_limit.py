@@ -0,0 +1,55 @@
+import fakeredis
+import redis
+from unittest.mock import patch
+from api.db_info.rate_limit import InMemoryRateLimiter, RedisRateLimiter
+
+## HELPER COMPONENTS
+
+def take(limiter, key: str, count: int, now: float) -> list:
+    with patch("api.db_info.rate_limit.time.time", return_value = now):
+        return [limiter.acquire(key) for _ in range(count)]
+
+## UNIT TESTS
+
+def check_token_bucket(limiter):
+    assert [allowed for (allowed, _) in take(limiter, "write:ip:1", 3, now = 1000.0)] == [True, True, True]
+    (allowed, retry_after) = take(limiter, "write:ip:1", 1, now = 1000.0)[0]
+    assert not allowed
+    assert retry_after == 0.5
+    assert take(limiter, "write:ip:2", 1, now = 1000.0)[0][0]
+    
+    assert [allowed for (allowed, _) in take(limiter, "write:ip:1", 2, now = 1000.5)] == [True, False]
+    assert [allowed for (allowed, _) in take(limiter, "write:ip:1", 4, now = 1010.0)] == [True, True, True, False]
+    assert limiter.stats()["limited"] == 3
+
+def test_in_memory_token_bucket():
+    check_token_bucket(InMemoryRateLimiter(burst = 3, rate = 2))
+
+def test_redis_token_bucket():
+    client = fakeredis.FakeRedis()
+    limiter = RedisRateLimiter(burst = 3, rate = 2, client = client)
+    check_token_bucket(limiter)
+    with patch("time.time", return_value = 1010.0):
+        assert 0 < client.pttl("points:ratelimit:write:ip:1") <= 1500
+    
+    # Replicas share their buckets
+    other_replica = RedisRateLimiter(burst = 3, rate = 2, client = client)
+    assert not take(other_replica, "write:ip:1", 1, now = 1010.0)[0][0]
+
+def test_redis_rate_limiter_fails_open():
+    client = fakeredis.FakeRedis()
+    limiter = RedisRateLimiter(burst = 1, rate = 1, client = client)
+    with patch.object(client, "pipeline", side_effect = redis.exceptions.ConnectionError()):
+        assert take(limiter, "write:ip:1", 3, now = 1000.0) == [(True, 0.0)] * 3
+
+def test_in_memory_rate_limiter_bounds_keys():
+    limiter = InMemoryRateLimiter(burst = 1, rate = 1, max_keys = 2)
+    take(limiter, "a", 1, now = 1000.0)
+    take(limiter, "b", 1, now = 1000.0)
+    take(limiter, "c", 1, now = 1000.0)
+    assert take(limiter, "a", 1, now = 1000.0)[0][0]
+    assert not take(limiter, "c", 1, now = 1000.0)[0][0]
+
+def test_disabled_rate_limiter():
+    limiter = InMemoryRateLimiter(burst = 1, rate = 0)
+    assert take(limiter, "a", 5, now = 1000.0) == [(True, 0.0)] * 5
@@ -0,0 +1,187 @@
+import asyncio
+import time
+from fastapi import HTTPException, Request, Response
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from api import main
+from api.db_info import crud, database, init_db, models, schemas
+from api.db_info.replicas import Replica, ReplicaRouter
+from api.dependencies import database as dependencies
+
+## HELPER COMPONENTS
+
+def create_database(path, names, version):
+    engine = create_engine(f"sqlite:///{path}")
+    init_db.create_schema(engine)
+    with sessionmaker(bind = engine)() as db:
+        db.add_all([models.Point(name = name, location = "Departamento 4", coordinates = f"40.6{index}, -8.6{index}")
+                    for (index, name) in enumerate(names)])
+        db.merge(models.SyncState(id = 1, version = version))
+        db.commit()
+    return engine
+
+def request_from(address, *headers):
+    return Request({"type": "http", "headers": [(name.encode(), value.encode()) for (name, value) in headers],
+                    "client": (address, 1234)})
+
+def replica_setup(tmp_path, replica_version = 5, max_lag = 10):
+    primary = create_database(tmp_path / "primary.db", ["DETI", "CP"], 5)
+    replica = Replica(f"sqlite:///{tmp_path / 'replica.db'}",
+                      create_database(tmp_path / "replica.db", ["DETI"], replica_version))
+    return (primary, replica, ReplicaRouter([replica], primary, max_lag = max_lag, sticky_seconds = 60))
+
+## UNIT TESTS
+
+def test_choose_round_robin_and_fallback(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    replicas = [Replica(f"sqlite:///{tmp_path / name}", engine) for name in ("first.db", "second.db")]
+    router = ReplicaRouter(replicas, engine)
+
+    assert [router.choose() for _ in range(4)] == replicas * 2
+    replicas[1].version = 3
+    assert [router.choose(min_version = 3) for _ in range(2)] == [replicas[1]] * 2
+    replicas[0].healthy = False
+    assert [router.choose() for _ in range(2)] == [replicas[1]] * 2
+    replicas[1].healthy = False
+    assert router.choose() is None
+    assert router.stats()["fallbacks"] == 1
+    assert [replica.reads for replica in replicas] == [2, 6]
+
+    disabled = ReplicaRouter([], engine)
+    assert not disabled.enabled
+    assert disabled.choose() is None
+    assert disabled.fallbacks == 0
+
+def test_check_replica_lag(tmp_path):
+    (primary, replica, router) = replica_setup(tmp_path, replica_version = 2, max_lag = 3)
+    router.check()
+    assert (replica.healthy, replica.version, replica.lag, replica.error) == (True, 2, 3, None)
+
+    router.max_lag = 2
+    router.check()
+    assert (replica.healthy, replica.lag) == (False, 3)
+
+    replica.engine = create_engine(f"sqlite:///{tmp_path / 'missing.db'}")
+    router.check()
+    assert not replica.healthy
+    assert replica.version is None and replica.lag is None
+    assert "sync_state" in replica.error
+
+def test_sticky_clients_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("api.db_info.replicas.time.monotonic", lambda: now[0])
+    router = ReplicaRouter([], None, sticky_seconds = 5, max_clients = 2)
+
+    router.stick("sub:first")
+    assert router.is_sticky("sub:first")
+    now[0] += 6
+    assert not router.is_sticky("sub:first")
+
+    for client in ("sub:first", "sub:second", "sub:third"):
+        router.stick(client)
+    assert not router.is_sticky("sub:first")
+    assert router.stats()["sticky_clients"] == 2
+    router.clear()
+    assert not router.is_sticky("sub:third")
+
+def test_replica_reads_and_sticky_writes(tmp_path, monkeypatch):
+    (primary, replica, router) = replica_setup(tmp_path)
+    monkeypatch.setattr(database, "replica_router", router)
+    monkeypatch.setattr(dependencies.database, "replica_router", router)
+    session = sessionmaker(class_ = database.RoutingSession, bind = primary)
+
+    with session() as db:
+        # Reads go to the replica, which lacks CP, and the other statements to the primary
+        assert [point.name for point in asyncio.run(dependencies.run_crud(crud.get_points, db))] == ["DETI"]
+        assert asyncio.run(dependencies.run_crud(crud.get_point_by_name, db, "CP")) is None
+        assert asyncio.run(dependencies.run_crud(crud.get_sync_state, db))[0] == 5
+        assert replica.reads == 2
+        assert db.info["replica"] is None
+
+    with session() as db:
+        db.info["client"] = "sub:writer"
+        point = schemas.PointCreate(name = "Reitoria", location = "Departamento 25", coordinates = "40.63, -8.65",
+                                    image = "https://api-assets.ua.pt/files/imgs/000/000/380/original.jpg")
+        assert crud.create_point(db, point) is not None
+        assert router.is_sticky("sub:writer")
+
+    with session() as db:
+        db.info["primary"] = router.is_sticky("sub:writer")
+        assert asyncio.run(dependencies.run_crud(crud.get_point_by_name, db, "Reitoria")).name == "Reitoria"
+        assert replica.reads == 2
+
+    replica.healthy = False
+    with session() as db:
+        assert len(asyncio.run(dependencies.run_crud(crud.get_points, db))) == 3
+        assert router.fallbacks == 1
+
+def test_reads_follow_the_sync_version_of_writes(tmp_path, monkeypatch):
+    (primary, replica, router) = replica_setup(tmp_path)
+    monkeypatch.setattr(database, "replica_router", router)
+    monkeypatch.setattr(dependencies.database, "replica_router", router)
+    session = sessionmaker(class_ = database.RoutingSession, bind = primary)
+    router.check()
+    point = schemas.PointCreate(name = "Reitoria", location = "Departamento 25", coordinates = "40.63, -8.65",
+                                image = "https://api-assets.ua.pt/files/imgs/000/000/380/original.jpg")
+
+    # The write is answered with its sync version, and a conflicting one with none
+    (response, conflict) = (Response(), Response())
+    with session() as db:
+        dependencies.bind_client(db, request_from("10.0.0.1"), response)
+        assert asyncio.run(dependencies.run_crud(crud.create_point, db, point)) is not None
+    with session() as db:
+        dependencies.bind_client(db, request_from("10.0.0.1"), conflict)
+        assert asyncio.run(dependencies.run_crud(crud.create_point, db, point)) is None
+    assert response.headers["X-Sync-Version"] == "6"
+    assert "sync_version=6" in response.headers["set-cookie"]
+    assert "x-sync-version" not in conflict.headers
+
+    # An instance which doesn't know the writer sends its reads to the primary until the replica has the write
+    router.clear()
+    with session() as db:
+        dependencies.bind_client(db, request_from("10.0.0.2", ("cookie", "sync_version=6")), Response())
+        assert not db.info["primary"]
+        assert asyncio.run(dependencies.run_crud(crud.get_point_by_name, db, "Reitoria")).name == "Reitoria"
+        assert (replica.reads, router.fallbacks) == (0, 1)
+
+    with sessionmaker(bind = replica.engine)() as db:
+        db.add(models.Point(name = "Reitoria", location = "Departamento 25", coordinates = "40.63, -8.65"))
+        db.merge(models.SyncState(id = 1, version = 6))
+        db.commit()
+    router.check()
+    with session() as db:
+        dependencies.bind_client(db, request_from("10.0.0.3", ("x-sync-version", "6")), Response())
+        assert asyncio.run(dependencies.run_crud(crud.get_point_by_name, db, "Reitoria")).name == "Reitoria"
+        assert replica.reads == 1
+
+def test_shared_point_reads_keep_their_routing(tmp_path, monkeypatch):
+    (primary, replica, router) = replica_setup(tmp_path)
+    session = sessionmaker(class_ = database.RoutingSession, bind = primary)
+    for module in (database, dependencies.database):
+        monkeypatch.setattr(module, "replica_router", router)
+    monkeypatch.setattr(dependencies.database, "ASYNC_MODE", False)
+    monkeypatch.setattr(dependencies.database, "SessionLocal", session)
+    monkeypatch.setattr(main.crud.point_catalogue, "ttl", 0)
+    router.check()
+    router.stick("ip:10.0.0.1")
+    
+    get_point_by_name = main.crud.get_point_by_name
+    def slow_get_point_by_name(db, name):
+        time.sleep(0.1)
+        return get_point_by_name(db, name)
+    monkeypatch.setattr(main.crud, "get_point_by_name", database.replica_read(slow_get_point_by_name))
+    
+    async def read(request):
+        with session() as db:
+            dependencies.bind_client(db, request, Response())
+            return await main.get_point(request, "CP", db)
+    
+    async def read_concurrently():
+        # A sticky client, a client which wrote version 6 elsewhere, and a client which can read the lagging replica
+        return await asyncio.gather(read(request_from("10.0.0.1")), read(request_from("10.0.0.2", ("x-sync-version", "6"))),
+                                    read(request_from("10.0.0.3")), return_exceptions = True)
+    
+    (sticky, written, anonymous) = asyncio.run(read_concurrently())
+    assert sticky.status_code == written.status_code == 200
+    assert isinstance(anonymous, HTTPException) and anonymous.status_code == 204
+    assert replica.reads == 1
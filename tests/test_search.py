@@ -0,0 +1,54 @@
+from unittest.mock import patch
+from api.db_info.search import SearchIndex, normalize, tokenize
+
+## HELPER COMPONENTS
+
+POINTS = [("Pavilhão Aristides Hall", "Departamento E"),
+          ("Cantina de Santiago", "Departamento 6"),
+          ("Cantina do Crasto", "Departamento M"),
+          ("DETI", "Departamento 4"),
+          ("Biblioteca", "Pavilhão 2")]
+
+index = SearchIndex((key, name, location, name) for (key, (name, location)) in enumerate(POINTS))
+
+## UNIT TESTS
+
+def test_normalize():
+    assert normalize("Pavilhão ÁGUA") == "pavilhao agua"
+    assert tokenize("Cantina-de Santiago, 6") == ("cantina", "de", "santiago", "6")
+
+def test_search_is_accent_and_case_insensitive():
+    assert index.search("pavilhao", 10)[0] == "Pavilhão Aristides Hall"
+    assert index.search("PAVILHÃO ARIST", 10) == ["Pavilhão Aristides Hall"]
+    assert index.search("aristides pav", 10) == ["Pavilhão Aristides Hall"]
+
+def test_search_ranking():
+    # Name prefix first, then name matches, then location matches
+    assert index.search("pav", 10) == ["Pavilhão Aristides Hall", "Biblioteca"]
+    assert index.search("santiago", 10) == ["Cantina de Santiago"]
+    assert index.search("cantina", 1) == ["Cantina de Santiago"]
+    assert len(index.search("departamento", 10)) == 4
+
+def test_search_misses():
+    assert index.search("", 10) == []
+    assert index.search("  ,; ", 10) == []
+    assert index.search("cantina deti", 10) == []
+    assert index.search("zzz", 10) == []
+
+def test_updated_index_only_reindexes_changes():
+    entries = [(key, name, location, name) for (key, (name, location)) in enumerate(POINTS)]
+    entries[3] = (3, "Reitoria", "Departamento 25", "Reitoria")
+    entries.append((5, "Pavilhão Jardim", "Campus", "Pavilhão Jardim"))
+    with patch.object(SearchIndex, "REBUILD_RATIO", 1):
+        updated = index.updated(entries[1:])
+    
+    assert updated.search("deti", 10) == []
+    assert updated.search("reit", 10) == ["Reitoria"]
+    assert updated.search("pav", 10) == ["Pavilhão Jardim", "Biblioteca"]
+    assert updated.postings["cantina"] is index.postings["cantina"]
+    assert updated.words == SearchIndex(entries[1:]).words
+    # The previous index is left untouched
+    assert index.search("pav", 10) == ["Pavilhão Aristides Hall", "Biblioteca"]
+    assert index.search("deti", 10) == ["DETI"]
+    
+    assert index.updated([(key, name, location, name) for (key, (name, location)) in enumerate(POINTS[:1])]).search("cantina", 10) == []
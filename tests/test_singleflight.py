@@ -0,0 +1,57 @@
+import asyncio
+from pytest import raises
+from api.db_info.singleflight import SingleFlight
+
+## UNIT TESTS
+
+def test_concurrent_reads_share_one_call():
+    flights = SingleFlight()
+    calls = []
+    
+    async def read(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return [key]
+    
+    async def run():
+        return await asyncio.gather(*[flights.do(key, lambda key = key: read(key)) for key in ("a", "a", "b", "a")])
+    
+    results = asyncio.run(run())
+    assert results == [["a"], ["a"], ["b"], ["a"]]
+    assert results[0] is results[1]
+    assert sorted(calls) == ["a", "b"]
+    assert flights.stats() == {"leaders": 2, "followers": 2, "in_flight": 0}
+    
+    asyncio.run(run())
+    assert len(calls) == 4
+
+def test_errors_are_shared():
+    flights = SingleFlight()
+    
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("database down")
+    
+    async def run():
+        return await asyncio.gather(flights.do("a", fail), flights.do("a", fail), return_exceptions = True)
+    
+    assert [type(result) for result in asyncio.run(run())] == [ValueError, ValueError]
+    assert flights.stats()["leaders"] == 1
+    with raises(ValueError):
+        asyncio.run(flights.do("a", fail))
+
+def test_cancelled_follower_does_not_cancel_the_read():
+    flights = SingleFlight()
+    
+    async def read():
+        await asyncio.sleep(0.05)
+        return "point"
+    
+    async def run():
+        leader = asyncio.ensure_future(flights.do("a", read))
+        follower = asyncio.ensure_future(flights.do("a", read))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        return await leader
+    
+    assert asyncio.run(run()) == "point"